@@ -1,7 +1,16 @@
 from archiver.archiver import *
 from archiver.date_tools import *
 from archiver.url_tools import *
+from archiver.metrics import *
+from archiver.profiler import *
+from archiver.backends import *
+from archiver.bloom import *
 from archiver.database import *
+from archiver.segment_store import *
+from archiver.artifact_store import *
 from archiver.file_handler import *
+from archiver.http_pool import *
+from archiver.scheduler import *
 from archiver.scraper import *
+from archiver.parsers import *
 from archiver.analyzer import *
@@ -3,16 +3,61 @@
 """
 
 import logging
+import multiprocessing
 import re
+import threading
+import time
 
-from bs4 import BeautifulSoup as bs
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+
+from archiver.artifact_store import ArtifactStore
+from archiver.parsers import SoupParser, get_parser
 
 # pylint: disable=missing-docstring
 
+# Upper bounds of the buckets of the number of links on a page.
+LINKS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+def process_context():
+    """multiprocessing context to start processes from a process with
+    threads running, such as the database writer.
+
+    Forking would copy the locks held by those threads, so processes are
+    started by a forkserver, or spawned where there is none.
+    """
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+        else 'spawn')
+
+def _links(parser, data, args, encoding = False):
+    """Links in data read with the parser called parser, the seconds that
+    took, and the encoding of data if asked for. Run in the processes of
+    Analyzer.find_links_in_pages.
+
+    """
+    parser = get_parser(parser)
+    start = time.perf_counter()
+    links = parser.links(data, *args)
+    seconds = time.perf_counter() - start
+    return links, seconds, parser.encoding(data) if encoding else None
+
 class Analyzer():
 
-    def __init__(self, parent):
+    def __init__(self, parent, parser = None, artifacts = False):
         self.parent = parent
+        # Parser of pages, see archiver.parsers (None: the fastest one).
+        self.parser = get_parser(parser)
+        # Keep what is read out of pages in an ArtifactStore.
+        self.keep_artifacts = artifacts
+        self._artifacts = None
+        self._artifacts_lock = threading.Lock()
+        metrics = parent.metrics
+        self.parse_seconds = metrics.histogram(
+            'scan_parse_seconds', 'Time to parse a page.')
+        self.links_per_page = metrics.histogram(
+            'scan_links_per_page', 'Links found on a scanned page.',
+            buckets = LINKS)
 
     @staticmethod
     def show_counter(counter, root, filtr = None):
@@ -42,6 +87,124 @@ class Analyzer():
             target_element = None, target_class = None, target_id = None):
         if not isinstance(url, str):
             raise TypeError('url is type:', type(url), url)
+        target_element, target_class, target_id = self._targets(
+            target_element, target_class, target_id)
+
+        if self.parent.db.content_scanned(url):
+            # The links are in the database already, from another url.
+            logging.info('Same contents scanned already: %s', url)
+            self.parent.db.set_scanned(url)
+            return
+        links = self._parse(
+            url, 'links', self.parser.links,
+            target_element, target_class, target_id)
+        self._save_links(url, links)
+
+    def find_links_in_pages(
+            self, urls,
+            target_element = None, target_class = None, target_id = None,
+            workers = None, batch_size = 100):
+        """find_links_in_page for each of urls, with the pages parsed in a
+        pool of workers processes (None: one per CPU).
+
+        Pages are read and handed to the pool batch_size at a time, and only
+        their links come back. The links of a batch are saved in the order
+        of urls, as find_links_in_page would, while the next batch is
+        parsed, and are committed before the batch after that is read.
+        """
+        if workers is not None and not isinstance(workers, int):
+            raise TypeError('Parameter \'workers\' must be an integer.')
+        if not isinstance(batch_size, int):
+            raise TypeError('Parameter \'batch_size\' must be an integer.')
+        if batch_size < 1 or (workers is not None and workers < 1):
+            raise ValueError('workers and batch_size must be at least 1.')
+        targets = self._targets(target_element, target_class, target_id)
+        urls = iter(urls)
+        with ProcessPoolExecutor(
+                workers, mp_context = process_context()) as pool:
+            jobs = None
+            for batch in iter(lambda: list(islice(urls, batch_size)), []):
+                submitted = self._submit(pool, batch, targets)
+                if jobs is not None:
+                    self._collect(jobs, targets)
+                jobs = submitted
+                if isinstance(jobs[-1][3], Exception):
+                    break
+            if jobs is not None:
+                self._collect(jobs, targets)
+
+    def _submit(self, pool, urls, targets):
+        """(url, fname, digest, job) for each of urls, where job is None
+        for contents scanned already, the links kept as artifact, or the
+        Future of _links. A page that cannot be read ends the jobs with the
+        error as job, raised once the pages before it are saved.
+
+        """
+        artifacts = self.get_artifacts()
+        parsing = {}
+        jobs = []
+        for url in urls:
+            if not isinstance(url, str):
+                raise TypeError('url is type:', type(url), url)
+            if self.parent.db.content_scanned(url):
+                jobs.append((url, None, None, None))
+                continue
+            try:
+                fname, data = self._read(url)
+            except OSError as e:
+                jobs.append((url, None, None, e))
+                break
+            digest = None
+            if artifacts is not None:
+                digest = artifacts.digest(data)
+            if fname not in parsing:
+                links = None
+                if artifacts is not None:
+                    links = artifacts.get(
+                        int(fname), digest, 'links',
+                        [self.parser.name] + list(targets))
+                if links is not None:
+                    artifacts.hits += 1
+                    parsing[fname] = links
+                else:
+                    parsing[fname] = pool.submit(
+                        _links, self.parser.name, data, targets,
+                        artifacts is not None)
+            jobs.append((url, fname, digest, parsing[fname]))
+        return jobs
+
+    def _collect(self, jobs, targets):
+        """Save the links of jobs from _submit, and commit them."""
+        artifacts = self.get_artifacts()
+        done = set()
+        for url, fname, digest, job in jobs:
+            if isinstance(job, Exception):
+                raise job
+            if job is None or self.parent.db.content_scanned(url):
+                # The links are in the database already, from another url.
+                logging.info('Same contents scanned already: %s', url)
+                self.parent.db.set_scanned(url)
+                continue
+            if isinstance(job, Future):
+                links, seconds, encoding = job.result()
+                if fname not in done:
+                    done.add(fname)
+                    self.parse_seconds.observe(seconds)
+                    self.parent.profiler.add('parse', seconds)
+                    if artifacts is not None:
+                        artifacts.misses += 1
+                        artifacts.put(
+                            int(fname), digest, 'links', links,
+                            [self.parser.name] + list(targets))
+                        artifacts.put(
+                            int(fname), digest, 'encoding', encoding, [])
+            else:
+                links = job
+            self._save_links(url, links)
+        self.parent.db.flush()
+
+    @staticmethod
+    def _targets(target_element, target_class, target_id):
         if target_element is None: target_element = ''
         if not isinstance(target_element, str):
             raise TypeError('Parameter \'target_element\' must be a string.')
@@ -51,42 +214,92 @@ class Analyzer():
         if target_id is None: target_id = ''
         if not isinstance(target_id, str):
             raise TypeError('Parameter \'target_id\' must be a string.')
+        return target_element, target_class, target_id
 
-        soup = self.get_soup(url = url)
-        target = soup.find(target_element, class_=target_class, id=target_id)
-        if target is None: target = soup
-        links = []
-        for a in target.find_all('a'):
-            if a.has_attr('href'):
-                link = a.attrs['href'].strip()
-                links.append(link)
-        self._save_links_from_page(url, links)
+    def _save_links(self, url, links):
+        links = [link.strip() for link in links]
+        self.links_per_page.observe(len(links))
+        with self.parent.profiler.span('save_links'):
+            self._save_links_from_page(url, links)
 
     def find_text_in_page(self, url):
         if not isinstance(url, str):
             raise TypeError('url is type:', type(url), url)
-        soup = self.get_soup(url = url)
-        return soup.text
+        return self._parse(url, 'text', self.parser.text)
+
+    def find_encoding_of_page(self, url):
+        """Encoding the page of url is read in."""
+        if not isinstance(url, str):
+            raise TypeError('url is type:', type(url), url)
+        return self._parse(url, 'encoding', self.parser.encoding)
 
     def get_soup(self, url):
+        data = self.read_page(url)
+        with self.parse_seconds.time(), self.parent.profiler.span('parse'):
+            return SoupParser().soup(data)
+
+    def read_page(self, url):
+        return self._read(url)[1]
+
+    def _read(self, url):
         if url is None or not isinstance(url, str):
             raise TypeError("url must be a string.")
         fname = self.parent.db.get_filename(url)
         logging.info(
-            'Loading & Souping file: [%s] for url: [%s]', fname, url)
+            'Loading & Parsing file: [%s] for url: [%s]', fname, url)
         try:
-            fpath = self.parent.db.get_filepath(url)
-            with open(fpath, 'rb') as fobj:
-                soup = bs(fobj.read(), 'html.parser')
-                # Remove all scripts and style data:
-                # http://stackoverflow.com/questions/22799990/beatifulsoup4
-                #                       -get-text-still-has-javascript
-                for script in soup(["script", "style"]):
-                    script.extract()
-                return soup
+            return fname, self.parent.fh.read_page(fname)
         except FileNotFoundError:
             raise OSError('File not found: {}'.format(fname))
 
+    def _parse(self, url, kind, parse, *args):
+        """parse(data, *args) for the page of url, kept as artifact kind
+        of the parser and args if artifacts are kept. Pages are decoded the
+        same way by all parsers, so their encoding is kept for all.
+
+        """
+        fname, data = self._read(url)
+        artifacts = self.get_artifacts()
+
+        def make(data):
+            with self.parse_seconds.time(), \
+                    self.parent.profiler.span('parse'):
+                value = parse(data, *args)
+            if artifacts is not None and kind != 'encoding':
+                # Kept with the first artifact of the page.
+                artifacts.cached(
+                    int(fname), data, 'encoding', self.parser.encoding, [])
+            return value
+
+        if artifacts is None:
+            return make(data)
+        key = list(args)
+        if kind != 'encoding':
+            key.insert(0, self.parser.name)
+        return artifacts.cached(int(fname), data, kind, make, key)
+
+    def artifacts_path(self):
+        if not self.parent.db.backend.persistent:
+            # Kept as long as the database.
+            return ':memory:'
+        return self.parent.fh.db + '.artifacts'
+
+    def get_artifacts(self):
+        """The ArtifactStore, or None if artifacts are not kept."""
+        if not self.keep_artifacts:
+            return None
+        with self._artifacts_lock:
+            if self._artifacts is None:
+                self._artifacts = ArtifactStore(self.artifacts_path())
+            return self._artifacts
+
+    def close(self):
+        with self._artifacts_lock:
+            if self._artifacts is not None:
+                logging.info('Artifacts: %s', self._artifacts.stats())
+                self._artifacts.close()
+                self._artifacts = None
+
     def _save_links_from_page(self, url, links):
         if not isinstance (url, str):
             raise TypeError('url needs to be of type string.')
@@ -3,6 +3,10 @@
 """
 
 import logging
+import os
+import socket
+import threading
+import time
 
 import archiver
 
@@ -17,58 +21,205 @@ class Agent(object):
 
     """
 
-    def __init__(self, directory, archive_folder, db):
+    def __init__(
+            self, directory, archive_folder, db, storage = None,
+            layout = 'sharded', backend = 'file', profile = None,
+            parser = None, artifacts = False, rate = None, max_rate = None):
+        self.metrics = archiver.Metrics()
+        self.profiler = archiver.Profiler(profile)
         self.fh = archiver.FileHander(
             parent = self,
-            directory = directory, archive_folder = archive_folder, db = db)
-        self.db = archiver.DB(parent = self)
-        self.scraper = archiver.Scraper(parent = self)
-        self.analyzer = archiver.Analyzer(parent = self)
+            directory = directory, archive_folder = archive_folder, db = db,
+            storage = storage, layout = layout)
+        self.db = archiver.DB(parent = self, backend = backend)
+        self.scraper = archiver.Scraper(
+            parent = self, rate = rate, max_rate = max_rate)
+        self.analyzer = archiver.Analyzer(
+            parent = self, parser = parser, artifacts = artifacts)
 
     def clean(self):
+        self.metrics.stop_reporter()
+        self.analyzer.close()
+        self.db.close()
         self.fh.clean()
 
+    def close(self):
+        self.metrics.stop_reporter()
+        self.analyzer.close()
+        self.db.close()
+        self.fh.close()
+        if self.profiler.enabled:
+            logging.info('Profile:\n%s', self.profiler.report())
+
+    def report_metrics(self, interval = 60, path = None):
+        """Log a summary of the metrics every interval seconds, and write
+        them to path in the Prometheus text format, until closed.
+
+        """
+        self.metrics.start_reporter(interval, path)
+
+    def shard_archive(self):
+        """Move the files of a flat archive into shards."""
+        self.fh.shard()
+
+    def pack_archive(self):
+        """Move a one-file-per-page archive into segments."""
+        self.fh.pack()
+
     def seed_archive(self, urls):
         self.db.seed_archive(urls)
 
-    def load_unfetched_links(self, restorer = None):
-        urls = self.db.get_unfetched_links()
-        #exit()
-        self.scraper.load_pages(urls, restorer)
+    def load_unfetched_links(
+            self, restorer = None, concurrency = None, per_host = None,
+            retry = True):
+        with self.profiler.stage('load_unfetched_links'):
+            urls = self.db.iter_unfetched_links()
+            #exit()
+            self.scraper.load_pages(
+                urls, restorer, concurrency = concurrency, per_host = per_host,
+                retry = retry)
+
+    def load_unfetched_seeds(
+            self, restorer = None, concurrency = None, per_host = None,
+            retry = True):
+        with self.profiler.stage('load_unfetched_seeds'):
+            urls = self.db.get_unfetched_seeds()
+            self.scraper.load_pages(
+                urls, restorer, concurrency = concurrency, per_host = per_host,
+                retry = retry)
+
+    def refetch_seeds(
+            self, restorer = None, concurrency = None, per_host = None,
+            retry = True):
+        """Fetch all seeds again, conditionally on them having changed.
 
-    def load_unfetched_seeds(self, restorer = None):
-        urls = self.db.get_unfetched_seeds()
-        self.scraper.load_pages(urls, restorer)
+        """
+        urls = self.db.get_seeds()
+        self.scraper.load_pages(
+            urls, restorer, concurrency = concurrency, per_host = per_host,
+            refetch = True, retry = retry)
+
+    def fill_frontier(self):
+        """Put all unfetched seeds and links in the frontier, seeds first.
 
-    def load_pages(self, urls, restorer = None):
-        self.scraper.load_pages(urls, restorer)
+        """
+        self.db.add_to_frontier(self.db.iter_unfetched_seeds(), priority = 1)
+        self.db.add_to_frontier(self.db.iter_unfetched_links())
+
+    def run_worker(
+            self, worker = None, batch_size = 100, lease = 600,
+            restorer = None, concurrency = None, per_host = None):
+        """Fetch leased batches of urls from the frontier until it is empty.
+
+        Any number of workers, in any number of processes, can run on the
+        same database. Urls leased to a worker that died are handed out
+        again once the lease expires. Urls that failed go back to the
+        frontier, to be claimed once they are due for another attempt; the
+        worker waits for them up to the scraper's ``retry_wait``.
+        """
+        if worker is None:
+            worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(lease / 3):
+                self.db.renew_leases(worker, lease)
+        renewer = threading.Thread(target = renew, daemon = True)
+        renewer.start()
+        try:
+            while True:
+                urls = self.db.claim_urls(worker, batch_size, lease)
+                if not urls:
+                    next_attempt = self.db.get_next_deferred()
+                    if next_attempt is None:
+                        break
+                    wait = next_attempt - time.time()
+                    if wait > self.scraper.retry_wait:
+                        logging.info('Leaving failed urls for the next run.')
+                        break
+                    time.sleep(max(0, wait))
+                    continue
+                logging.info('Worker %s claimed %s urls.', worker, len(urls))
+                self.scraper.load_pages(
+                    urls, restorer, concurrency = concurrency,
+                    per_host = per_host, retry = False)
+                self.db.flush()
+                deferred = self._deferred(urls)
+                self.db.defer_urls(worker, deferred)
+                deferred = {url for url, _ in deferred}
+                self.db.complete_urls(
+                    worker, [url for url in urls if url not in deferred])
+        finally:
+            stop.set()
+            renewer.join()
+            self.db.flush()
+            self.db.release_urls(worker)
+
+    def _deferred(self, urls):
+        """(url, next_attempt) for the urls to try again."""
+        deferred = []
+        for url in urls:
+            retry = self.db.get_retry(url)
+            if retry is not None and retry[0] < self.scraper.max_attempts:
+                deferred.append((url, retry[1]))
+        return deferred
+
+    def load_pages(
+            self, urls, restorer = None, concurrency = None, per_host = None,
+            retry = True):
+        self.scraper.load_pages(
+            urls, restorer, concurrency = concurrency, per_host = per_host,
+            retry = retry)
 
     def find_links_in_archive(
-            self, target_element = None, target_class = None, target_id = None):
-        for url in self.db.get_unscanned():
-            self.analyzer.find_links_in_page(
-                url,
-                target_element = target_element,
-                target_class = target_class,
-                target_id = target_id)
+            self, target_element = None, target_class = None, target_id = None,
+            workers = None, batch_size = 100):
+        """Scan the unscanned seeds for links, parsing the pages one at a
+        time, or with workers set, in that many processes, batch_size pages
+        at a time (see Analyzer.find_links_in_pages).
+
+        """
+        with self.profiler.stage('find_links_in_archive'):
+            if workers is not None:
+                self.analyzer.find_links_in_pages(
+                    self.db.iter_unscanned(),
+                    target_element = target_element,
+                    target_class = target_class,
+                    target_id = target_id,
+                    workers = workers, batch_size = batch_size)
+                return
+            for url in self.db.iter_unscanned():
+                with self.profiler.span('scan'):
+                    self.analyzer.find_links_in_page(
+                        url,
+                        target_element = target_element,
+                        target_class = target_class,
+                        target_id = target_id)
 
     def extract_text_from_articles(self):
         """Only scan non-seeds.
 
         """
-        fetched_pages = self.db.get_fetched_articles()
-        for page in fetched_pages:
-            print (''.join((80*['='])))
-            print (''.join((80*['='])))
-            print ()
-            text = self.analyzer.find_text_in_page(page)
-            import re
-            out = text
-            out = re.sub(r'\n+', r'\n', out)
-            out = re.sub(r'\t+', r'', out)
-            out = re.sub(r'( )+', r' ', out)
-            print ('来源 in out and 字号 in out:', '来源' in out and '字号' in out)
-            print (out)
-            print ()
+        with self.profiler.stage('extract_text_from_articles'):
+            fetched_pages = self.db.iter_fetched_articles()
+            # Urls with the same contents share a file, only extract it once.
+            seen = set()
+            for page in fetched_pages:
+                fname = self.db.get_filename(page)
+                if fname in seen:
+                    continue
+                seen.add(fname)
+                print (''.join((80*['='])))
+                print (''.join((80*['='])))
+                print ()
+                with self.profiler.span('extract'):
+                    text = self.analyzer.find_text_in_page(page)
+                import re
+                out = text
+                out = re.sub(r'\n+', r'\n', out)
+                out = re.sub(r'\t+', r'', out)
+                out = re.sub(r'( )+', r' ', out)
+                print ('来源 in out and 字号 in out:', '来源' in out and '字号' in out)
+                print (out)
+                print ()
         #file_names = [self.db.get_filepath(_) for _ in fetched_pages]
         #print (file_names[:10])
@@ -0,0 +1,121 @@
+""" What was read out of archived pages.
+
+Links, text, meta tags and the like are kept in an SQLite file next to the
+archive once a page is parsed, so later stages need not parse it again.
+
+"""
+
+import hashlib
+import json
+import sqlite3 as lite
+import threading
+import zlib
+
+# pylint: disable=missing-docstring
+
+class ArtifactStore():
+    """Artifacts of pages, keyed by the file id and content hash of the
+    page, the kind of artifact and the arguments it was made with.
+
+    An artifact of a file whose contents changed since has another hash,
+    and is made again.
+    """
+
+    # Artifacts of stores of other versions are dropped, for when the way
+    # they are made changes.
+    version = 2
+
+    def __init__(self, path, level = 6):
+        if not isinstance(path, str):
+            raise TypeError('path must be a string.')
+        self.path = path
+        self.level = level
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._con = lite.connect(path, check_same_thread = False)
+        with self._lock, self._con as con:
+            con.execute('PRAGMA journal_mode = wal')
+            con.execute('PRAGMA synchronous = normal')
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS artifacts('
+                'file_id INTEGER NOT NULL,'
+                'kind TEXT NOT NULL,'
+                'key TEXT NOT NULL,'
+                'hash TEXT NOT NULL,'
+                'value BLOB NOT NULL,'
+                'PRIMARY KEY (file_id, kind, key)'
+                ')'
+            )
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.version:
+                con.execute('DELETE FROM artifacts')
+                con.execute('PRAGMA user_version = {}'.format(
+                    int(self.version)))
+
+    @staticmethod
+    def digest(data):
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def _key(key):
+        return key if isinstance(key, str) else json.dumps(key)
+
+    def get(self, file_id, digest, kind, key = ''):
+        """Artifact kind of file_id made with key, or None if there is none
+        for contents with hash digest.
+
+        """
+        with self._lock:
+            row = self._con.execute(
+                'SELECT hash, value FROM artifacts '
+                'WHERE file_id = ? AND kind = ? AND key = ?',
+                (file_id, kind, self._key(key))).fetchone()
+        if row is None or row[0] != digest:
+            return None
+        return json.loads(zlib.decompress(row[1]).decode())
+
+    def put(self, file_id, digest, kind, value, key = ''):
+        """Keep value, anything json can hold, as artifact kind of file_id
+        with contents of hash digest, made with key.
+
+        """
+        if not isinstance(file_id, int):
+            raise TypeError('file_id must be an integer.')
+        blob = zlib.compress(json.dumps(value).encode(), self.level)
+        with self._lock, self._con as con:
+            con.execute(
+                'INSERT OR REPLACE INTO artifacts '
+                '(file_id, kind, key, hash, value) VALUES (?, ?, ?, ?, ?)',
+                (file_id, kind, self._key(key), digest, blob))
+
+    def cached(self, file_id, data, kind, make, key = ''):
+        """Artifact kind of file_id, whose contents are data, or make(data)
+        kept as such.
+
+        """
+        digest = self.digest(data)
+        value = self.get(file_id, digest, kind, key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = make(data)
+        self.put(file_id, digest, kind, value, key)
+        return value
+
+    def forget(self, file_id):
+        with self._lock, self._con as con:
+            con.execute('DELETE FROM artifacts WHERE file_id = ?', (file_id,))
+
+    def stats(self):
+        with self._lock:
+            count = self._con.execute(
+                'SELECT COUNT(*) FROM artifacts').fetchone()[0]
+        return {'artifacts': count, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._con.close()
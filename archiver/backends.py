@@ -0,0 +1,112 @@
+""" Where the database is kept.
+
+A backend opens the connections of DB. All backends are SQLite databases,
+so DB runs the same statements on each of them.
+
+"""
+
+import itertools
+import os
+import sqlite3 as lite
+import threading
+import time
+
+# pylint: disable=missing-docstring
+
+def _timed(execute):
+    """Count and time execute in the metrics of the connection, by the
+    first word of the statement.
+
+    """
+    def timed(self, sql, *args):
+        con = self if isinstance(self, Connection) else self.connection
+        if con.metrics is None:
+            return execute(self, sql, *args)
+        start = time.perf_counter()
+        try:
+            return execute(self, sql, *args)
+        finally:
+            op = sql.split(None, 1)[0].upper() if sql.strip() else ''
+            con.queries.inc(op = op)
+            con.query_seconds.observe(time.perf_counter() - start, op = op)
+    return timed
+
+class Cursor(lite.Cursor):
+
+    execute = _timed(lite.Cursor.execute)
+    executemany = _timed(lite.Cursor.executemany)
+
+class Connection(lite.Connection):
+    """Connection that can be weakly referenced, so the connections of
+    finished threads are closed when collected, and that reports its
+    statements to ``metrics`` when set.
+
+    """
+
+    # Value of PRAGMA synchronous it was set up with.
+    synchronous = None
+    metrics = None
+
+    execute = _timed(lite.Connection.execute)
+    executemany = _timed(lite.Connection.executemany)
+
+    def cursor(self, factory = Cursor):
+        return super().cursor(factory)
+
+    def instrument(self, metrics):
+        """Count and time statements in metrics, an archiver.Metrics."""
+        self.queries = metrics.counter(
+            'db_queries_total', 'Statements run, by kind.', ('op',))
+        self.query_seconds = metrics.histogram(
+            'db_query_seconds', 'Time spent running statements.', ('op',))
+        self.metrics = metrics
+
+class SQLiteBackend():
+    """Database in the SQLite file of the archive, which several processes
+    can share.
+
+    """
+
+    # Whether files kept next to the database (path + suffix) last:
+    persistent = True
+
+    def connect(self, path, timeout):
+        return lite.connect(
+            path, timeout = timeout, check_same_thread = False,
+            factory = Connection)
+
+    def close(self):
+        pass
+
+class MemoryBackend(SQLiteBackend):
+    """Database in memory, shared by the threads of this process. It is gone
+    once closed, e.g. for tests and short analysis runs.
+
+    """
+
+    persistent = False
+
+    _numbers = itertools.count()
+
+    def __init__(self):
+        self.uri = 'file:/archiver-{}-{}?vfs=memdb'.format(
+            os.getpid(), next(self._numbers))
+        self._keep = None
+        self._lock = threading.Lock()
+
+    def connect(self, path, timeout):
+        with self._lock:
+            if self._keep is None:
+                # The database lives as long as a connection to it is open.
+                self._keep = lite.connect(self.uri, uri = True)
+        return lite.connect(
+            self.uri, uri = True, timeout = timeout,
+            check_same_thread = False, factory = Connection)
+
+    def close(self):
+        with self._lock:
+            if self._keep is not None:
+                self._keep.close()
+                self._keep = None
+
+BACKENDS = {'file': SQLiteBackend, 'memory': MemoryBackend}
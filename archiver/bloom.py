@@ -0,0 +1,160 @@
+""" Probabilistic sets of strings.
+
+"""
+
+import hashlib
+import json
+import math
+import struct
+
+from archiver.file_handler import FileHander
+
+# pylint: disable=missing-docstring
+
+MAGIC = b'BLOOM1'
+HEADER = struct.Struct('>6sI')
+
+class BloomFilter():
+    """Set of up to ``capacity`` strings, in which a string that was not
+    added is found with a chance of about ``error_rate``.
+
+    """
+
+    def __init__(self, capacity, error_rate, bits = None, count = 0):
+        if capacity < 1:
+            raise ValueError('capacity must be positive.')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1.')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = self.bits_needed(capacity, error_rate)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        if bits is None:
+            bits = bytearray((self.size + 7) // 8)
+        elif len(bits) != (self.size + 7) // 8:
+            raise ValueError('Wrong number of bits.')
+        self.bits = bits
+        self.count = count
+
+    @staticmethod
+    def bits_needed(capacity, error_rate):
+        return math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size = 16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(
+            bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """Add key, return whether it was new (or seemed to be)."""
+        new = False
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                bits[p >> 3] |= 1 << (p & 7)
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def current_error_rate(self):
+        """Chance of finding a string that was not added, now."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) \
+            ** self.hashes
+
+class ScalableBloomFilter():
+    """Bloom filter that grows as strings are added (Almeida et al., 2007).
+
+    When a filter is full, another one is added with ``growth`` times its
+    capacity and ``tightening`` times its error rate, so the error rate of
+    all of them stays below ``error_rate``.
+    """
+
+    def __init__(
+            self, capacity = 100000, error_rate = 1e-6, growth = 2,
+            tightening = 0.5):
+        if not 0 < tightening < 1:
+            raise ValueError('tightening must be between 0 and 1.')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+        # What the filter covers, e.g. the last row added to it.
+        self.mark = None
+
+    def __contains__(self, key):
+        return any(key in f for f in reversed(self.filters))
+
+    def add(self, key):
+        """Add key, return whether it was new (or seemed to be)."""
+        if key in self:
+            return False
+        if not self.filters or self.filters[-1].full:
+            number = len(self.filters)
+            self.filters.append(BloomFilter(
+                self.capacity * self.growth ** number,
+                self.error_rate * (1 - self.tightening)
+                * self.tightening ** number))
+        return self.filters[-1].add(key)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def stats(self):
+        return {
+            'count': len(self),
+            'filters': len(self.filters),
+            'bytes': sum(len(f.bits) for f in self.filters),
+            'error_rate': 1 - math.prod(
+                1 - f.current_error_rate() for f in self.filters)}
+
+    def save(self, path):
+        """Write the filter to path, replacing it at once."""
+        header = json.dumps({
+            'capacity': self.capacity, 'error_rate': self.error_rate,
+            'growth': self.growth, 'tightening': self.tightening,
+            'mark': self.mark,
+            'filters': [
+                [f.capacity, f.error_rate, f.count] for f in self.filters],
+        }).encode()
+        with FileHander.open_atomic(path) as fobj:
+            fobj.write(HEADER.pack(MAGIC, len(header)))
+            fobj.write(header)
+            for f in self.filters:
+                fobj.write(f.bits)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by save. Raises ValueError if the file is
+        not one.
+
+        """
+        with open(path, 'rb') as fobj:
+            head = fobj.read(HEADER.size)
+            if len(head) < HEADER.size:
+                raise ValueError('Not a Bloom filter: {}'.format(path))
+            magic, length = HEADER.unpack(head)
+            if magic != MAGIC:
+                raise ValueError('Not a Bloom filter: {}'.format(path))
+            header = json.loads(fobj.read(length).decode())
+            bloom = cls(
+                header['capacity'], header['error_rate'], header['growth'],
+                header['tightening'])
+            bloom.mark = header['mark']
+            for capacity, error_rate, count in header['filters']:
+                size = BloomFilter.bits_needed(capacity, error_rate)
+                bits = fobj.read((size + 7) // 8)
+                bloom.filters.append(
+                    BloomFilter(capacity, error_rate, bytearray(bits), count))
+        return bloom
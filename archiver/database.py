@@ -2,19 +2,257 @@
 
 """
 
+import atexit
+import itertools
 import os
 import logging
+import queue
+import threading
+import time
+import weakref
 
-import sqlite3 as lite
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from archiver.backends import BACKENDS
+from archiver.bloom import ScalableBloomFilter
+from archiver.url_tools import canonical_url
 
 # pylint: disable=missing-docstring, too-many-public-methods
 
+# Changes to the schema of existing databases, in order. The version of a
+# database (PRAGMA user_version) is the number of them it has had.
+MIGRATIONS = (
+    (
+        # One row per url, keeping a fetched page over a 404.
+        'DELETE FROM file_names WHERE ID NOT IN ('
+        'SELECT ID FROM (SELECT ID, ROW_NUMBER() OVER ('
+        'PARTITION BY url ORDER BY four_o_four, ID) AS n FROM file_names) '
+        'WHERE n = 1)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS file_names_url ON file_names(url)',
+        'CREATE INDEX IF NOT EXISTS file_names_unscanned ON file_names(url) '
+        'WHERE scanned = 0 AND four_o_four = 0',
+        'CREATE INDEX IF NOT EXISTS links_link ON links(link)',
+        'CREATE INDEX IF NOT EXISTS links_url_fetched ON links(url, fetched)',
+        'CREATE INDEX IF NOT EXISTS links_unfetched ON links(url, link) '
+        'WHERE fetched = 0',
+    ),
+    (
+        # Every url once, in urls. Pages and links refer to it by ID, the
+        # old tables become views of them.
+        'CREATE TABLE urls('
+        'ID INTEGER PRIMARY KEY,'
+        'url VARCHAR(255) NOT NULL UNIQUE'
+        ')',
+        'INSERT OR IGNORE INTO urls (url) SELECT url FROM file_names',
+        'INSERT OR IGNORE INTO urls (url) SELECT url FROM links',
+        'INSERT OR IGNORE INTO urls (url) SELECT link FROM links',
+        'CREATE TABLE pages('
+        'ID INTEGER PRIMARY KEY AUTOINCREMENT,'
+        'url_id INT NOT NULL UNIQUE REFERENCES urls(ID),'
+        'scanned INT DEFAULT 0,'
+        'four_o_four INT DEFAULT 0'
+        ')',
+        'INSERT INTO pages (ID, url_id, scanned, four_o_four) '
+        'SELECT file_names.ID, urls.ID, scanned, four_o_four FROM file_names '
+        'JOIN urls ON urls.url = file_names.url',
+        # File names of deleted pages are not given out again.
+        'DELETE FROM sqlite_sequence WHERE name = "pages"',
+        'INSERT INTO sqlite_sequence (name, seq) '
+        'SELECT "pages", seq FROM sqlite_sequence WHERE name = "file_names"',
+        'CREATE TABLE edges('
+        'url_id INT NOT NULL REFERENCES urls(ID),'
+        'link_id INT NOT NULL REFERENCES urls(ID),'
+        'fetched INT DEFAULT 0,'
+        'UNIQUE(url_id, link_id) ON CONFLICT IGNORE'
+        ')',
+        'INSERT INTO edges (url_id, link_id, fetched) '
+        'SELECT source.ID, target.ID, fetched FROM links '
+        'JOIN urls AS source ON source.url = links.url '
+        'JOIN urls AS target ON target.url = links.link '
+        'ORDER BY links.rowid',
+        'DROP TABLE file_names',
+        'DROP TABLE links',
+        'CREATE VIEW file_names AS '
+        'SELECT urls.url AS url, pages.ID AS ID, scanned, four_o_four '
+        'FROM pages JOIN urls ON urls.ID = pages.url_id',
+        'CREATE VIEW links AS '
+        'SELECT source.url AS url, target.url AS link, fetched FROM edges '
+        'JOIN urls AS source ON source.ID = edges.url_id '
+        'JOIN urls AS target ON target.ID = edges.link_id',
+        'CREATE TRIGGER file_names_insert INSTEAD OF INSERT ON file_names '
+        'BEGIN '
+        'INSERT OR IGNORE INTO urls (url) VALUES (NEW.url); '
+        'INSERT INTO pages (url_id, scanned, four_o_four) '
+        'SELECT ID, COALESCE(NEW.scanned, 0), COALESCE(NEW.four_o_four, 0) '
+        'FROM urls WHERE url = NEW.url; '
+        'END',
+        'CREATE TRIGGER links_insert INSTEAD OF INSERT ON links '
+        'BEGIN '
+        'INSERT OR IGNORE INTO urls (url) VALUES (NEW.url); '
+        'INSERT OR IGNORE INTO urls (url) VALUES (NEW.link); '
+        'INSERT INTO edges (url_id, link_id, fetched) '
+        'SELECT source.ID, target.ID, COALESCE(NEW.fetched, 0) '
+        'FROM urls AS source, urls AS target '
+        'WHERE source.url = NEW.url AND target.url = NEW.link; '
+        'END',
+        'CREATE INDEX pages_unscanned ON pages(url_id) '
+        'WHERE scanned = 0 AND four_o_four = 0',
+        'CREATE INDEX edges_link ON edges(link_id)',
+        'CREATE INDEX edges_url_fetched ON edges(url_id, fetched)',
+        'CREATE INDEX edges_unfetched ON edges(url_id, link_id) '
+        'WHERE fetched = 0',
+    ),
+    (
+        # Unfetched links in order, for paging through them.
+        'CREATE INDEX edges_unfetched_link ON edges(link_id) '
+        'WHERE fetched = 0',
+    ),
+    (
+        # A random id, telling files kept next to the database whether
+        # they belong to it.
+        'CREATE TABLE meta('
+        'key VARCHAR(255) PRIMARY KEY,'
+        'value VARCHAR(255)'
+        ')',
+        'INSERT INTO meta (key, value) '
+        'VALUES ("id", lower(hex(randomblob(16))))',
+    ),
+)
+
+# ID of an url, in SQL.
+URL_ID = '(SELECT ID FROM urls WHERE url = ?)'
+
+# Queue markers for the writer thread.
+_FLUSH = object()
+_STOP = object()
+
+# Databases with writes to flush before the interpreter exits.
+_open_dbs = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for db in list(_open_dbs):
+        db.close()
+
+class LRUCache():
+    """Mapping of at most ``maxsize`` items, dropping the least recently
+    used ones, which counts its hits and misses.
+
+    """
+
+    def __init__(self, maxsize = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last = False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items)}
+
 class DB():
+    """Bookkeeping of the archive in SQLite, kept by backend: 'file' (the
+    database file of the archive), 'memory', or a backend object.
+
+    Every thread keeps one connection open, in WAL mode by default so
+    readers and the writer do not block each other.
+
+    Bookkeeping of the crawl (fetched, scanned, 404 and links) is written
+    behind: a writer thread commits it in transactions of up to
+    ``write_batch_size`` statements, or every ``write_interval`` seconds.
+    Listing queries flush it first, flush() waits for it.
 
-    def __init__(self, parent):
+    The file name and 404 status of recently used urls are cached, for
+    the changes made by this process.
+
+    Seeds and links are stored in canonical form (see canonical_url), with
+    the ``url_query`` and ``url_ignore_params`` settings, so the same page
+    is only fetched once.
+
+    With ``bloom`` set, register_links leaves out links that a Bloom filter
+    has seen already, without asking SQLite. A new link is taken for a
+    seen one with a chance below ``bloom_error_rate``. The filter is kept
+    in a file next to the database, and catches up with the links stored
+    since it was saved when loaded.
+    """
+
+    journal_mode = 'wal'
+    synchronous = 'normal'
+    cache_size = -16000 # KiB when negative, pages otherwise.
+    mmap_size = 256 * 2**20
+    busy_timeout = 30
+    write_batch_size = 1000
+    write_interval = 0.5
+    lru_size = 100000
+    url_query = 'keep'
+    url_ignore_params = ()
+    page_size = 1000
+    bloom = False
+    bloom_capacity = 1000000
+    bloom_error_rate = 1e-6
+
+    def __init__(self, parent, backend = 'file'):
         self.parent = parent
+        if isinstance(backend, str):
+            if backend not in BACKENDS:
+                raise ValueError(
+                    'backend must be one of: {}'.format(', '.join(BACKENDS)))
+            backend = BACKENDS[backend]()
+        self.backend = backend
+        self._synchronous = self.synchronous
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._reset_writer()
+        self._pending_lock = threading.Lock()
+        self._pending_scanned = set()
+        self._pending_four_o_fours = set()
+        self._seen_links = None
+        self._bloom_lock = threading.Lock()
+        self.filename_cache = LRUCache(self.lru_size)
+        self.four_o_four_cache = LRUCache(self.lru_size)
+        _open_dbs.add(self)
         self.create_name_mapper()
         self.create_links_mapper()
+        self.create_validators_mapper()
+        self.create_retries_mapper()
+        self.create_contents_mapper()
+        self.create_frontier()
+        self.migrate()
 
     def create_name_mapper(self):
         with self.connect() as con:
@@ -40,71 +278,481 @@ class DB():
                 ')'
             )
 
+    def create_validators_mapper(self):
+        """HTTP response validators of the archived version of each url, used
+        for conditional requests when fetching it again.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS validators('
+                'url VARCHAR(255) PRIMARY KEY,'
+                'etag VARCHAR(255),'
+                'last_modified VARCHAR(255),'
+                'content_length INT,'
+                'fetched_at REAL'
+                ')'
+            )
+
+    def create_retries_mapper(self):
+        """Urls whose fetch failed for a passing reason, and when to try them
+        again.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS retries('
+                'url VARCHAR(255) PRIMARY KEY,'
+                'attempts INT DEFAULT 0,'
+                'next_attempt REAL,'
+                'last_error VARCHAR(255)'
+                ')'
+            )
+
+    def create_contents_mapper(self):
+        """Content hash of every archived page, and the file holding each
+        distinct content. Urls with the same content share that file.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS page_hashes('
+                'url VARCHAR(255) PRIMARY KEY,'
+                'hash VARCHAR(64) NOT NULL'
+                ')'
+            )
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS contents('
+                'hash VARCHAR(64) PRIMARY KEY,'
+                'ID INTEGER NOT NULL'
+                ')'
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS page_hashes_hash '
+                'ON page_hashes(hash)')
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS contents_id ON contents(ID)')
+
+    def create_frontier(self):
+        """Urls to fetch, handed out in leased batches to worker processes.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS frontier('
+                'url VARCHAR(255) PRIMARY KEY,'
+                'priority INT DEFAULT 0,'
+                'worker VARCHAR(255),'
+                'lease_expires REAL,'
+                'done INT DEFAULT 0'
+                ')'
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS frontier_todo '
+                'ON frontier(done, priority)')
+
+    def migrate(self):
+        """Bring the schema up to date, once per database."""
+        with self.connect() as con:
+            cur = con.cursor()
+            # Only one process migrates, the others see the new version.
+            cur.execute('BEGIN IMMEDIATE')
+            version = cur.execute('PRAGMA user_version').fetchone()[0]
+            for number, statements in enumerate(
+                    MIGRATIONS[version:], version + 1):
+                logging.info('Migrating database to version %s', number)
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute('PRAGMA user_version = {}'.format(number))
+
     def connect(self):
-        return lite.connect(self.parent.fh.db)
+        """Return the connection of the current thread, opening it on first
+        use. It commits when used as a context manager, but stays open.
+
+        """
+        self._check_pid()
+        path = self.parent.fh.db
+        con = getattr(self._local, 'con', None)
+        if con is not None and self._local.path == path:
+            if con.synchronous != self._synchronous:
+                self._set_synchronous(con)
+            return con
+        con = self.backend.connect(path, self.busy_timeout)
+        if getattr(self.parent, 'metrics', None) is not None:
+            con.instrument(self.parent.metrics)
+        con.execute('PRAGMA journal_mode = {}'.format(self.journal_mode))
+        self._set_synchronous(con)
+        con.execute('PRAGMA cache_size = {}'.format(int(self.cache_size)))
+        con.execute('PRAGMA mmap_size = {}'.format(int(self.mmap_size)))
+        self._local.con = con
+        self._local.path = path
+        with self._connections_lock:
+            self._connections.add(con)
+        return con
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Connections and the writer are not shared with a forked process.
+            self._local = threading.local()
+            self._connections = weakref.WeakSet()
+            self._reset_writer()
+            self._pid = os.getpid()
+
+    def _reset_writer(self):
+        self._writes = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._write_error = None
+
+    def _write_behind(self, sql, args, many = False, pending = None):
+        """Queue a statement for the writer thread. With pending as
+        (set, url), url is in set until the statement is written.
+
+        """
+        self._check_pid()
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target = self._write_loop, name = 'db-writer',
+                    daemon = True)
+                self._writer.start()
+        if pending is not None:
+            with self._pending_lock:
+                pending[0].add(pending[1])
+        self._writes.put((sql, args, many, pending))
+
+    def _write_loop(self):
+        while True:
+            batch = []
+            item = self._writes.get()
+            deadline = time.monotonic() + self.write_interval
+            while item not in (_FLUSH, _STOP):
+                batch.append(item)
+                wait = deadline - time.monotonic()
+                if len(batch) >= self.write_batch_size or wait <= 0:
+                    item = None
+                    break
+                try:
+                    item = self._writes.get(timeout = wait)
+                except queue.Empty:
+                    item = None
+                    break
+            self._write_batch(batch)
+            for _ in range(len(batch) + (item is not None)):
+                self._writes.task_done()
+            if item is _STOP:
+                return
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            with self.connect() as con:
+                for sql, args, many, _ in batch:
+                    if many:
+                        con.executemany(sql, args)
+                    else:
+                        con.execute(sql, args)
+        except Exception as e: # pylint: disable=broad-except
+            logging.exception('Writing %s statements failed.', len(batch))
+            self._write_error = e
+        with self._pending_lock:
+            for _, _, _, pending in batch:
+                if pending is not None:
+                    pending[0].discard(pending[1])
+
+    def flush(self):
+        """Wait until the queued writes are committed."""
+        self._check_pid()
+        if self._writer is not None:
+            self._writes.put(_FLUSH)
+            self._writes.join()
+        error, self._write_error = self._write_error, None
+        if error is not None:
+            raise error
+
+    def _set_synchronous(self, con):
+        synchronous = self._synchronous
+        con.execute('PRAGMA synchronous = {}'.format(synchronous))
+        con.synchronous = synchronous
+
+    @contextmanager
+    def bulk_load(self, batch_size = 50000):
+        """Write in large transactions, which are not synced to disk, in the
+        with block. A crash of the computer during it (not of the program)
+        can leave the database corrupt.
+
+        """
+        self.flush()
+        previous = self._synchronous, self.write_batch_size
+        self._synchronous = 'off'
+        self.write_batch_size = batch_size
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._synchronous, self.write_batch_size = previous
+            with self.connect() as con:
+                # Sync what was written.
+                con.execute('PRAGMA wal_checkpoint')
+
+    def close(self):
+        """Flush the queued writes, and close the connections of all
+        threads. A database in memory is gone after.
+
+        """
+        try:
+            self.flush()
+            self._save_bloom()
+        finally:
+            with self._writer_lock:
+                writer, self._writer = self._writer, None
+            if writer is not None and self._pid == os.getpid():
+                self._writes.put(_STOP)
+                writer.join()
+            self._close_connections()
+            self.backend.close()
+
+    def _close_connections(self):
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for con in connections:
+            con.close()
+        self._local = threading.local()
 
     def drop_name_mapper(self):
         with self.connect() as con:
             cur = con.cursor()
-            cur.execute('DROP TABLE file_names')
+            cur.execute('DELETE FROM pages')
+            cur.execute('DELETE FROM sqlite_sequence WHERE name = "pages"')
 
     def clean(self):
         self.drop_name_mapper()
+        self.filename_cache.clear()
+        self.four_o_four_cache.clear()
 
     def set_filename(self, url):
         if not isinstance (url, str):
             raise TypeError
         with self.connect() as con:
             cur = con.cursor()
-            cur.execute('INSERT INTO file_names (url) VALUES (?)', (url,))
+            cur.execute('INSERT OR IGNORE INTO urls (url) VALUES (?)', (url,))
+            cur.execute(
+                'INSERT INTO pages (url_id) SELECT ID FROM urls WHERE url = ?',
+                (url,))
             filename = str(cur.lastrowid).zfill(6)
-            return filename
+        self.filename_cache.put(url, filename)
+        self.four_o_four_cache.put(url, False)
+        return filename
 
     def get_filepath(self, url):
         if not isinstance (url, str):
             raise TypeError
         fname = self.get_filename(url)
-        fpath = os.path.join(self.parent.fh.archive_folder, fname)
+        fpath = self.parent.fh.find_path(fname)
         if not os.path.isfile(fpath):
             raise OSError(('File {} does not exist.'.format(fname)))
         return fpath
 
+    def get_page(self, url):
+        """Return the archived contents of url."""
+        return self.parent.fh.read_page(self.get_filename(url))
+
     def get_filename(self, url):
+        """Return the name of the file holding the contents of url, which
+        is shared with other urls with the same contents.
+
+        """
+        if not isinstance (url, str):
+            raise TypeError
+        filename = self.filename_cache.get(url)
+        if filename is not None:
+            return filename
         with self.connect() as con:
-            if not isinstance (url, str):
-                raise TypeError
             cur = con.cursor()
-            cur.execute('SELECT id FROM file_names WHERE url=?', (url,))
+            cur.execute(
+                'SELECT COALESCE(contents.ID, pages.ID) FROM urls '
+                'JOIN pages ON pages.url_id = urls.ID '
+                'LEFT JOIN page_hashes ON urls.url = page_hashes.url '
+                'LEFT JOIN contents ON page_hashes.hash = contents.hash '
+                'WHERE urls.url=?', (url,))
             result = cur.fetchone()
             if result is None:
                 raise KeyError('File not registered for url: {}'.format(url))
             filename = str(result[0]).zfill(6)
-            return filename
+        self.filename_cache.put(url, filename)
+        return filename
 
-    def rm_filename(self, url):
+    def get_own_filename(self, url):
+        """Return the file name given to url, whether or not its contents
+        are stored under it.
+
+        """
         with self.connect() as con:
             if not isinstance (url, str):
                 raise TypeError
             cur = con.cursor()
-            cur.execute('DELETE FROM file_names WHERE url=?', (url,))
+            cur.execute('SELECT ID FROM pages WHERE url_id = ' + URL_ID, (url,))
+            result = cur.fetchone()
+            if result is None:
+                raise KeyError('File not registered for url: {}'.format(url))
+            return str(result[0]).zfill(6)
 
-    def get_unscanned(self):
+    def rm_filename(self, url):
         with self.connect() as con:
+            if not isinstance (url, str):
+                raise TypeError
             cur = con.cursor()
+            # Urls sharing the contents of url may now resolve to another
+            # file.
             cur.execute(
-                'SELECT file_names.url FROM file_names '
-                'JOIN links ON file_names.url = links.link '
-                'WHERE scanned = 0 AND four_o_four = 0 '
-                'AND links.url = "seed"'
-            )
-            return [_[0] for _ in cur.fetchall()]
+                'SELECT url FROM page_hashes WHERE hash = '
+                '(SELECT hash FROM page_hashes WHERE url = ?)', (url,))
+            stale = [_[0] for _ in cur.fetchall()]
+            cur.execute(
+                'DELETE FROM contents WHERE ID = '
+                '(SELECT ID FROM pages WHERE url_id = ' + URL_ID + ')', (url,))
+            cur.execute('DELETE FROM page_hashes WHERE url=?', (url,))
+            cur.execute('DELETE FROM pages WHERE url_id = ' + URL_ID, (url,))
+        for other in stale + [url]:
+            self.filename_cache.pop(other)
+        self.four_o_four_cache.pop(url)
 
-    def set_scanned(self, url):
+    def renew_filename(self, url):
+        """Give url a new file name, leaving its old file to the urls that
+        share it.
+
+        """
         with self.connect() as con:
             if not isinstance (url, str):
                 raise TypeError
             cur = con.cursor()
-            cur.execute('UPDATE file_names SET scanned = 1 WHERE url=?', (url,))
+            cur.execute(
+                'SELECT url_id, scanned, four_o_four FROM pages '
+                'WHERE url_id = ' + URL_ID, (url,))
+            result = cur.fetchone()
+            if result is None:
+                raise KeyError('File not registered for url: {}'.format(url))
+            cur.execute('DELETE FROM pages WHERE url_id = ?', result[:1])
+            cur.execute(
+                'INSERT INTO pages (url_id, scanned, four_o_four) '
+                'VALUES (?, ?, ?)', result)
+            filename = str(cur.lastrowid).zfill(6)
+        self.filename_cache.pop(url)
+        return filename
+
+    def add_content(self, url, digest, filename):
+        """Record that url has contents with hash digest, written to the
+        file filename unless the same contents are stored already.
+
+        Returns the name of the file holding the contents. If that is not
+        filename, the contents need not be written.
+        """
+        if not isinstance (url, str):
+            raise TypeError
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute('SELECT hash FROM page_hashes WHERE url=?', (url,))
+            old = cur.fetchone()
+            cur.execute(
+                'INSERT OR IGNORE INTO contents (hash, ID) VALUES (?, ?)',
+                (digest, int(filename)))
+            cur.execute('SELECT ID FROM contents WHERE hash=?', (digest,))
+            original = cur.fetchone()[0]
+            cur.execute(
+                'INSERT OR REPLACE INTO page_hashes (url, hash) VALUES (?, ?)',
+                (url, digest))
+            if old is not None and old[0] != digest:
+                # Forget the old contents, unless other urls still have them.
+                cur.execute(
+                    'DELETE FROM contents WHERE hash = ? AND NOT EXISTS '
+                    '(SELECT 1 FROM page_hashes WHERE hash = ?)',
+                    (old[0], old[0]))
+        original = str(original).zfill(6)
+        self.filename_cache.put(url, original)
+        return original
+
+    def get_content_hash(self, url):
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute('SELECT hash FROM page_hashes WHERE url=?', (url,))
+            result = cur.fetchone()
+            return None if result is None else result[0]
+
+    def is_shared(self, url):
+        """Whether other urls use the file holding the contents of url."""
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT COUNT(*) FROM page_hashes WHERE url != ? AND hash = '
+                '(SELECT hash FROM page_hashes WHERE url = ?)', (url, url))
+            return cur.fetchone()[0] > 0
+
+    def content_scanned(self, url):
+        """Whether the contents of url were scanned for links under another
+        url.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT page_hashes.url, pages.scanned FROM page_hashes '
+                'JOIN urls ON page_hashes.url = urls.url '
+                'JOIN pages ON pages.url_id = urls.ID '
+                'WHERE page_hashes.url != ? AND page_hashes.hash = '
+                '(SELECT hash FROM page_hashes WHERE url = ?)', (url, url))
+            others = cur.fetchall()
+        with self._pending_lock:
+            return any(
+                scanned or other in self._pending_scanned
+                for other, scanned in others)
+
+    def _paged(self, sql, args = (), page_size = None, after = -1):
+        """Yield the rows of sql, a page at a time, each in a query of its
+        own so no read stays open in between.
+
+        The first column of sql is a unique key it is ordered by, which is
+        left out of the rows. Its last parameters are the key to start
+        after ('key > ?') and the page size ('LIMIT ?').
+        """
+        if page_size is None: page_size = self.page_size
+        self.flush()
+        key = after
+        while True:
+            with self.connect() as con:
+                rows = con.execute(
+                    sql, tuple(args) + (key, page_size)).fetchall()
+            for row in rows:
+                yield row[1:]
+            if len(rows) < page_size:
+                return
+            key = rows[-1][0]
+
+    def iter_unscanned(self, page_size = None):
+        """Yield the seeds that have not been scanned for links."""
+        for url, in self._paged(
+                'SELECT edges.link_id, urls.url FROM edges '
+                'JOIN pages ON pages.url_id = edges.link_id '
+                'JOIN urls ON urls.ID = edges.link_id '
+                'WHERE scanned = 0 AND four_o_four = 0 '
+                'AND edges.url_id = ' + URL_ID + ' AND edges.link_id > ? '
+                'ORDER BY edges.link_id LIMIT ?', ('seed',), page_size):
+            yield url
+
+    def get_unscanned(self):
+        return list(self.iter_unscanned())
+
+    def set_scanned(self, url):
+        if not isinstance (url, str):
+            raise TypeError
+        self._write_behind(
+            'UPDATE pages SET scanned = 1 WHERE url_id = ' + URL_ID, (url,),
+            pending = (self._pending_scanned, url))
 
     def set_unscanned(self, url):
         """Tell the database that an url has not been scanned for links, e.g.:
@@ -114,43 +762,147 @@ class DB():
                 'http://politics.people.com.cn/GB/70731/review/20120323.html']:
             agent.db.set_unscanned(url)
         """
+        self.flush()
         with self.connect() as con:
             if not isinstance (url, str):
                 raise TypeError
             cur = con.cursor()
-            cur.execute('UPDATE file_names SET scanned = 0 WHERE url=?', (url,))
+            cur.execute(
+                'UPDATE pages SET scanned = 0 WHERE url_id = ' + URL_ID, (url,))
+
+    def canonical(self, url, base = None):
+        """Return the canonical form of url, relative to base."""
+        return canonical_url(
+            url, base, query = self.url_query,
+            ignore_params = self.url_ignore_params)
 
     def register_links(self, url, links):
+        if not isinstance (url, str):
+            raise TypeError
+        links = [self.canonical(link, url) for link in links]
+        # Links to the page itself, such as '#' or '#top'.
+        own = self.canonical(url)
+        links = [link for link in links if link != own]
+        if self.bloom:
+            links = self._see(links)
+        self._add_edges([(url, link) for link in links])
+
+    def bloom_path(self):
+        return self.parent.fh.db + '.bloom'
+
+    def _see(self, links):
+        """Add links to the Bloom filter, return the ones it had not seen."""
+        seen = self._get_bloom()
+        with self._bloom_lock:
+            return [link for link in links if seen.add(link)]
+
+    def _get_bloom(self):
+        with self._bloom_lock:
+            if self._seen_links is None:
+                self._seen_links = self._load_bloom()
+            return self._seen_links
+
+    def _load_bloom(self):
         with self.connect() as con:
-            if not isinstance (url, str):
-                raise TypeError
-            cur = con.cursor()
-            urls = len(links)*[url]
-            links = [link if not link.startswith('/')
-                     else 'http://'+url[7:].split('/')[0]+link
-                     for link in links]
-            cur.executemany(
-                'INSERT INTO links(url, link) VALUES (?, ?)',
-                zip(urls, links))
+            db_id = con.execute(
+                'SELECT value FROM meta WHERE key = "id"').fetchone()[0]
+        path = self.bloom_path()
+        bloom = None
+        if self.backend.persistent and os.path.isfile(path):
+            try:
+                bloom = ScalableBloomFilter.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.info('Cannot read Bloom filter: %s (%s)', path, e)
+            else:
+                if not isinstance(bloom.mark, dict) \
+                        or bloom.mark.get('db') != db_id:
+                    logging.info('Bloom filter of another database: %s', path)
+                    bloom = None
+        if bloom is None:
+            bloom = ScalableBloomFilter(
+                self.bloom_capacity, self.bloom_error_rate)
+            bloom.mark = {'db': db_id, 'rowid': 0}
+        self._catch_up(bloom)
+        logging.info('Bloom filter of links: %s', bloom.stats())
+        return bloom
+
+    def _catch_up(self, bloom):
+        """Add the links stored after the mark of bloom, and move the mark
+        to the last of them.
+
+        """
+        rowid = bloom.mark['rowid']
+        for rowid, link in self._paged(
+                'SELECT edges.rowid, edges.rowid, urls.url FROM edges '
+                'JOIN urls ON urls.ID = edges.link_id WHERE edges.rowid > ? '
+                'ORDER BY edges.rowid LIMIT ?', after = rowid):
+            bloom.add(link)
+        bloom.mark['rowid'] = rowid
+
+    def _save_bloom(self):
+        with self._bloom_lock:
+            bloom = self._seen_links
+            if bloom is None or not self.backend.persistent:
+                return
+            # Other processes may have stored links the filter has not seen,
+            # so the mark cannot simply move to the last edge.
+            self._catch_up(bloom)
+            bloom.save(self.bloom_path())
+            logging.info('Saved Bloom filter of links: %s', bloom.stats())
+            self._seen_links = None
+
+    def bloom_stats(self):
+        """Number of links, filters, bytes and the current error rate of the
+        Bloom filter, or None without one.
+
+        """
+        if not self.bloom:
+            return None
+        seen = self._get_bloom()
+        with self._bloom_lock:
+            return seen.stats()
+
+    def _add_edges(self, edges):
+        """Queue links between pairs of urls."""
+        self._write_behind(
+            'INSERT OR IGNORE INTO urls (url) VALUES (?)',
+            # In order, so ids follow the order urls are found in.
+            [(url,) for url in dict.fromkeys(
+                url for edge in edges for url in edge)],
+            many = True)
+        self._write_behind(
+            'INSERT INTO edges (url_id, link_id) '
+            'VALUES (' + URL_ID + ', ' + URL_ID + ')', edges, many = True)
+
+    def iter_all_links(self, page_size = None):
+        for link, in self._paged(
+                'SELECT edges.rowid, urls.url FROM edges '
+                'JOIN urls ON urls.ID = edges.link_id WHERE edges.rowid > ? '
+                'ORDER BY edges.rowid LIMIT ?', (), page_size):
+            yield link
 
     def get_all_links(self):
-        with self.connect() as con:
-            cur = con.cursor()
-            return cur.execute('SELECT link FROM links').fetchall()
+        return [(link,) for link in self.iter_all_links()]
 
     def get_four_o_fours(self):
+        self.flush()
         with self.connect() as con:
             cur = con.cursor()
             res = cur.execute(
-                'SELECT url FROM file_names WHERE four_o_four = 1')
+                'SELECT urls.url FROM pages JOIN urls ON urls.ID = pages.url_id '
+                'WHERE four_o_four = 1')
             return [_[0] for _ in res.fetchall()]
 
     def set_four_o_four(self, url):
-        with self.connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                'INSERT INTO file_names (url, four_o_four) VALUES (?, 1)',
-                (url,))
+        if not isinstance (url, str):
+            raise TypeError
+        self.four_o_four_cache.put(url, True)
+        self._write_behind('INSERT OR IGNORE INTO urls (url) VALUES (?)', (url,))
+        self._write_behind(
+            'INSERT INTO pages (url_id, four_o_four) '
+            'SELECT ID, 1 FROM urls WHERE url = ? '
+            'ON CONFLICT(url_id) DO UPDATE SET four_o_four = 1',
+            (url,), pending = (self._pending_four_o_fours, url))
 
     def update_fetched(self, url, revert = False):
         fetched = 1-int(revert)
@@ -158,69 +910,279 @@ class DB():
         #with self.connect() as con:
         #    cur = con.cursor()
         #    cur.execute('UPDATE links SET fetched = ? WHERE url = "seed"', (fetched, url))
+        self._write_behind(
+            'UPDATE edges SET fetched = ? WHERE link_id = ' + URL_ID,
+            (fetched, url))
+
+    def is_four_o_four(self, url):
+        four_o_four = self.four_o_four_cache.get(url)
+        if four_o_four is not None:
+            return four_o_four
+        with self._pending_lock:
+            if url in self._pending_four_o_fours:
+                return True
         with self.connect() as con:
             cur = con.cursor()
-            cur.execute('UPDATE links SET fetched = ? WHERE link = ?', (fetched, url))
+            cur.execute(
+                'SELECT four_o_four FROM pages WHERE url_id = ' + URL_ID, (url,))
+            res = cur.fetchone()
+        if res is None:
+            # Not fetched yet, it may still be.
+            return False
+        four_o_four = bool(res[0])
+        self.four_o_four_cache.put(url, four_o_four)
+        return four_o_four
 
-    def is_four_o_four(self, url):
+    def cache_stats(self):
+        """Hits and misses of the url caches."""
+        return {
+            'filenames': self.filename_cache.stats(),
+            'four_o_fours': self.four_o_four_cache.stats()}
+
+    def seed_archive(self, urls):
+        urls = [self.canonical(url) for url in urls]
+        if self.bloom:
+            self._see(urls)
+        with self.bulk_load():
+            self._add_edges([('seed', url) for url in urls])
+
+    def set_validators(
+            self, url, etag = None, last_modified = None,
+            content_length = None):
+        if not isinstance (url, str):
+            raise TypeError
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'INSERT OR REPLACE INTO validators '
+                '(url, etag, last_modified, content_length, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, etag, last_modified, content_length, time.time()))
+
+    def get_validators(self, url):
+        if not isinstance (url, str):
+            raise TypeError
         with self.connect() as con:
             cur = con.cursor()
-            cur.execute('SELECT four_o_four FROM file_names WHERE url = ?', (url,))
+            cur.execute(
+                'SELECT etag, last_modified, content_length, fetched_at '
+                'FROM validators WHERE url = ?', (url,))
             res = cur.fetchone()
             if res is None:
-                return False
-            return bool(res[0])
+                return None
+            return dict(zip(
+                ('etag', 'last_modified', 'content_length', 'fetched_at'),
+                res))
 
-    def seed_archive(self, urls):
+    def schedule_retry(self, url, error, delay = 30, max_delay = 6 * 3600):
+        """Count a failed attempt at fetching url. The next attempt is due
+        after a delay that doubles with every failure.
+
+        """
+        if not isinstance (url, str):
+            raise TypeError
         with self.connect() as con:
             cur = con.cursor()
+            cur.execute('SELECT attempts FROM retries WHERE url = ?', (url,))
+            res = cur.fetchone()
+            attempts = 1 if res is None else res[0] + 1
+            next_attempt = time.time() + min(
+                max_delay, delay * 2 ** (attempts - 1))
+            cur.execute(
+                'INSERT OR REPLACE INTO retries '
+                '(url, attempts, next_attempt, last_error) '
+                'VALUES (?, ?, ?, ?)',
+                (url, attempts, next_attempt, error))
+            return attempts
+
+    def get_retry(self, url):
+        """Return (attempts, next_attempt) for url, or None if it has not
+        failed.
+
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT attempts, next_attempt FROM retries WHERE url = ?',
+                (url,))
+            return cur.fetchone()
+
+    def clear_retry(self, url):
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute('DELETE FROM retries WHERE url = ?', (url,))
+
+    def get_due_retries(self, max_attempts):
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT url FROM retries '
+                'WHERE attempts < ? AND next_attempt <= ?',
+                (max_attempts, time.time()))
+            return [_[0] for _ in cur.fetchall()]
+
+    def get_next_retry(self, max_attempts):
+        """Return when the next failed url is due, or None."""
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT MIN(next_attempt) FROM retries WHERE attempts < ?',
+                (max_attempts,))
+            return cur.fetchone()[0]
+
+    def add_to_frontier(self, urls, priority = 0):
+        """Add urls to the frontier, or put them back if they were done."""
+        urls = iter(urls)
+        while True:
+            batch = list(itertools.islice(urls, self.page_size))
+            if not batch:
+                return
+            self._add_to_frontier(batch, priority)
+
+    def _add_to_frontier(self, urls, priority):
+        urls = [(url,) for url in urls]
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.executemany(
+                'INSERT OR IGNORE INTO frontier (url, priority) VALUES (?, ?)',
+                [(url, priority) for (url,) in urls])
             cur.executemany(
-                'INSERT INTO links (url, link) VALUES (?, ?)',
-                zip(len(urls)*['seed'], urls))
+                'UPDATE frontier SET done = 0, worker = NULL, '
+                'lease_expires = NULL WHERE done = 1 AND url = ?', urls)
 
-    def get_unfetched_seeds(self):
+    def claim_urls(self, worker, batch_size = 100, lease = 600):
+        """Lease up to batch_size urls to worker for lease seconds. Urls
+        leased to no one, or whose lease has expired, are handed out by
+        priority.
+
+        """
+        if not isinstance (worker, str):
+            raise TypeError
+        now = time.time()
         with self.connect() as con:
             cur = con.cursor()
+            # Take the write lock before reading, so no other worker can
+            # claim the same urls in between.
+            cur.execute('BEGIN IMMEDIATE')
             cur.execute(
-                'SELECT link FROM links WHERE fetched = 0 AND url = "seed"')
-            links = {_[0] for _ in cur.fetchall()}
-            logging.info(
-                'Number of unique links to fetch (archives): %s',
-                len(links))
-            return links
+                'SELECT url FROM frontier WHERE done = 0 '
+                'AND (lease_expires IS NULL OR lease_expires < ?) '
+                'ORDER BY priority DESC LIMIT ?', (now, batch_size))
+            urls = [_[0] for _ in cur.fetchall()]
+            cur.executemany(
+                'UPDATE frontier SET worker = ?, lease_expires = ? '
+                'WHERE url = ?',
+                [(worker, now + lease, url) for url in urls])
+            return urls
 
-    def get_unfetched_links(self):
+    def renew_leases(self, worker, lease = 600):
         with self.connect() as con:
             cur = con.cursor()
             cur.execute(
-                'SELECT url, link FROM links '
-                'WHERE fetched = 0 AND url != "seed"'
-            )
-            links = {link if not link.startswith('/')
-                     else 'http://'+url[7:].split('/')[0]+link
-                     for url, link in cur.fetchall()}
-            logging.info(
-                'Number of unique links to fetch (articles): %s',
-                len(links))
-            return links
+                'UPDATE frontier SET lease_expires = ? '
+                'WHERE worker = ? AND done = 0', (time.time() + lease, worker))
 
-    def get_fetched_articles(self):
+    def complete_urls(self, worker, urls):
+        """Mark urls done, if worker still holds their lease."""
         with self.connect() as con:
             cur = con.cursor()
-            #cur.execute(
-            #    'SELECT file_names.url FROM file_names JOIN links '
-            #    'ON file_names.url = links.link ')
-            #print (cur.fetchall())
+            cur.executemany(
+                'UPDATE frontier SET done = 1, lease_expires = NULL '
+                'WHERE url = ? AND worker = ?',
+                [(url, worker) for url in urls])
 
-            #cur.execute('SELECT file_names.url FROM file_names')
-            #print (cur.fetchall())
+    def defer_urls(self, worker, urls):
+        """Hand back urls, as (url, time) pairs, that worker holds the lease
+        of, to be claimed again from time on.
 
-            #cur.execute('SELECT link FROM links')
-            #print (cur.fetchall())
+        """
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.executemany(
+                'UPDATE frontier SET worker = NULL, lease_expires = ? '
+                'WHERE url = ? AND worker = ? AND done = 0',
+                [(when, url, worker) for url, when in urls])
 
+    def get_next_deferred(self):
+        """Return when the next deferred url can be claimed, or None."""
+        with self.connect() as con:
+            cur = con.cursor()
             cur.execute(
-                'SELECT file_names.url FROM file_names JOIN links '
-                'ON file_names.url = links.link WHERE links.url != "seed" '
-                'AND four_o_four = 0'
-            )
-            return [_[0] for _ in cur.fetchall()]
+                'SELECT MIN(lease_expires) FROM frontier '
+                'WHERE done = 0 AND worker IS NULL')
+            return cur.fetchone()[0]
+
+    def release_urls(self, worker):
+        """Hand back the urls leased to worker that are not done."""
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'UPDATE frontier SET worker = NULL, lease_expires = NULL '
+                'WHERE worker = ? AND done = 0', (worker,))
+
+    def get_frontier_size(self):
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute('SELECT COUNT(*) FROM frontier WHERE done = 0')
+            return cur.fetchone()[0]
+
+    def get_seeds(self):
+        self.flush()
+        with self.connect() as con:
+            cur = con.cursor()
+            cur.execute(
+                'SELECT urls.url FROM edges JOIN urls ON urls.ID = edges.link_id '
+                'WHERE edges.url_id = ' + URL_ID, ('seed',))
+            return {_[0] for _ in cur.fetchall()}
+
+    def iter_unfetched_seeds(self, page_size = None):
+        for link, in self._paged(
+                'SELECT edges.link_id, urls.url FROM edges '
+                'JOIN urls ON urls.ID = edges.link_id '
+                'WHERE fetched = 0 AND edges.url_id = ' + URL_ID + ' '
+                'AND edges.link_id > ? ORDER BY edges.link_id LIMIT ?',
+                ('seed',), page_size):
+            yield link
+
+    def get_unfetched_seeds(self):
+        links = set(self.iter_unfetched_seeds())
+        logging.info(
+            'Number of unique links to fetch (archives): %s',
+            len(links))
+        return links
+
+    def iter_unfetched_links(self, page_size = None):
+        """Yield every link not fetched yet, once, except seeds."""
+        for url, link in self._paged(
+                'SELECT edges.link_id, source.url, target.url FROM edges '
+                'JOIN urls AS source ON source.ID = edges.url_id '
+                'JOIN urls AS target ON target.ID = edges.link_id '
+                'WHERE fetched = 0 AND edges.url_id IS NOT ' + URL_ID + ' '
+                'AND edges.link_id > ? GROUP BY edges.link_id '
+                'ORDER BY edges.link_id LIMIT ?', ('seed',), page_size):
+            # Links stored before they were made canonical may be relative.
+            if link.startswith('/'):
+                link = self.canonical(link, url)
+            yield link
+
+    def get_unfetched_links(self):
+        links = set(self.iter_unfetched_links())
+        logging.info(
+            'Number of unique links to fetch (articles): %s',
+            len(links))
+        return links
+
+    def iter_fetched_articles(self, page_size = None):
+        """Yield every page found by a link, once, except seeds and 404s."""
+        for url, in self._paged(
+                'SELECT edges.link_id, urls.url FROM edges '
+                'JOIN pages ON pages.url_id = edges.link_id '
+                'JOIN urls ON urls.ID = edges.link_id '
+                'WHERE edges.url_id IS NOT ' + URL_ID + ' '
+                'AND four_o_four = 0 AND edges.link_id > ? '
+                'GROUP BY edges.link_id ORDER BY edges.link_id LIMIT ?',
+                ('seed',), page_size):
+            yield url
+
+    def get_fetched_articles(self):
+        return list(self.iter_fetched_articles())
@@ -2,24 +2,42 @@
 
 """
 
+from contextlib import contextmanager
 from glob import glob
+import gzip
 import logging
 import os
 import shutil
+import tempfile
+import threading
+import uuid
+
+from archiver.segment_store import SegmentStore
 
 # pylint: disable=missing-docstring
 
+class DiscardPage(Exception):
+    """Raise inside FileHander.open_page to drop what was written."""
+
 class FileHander():
 
     _directory = None
     _archive_folder = None
     _db = None
+    _storage = None
+    _segments = None
+    _layout = None
 
-    def __init__(self, parent, directory, archive_folder, db):
+    def __init__(
+            self, parent, directory, archive_folder, db, storage = None,
+            layout = 'sharded'):
         self.parent = parent
+        self._segments_lock = threading.Lock()
         self.directory = directory
         self.archive_folder = archive_folder
         self.db = db
+        self.storage = storage
+        self.layout = layout
 
     @property
     def directory(self):
@@ -65,6 +83,160 @@ class FileHander():
         db = os.path.join(self.directory, db)
         self._db = db
 
+    @property
+    def storage(self):
+        """How pages are stored: 'files', one file per page, or 'segments',
+        packed into a SegmentStore in the archive folder."""
+        if self._storage is not None:
+            return self._storage
+        if (self.archive_folder is not None and
+                os.path.isfile(os.path.join(self.archive_folder, 'index'))):
+            return 'segments'
+        return 'files'
+
+    @storage.setter
+    def storage(self, storage):
+        if storage not in (None, 'files', 'segments'):
+            raise ValueError(
+                'storage must be "files" or "segments", not "{}"'.format(
+                    storage))
+        self._storage = storage
+
+    @property
+    def layout(self):
+        """Where page files go: 'flat', all in the archive folder, or
+        'sharded', in two levels of subfolders named after the last four
+        digits of the file name (000123 -> 23/01/000123)."""
+        return self._layout
+
+    @layout.setter
+    def layout(self, layout):
+        if layout not in ('flat', 'sharded'):
+            raise ValueError(
+                'layout must be "flat" or "sharded", not "{}"'.format(layout))
+        self._layout = layout
+
+    @staticmethod
+    def shard_path(folder, fname):
+        return os.path.join(folder, fname[-2:], fname[-4:-2], fname)
+
+    @staticmethod
+    def find_page_file(folder, fname):
+        """Return the path of the file for fname in folder, sharded or
+        flat.
+
+        """
+        fpath = FileHander.shard_path(folder, fname)
+        if os.path.isfile(fpath):
+            return fpath
+        return os.path.join(folder, fname)
+
+    def get_path(self, fname):
+        """Where the file for fname goes."""
+        if self.layout == 'sharded':
+            return self.shard_path(self.archive_folder, fname)
+        return os.path.join(self.archive_folder, fname)
+
+    def find_path(self, fname):
+        """Where the file for fname is, falling back on the other layout
+        for archives that have not been moved over."""
+        fpath = self.get_path(fname)
+        if os.path.isfile(fpath):
+            return fpath
+        if self.layout == 'sharded':
+            return os.path.join(self.archive_folder, fname)
+        return self.shard_path(self.archive_folder, fname)
+
+    def page_files(self):
+        """Yield (file name, path) for the page files in the archive
+        folder, in either layout.
+
+        """
+        for entry in os.scandir(self.archive_folder):
+            if entry.name.isdigit() and entry.is_file():
+                yield entry.name, entry.path
+            elif len(entry.name) == 2 and entry.is_dir():
+                for sub in os.scandir(entry.path):
+                    if not sub.is_dir():
+                        continue
+                    for page in os.scandir(sub.path):
+                        if page.name.isdigit():
+                            yield page.name, page.path
+
+    def shard(self):
+        """Move the files of a flat archive into shards."""
+        moved = 0
+        for fname, fpath in list(self.page_files()):
+            target = self.shard_path(self.archive_folder, fname)
+            if fpath != target:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(fpath, target)
+                moved += 1
+        logging.info('Moved %s files into shards.', moved)
+        self.layout = 'sharded'
+
+    @property
+    def segments(self):
+        """_"""
+        with self._segments_lock:
+            if (self._segments is None or
+                    self._segments.folder != self.archive_folder):
+                if self._segments is not None:
+                    self._segments.close()
+                self._segments = SegmentStore(self.archive_folder)
+            return self._segments
+
+    def read_page(self, fname):
+        """Return the contents of a page in the archive."""
+        if self.storage == 'segments':
+            try:
+                return self.gunzip(self.segments.get(int(fname)))
+            except KeyError:
+                raise FileNotFoundError(
+                    'File {} does not exist.'.format(fname))
+        return self.read_file(self.find_path(fname))
+
+    @contextmanager
+    def open_page(self, fname):
+        """Open a page in the archive for writing. It is stored once the
+        file object is closed without errors, or dropped on DiscardPage.
+
+        """
+        try:
+            if self.storage == 'segments':
+                with tempfile.TemporaryFile(dir = self.archive_folder) as fobj:
+                    yield fobj
+                    fobj.seek(0)
+                    self.segments.put(int(fname), fobj)
+            else:
+                fpath = self.get_path(fname)
+                os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                with self.open_atomic(fpath) as fobj:
+                    yield fobj
+        except DiscardPage:
+            pass
+
+    def delete_page(self, fname):
+        if self.storage == 'segments':
+            self.segments.delete(int(fname))
+        else:
+            self.delete_file(self.find_path(fname))
+
+    def pack(self):
+        """Move all files of a one-file-per-page archive into segments."""
+        files = sorted(self.page_files())
+        logging.info('Packing %s files into segments...', len(files))
+        for name, fpath in files:
+            with open(fpath, 'rb') as fobj:
+                self.segments.put(int(name), fobj)
+            os.remove(fpath)
+        self.storage = 'segments'
+
+    def close(self):
+        if self._segments is not None:
+            self._segments.close()
+            self._segments = None
+
     @staticmethod
     def delete_file(target):
         """_"""
@@ -74,20 +246,63 @@ class FileHander():
         except FileNotFoundError:
             logging.info('Does not exist: ' + target)
 
+    @staticmethod
+    def read_file(target):
+        """Return the contents of an archived file, unzipped if it was
+        stored gzipped.
+
+        """
+        with open(target, 'rb') as fobj:
+            return FileHander.gunzip(fobj.read())
+
+    @staticmethod
+    def gunzip(data):
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return data
+
+    @staticmethod
+    @contextmanager
+    def open_atomic(target):
+        """Open a temporary file for writing, which replaces target once it
+        is complete and on disk. Target is left alone if writing fails.
+
+        """
+        folder, name = os.path.split(target)
+        temp = os.path.join(
+            folder, '.{}.{}.part'.format(name, uuid.uuid4().hex))
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                yield fobj
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.replace(temp, target)
+        except BaseException:
+            FileHander.delete_file(temp)
+            raise
+
     def clean(self):
         """_"""
         if not input('You sure you want to delete everything? (Yes/no)\n >') == 'Yes':
             print ('Bye')
             exit()
         logging.info('Cleaning...')
+        self.close()
         self.delete_file(target = self.db)
         # clean archive
-        for f in glob(os.path.join(self.archive_folder, '*')):
-            logging.info('Deleting (archive): %s', f)
-            os.remove(f)
+        for entry in os.scandir(self.archive_folder):
+            logging.info('Deleting (archive): %s', entry.path)
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
         # remove subfolders
         for f in glob(os.path.join(self.directory, '*')):
-            logging.info('Deleting: (dir): %s', f)
-            shutil.rmtree(f)
+            if os.path.isdir(f):
+                logging.info('Deleting: (dir): %s', f)
+                shutil.rmtree(f)
+            else:
+                self.delete_file(target = f)
         self.directory = self.directory
         self._archive_folder =  None
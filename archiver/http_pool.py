@@ -0,0 +1,332 @@
+""" Pooled keep-alive HTTP connections.
+
+"""
+
+import http.client
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+
+from collections import defaultdict, deque
+from socket import timeout
+from urllib.parse import urljoin, urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# pylint: disable=missing-docstring
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+ACCEPT_ENCODING = 'gzip, deflate' + (', br' if brotli is not None else '')
+
+# Errors of the decompressors on data that is corrupt or not compressed.
+CODEC_ERRORS = (zlib.error,) + ((brotli.error,) if brotli is not None else ())
+
+class DecodeError(Exception):
+    """A body does not have the Content-Encoding it was sent with."""
+
+class Decoder():
+    """Undo a Content-Encoding, a piece of the body at a time. Raises
+    DecodeError on data that cannot be decoded.
+
+    """
+
+    def __init__(self, encoding = None):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._obj = None # zlib wrapped or raw, see first bytes.
+        elif encoding == 'br' and brotli is not None:
+            self._obj = brotli.Decompressor()
+        elif encoding == 'identity':
+            self._obj = False
+        else:
+            raise ValueError('Unsupported encoding: {}'.format(encoding))
+        self.encoding = encoding
+
+    def decode(self, data):
+        if self._obj is False or not data:
+            return data
+        try:
+            return self._decode(data)
+        except CODEC_ERRORS as e:
+            raise DecodeError(
+                'Cannot decode {} data: {}'.format(self.encoding, e)) from e
+
+    def _decode(self, data):
+        if self._obj is None:
+            # Some servers send raw deflate data without the zlib header.
+            try:
+                self._obj = zlib.decompressobj()
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.encoding == 'br':
+            return self._obj.process(data)
+        return self._obj.decompress(data)
+
+    def flush(self):
+        if self._obj in (None, False) or self.encoding == 'br':
+            return b''
+        try:
+            return self._obj.flush()
+        except CODEC_ERRORS as e:
+            raise DecodeError(
+                'Cannot decode {} data: {}'.format(self.encoding, e)) from e
+
+class DNSCache():
+    """Remember resolved addresses for a while, instead of asking the
+    resolver once per connection.
+
+    """
+
+    def __init__(self, ttl = 300):
+        self.ttl = ttl
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._addresses.get((host, port))
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        addresses = []
+        for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+            if info[4][:2] not in addresses:
+                addresses.append(info[4][:2])
+        with self._lock:
+            self._addresses[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self._lock:
+            self._addresses.pop((host, port), None)
+
+class _CachedDNSMixin():
+
+    dns = None
+    idle_since = None
+
+    def _open_socket(self):
+        error = None
+        for address in self.dns.resolve(self.host, self.port):
+            try:
+                sock = socket.create_connection(address, self.timeout)
+            except OSError as e:
+                error = e
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        # The cached addresses may be stale, resolve again next time.
+        self.dns.forget(self.host, self.port)
+        if error is None:
+            error = OSError('No address for host: {}'.format(self.host))
+        raise error
+
+class HTTPConnection(_CachedDNSMixin, http.client.HTTPConnection):
+
+    def connect(self):
+        self.sock = self._open_socket()
+
+class HTTPSConnection(_CachedDNSMixin, http.client.HTTPSConnection):
+
+    def connect(self):
+        self.sock = self._context.wrap_socket(
+            self._open_socket(), server_hostname = self.host)
+
+class PooledResponse():
+    """A response whose connection goes back to the pool when closed.
+
+    """
+
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+
+    @property
+    def status(self):
+        return self.response.status
+
+    @property
+    def reason(self):
+        return self.response.reason
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    def getheader(self, name, default = None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt = None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, connection)
+        else:
+            # Unread body or "Connection: close", cannot be reused.
+            self.response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class HTTPPool():
+    """HTTP/1.1 client keeping at most ``maxsize`` idle connections per host
+    open, for up to ``idle_timeout`` seconds.
+
+    Errors are raised like ``urllib.request.urlopen`` does: HTTPError for
+    status codes from 400 and up, URLError when no request could be made.
+    Other statuses (e.g. 304) are returned to the caller.
+    """
+
+    def __init__(
+            self, maxsize = 8, idle_timeout = 30, timeout = 60,
+            dns_ttl = 300, max_redirects = 10, headers = None):
+        if not isinstance(maxsize, int) or maxsize < 0:
+            raise ValueError('maxsize must be a non-negative integer.')
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.dns = DNSCache(ttl = dns_ttl)
+        self.headers = {
+            'User-Agent': 'Python-urllib/' + urllib.request.__version__}
+        if headers is not None:
+            self.headers.update(headers)
+        self._idle = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def urlopen(self, url, headers = None, method = 'GET'):
+        if not isinstance(url, str):
+            raise TypeError('url must be a string.')
+        for _ in range(self.max_redirects + 1):
+            response = self.request(method, url, headers)
+            location = response.getheader('Location')
+            if response.status in REDIRECTS and location:
+                response.read()
+                response.close()
+                url = urljoin(url, location)
+                if response.status == 303: method = 'GET'
+                continue
+            if response.status >= 400:
+                response.read()
+                response.close()
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason,
+                    response.headers, None)
+            return response
+        raise urllib.error.HTTPError(
+            url, response.status, 'Too many redirects', response.headers, None)
+
+    def request(self, method, url, headers = None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise urllib.error.URLError('Unsupported url: {}'.format(url))
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname.lower(), parts.port or default_port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = dict(self.headers)
+        if headers is not None:
+            request_headers.update(headers)
+        for attempt in range(2):
+            connection, reused = self.get(key)
+            try:
+                connection.request(method, path, headers = request_headers)
+                response = connection.getresponse()
+            except timeout:
+                connection.close()
+                raise
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                connection.close()
+                # The server may have dropped an idle keep-alive connection.
+                if reused and attempt == 0:
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            return PooledResponse(self, key, connection, response, url)
+
+    def get(self, key):
+        """Return an idle connection for (scheme, host, port), or a new one,
+        and whether it was reused.
+
+        """
+        now = time.monotonic()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.idle_since < self.idle_timeout:
+                    connection = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if connection is not None:
+            return connection, True
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = HTTPSConnection(host, port, timeout = self.timeout)
+        else:
+            connection = HTTPConnection(host, port, timeout = self.timeout)
+        connection.dns = self.dns
+        return connection, False
+
+    def put(self, key, connection):
+        connection.idle_since = time.monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def evict_idle(self):
+        """Close connections that have been idle for too long."""
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in list(idle):
+                    if now - connection.idle_since >= self.idle_timeout:
+                        idle.remove(connection)
+                        stale.append(connection)
+        for connection in stale:
+            connection.close()
+
+    def idle_count(self, key = None):
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key, ()))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close(self):
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
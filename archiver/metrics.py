@@ -0,0 +1,286 @@
+""" Crawl metrics.
+
+Counters and histograms kept in memory, written out in the Prometheus text
+format and summed up in a log line now and then.
+
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from archiver.file_handler import FileHander
+
+# pylint: disable=missing-docstring
+
+# Upper bounds of the buckets of a histogram of durations, in seconds.
+SECONDS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10, 30, 60)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _label_value(v))
+                          for n, v in zip(names, values)) + '}'
+
+class Counter():
+    """Number that only goes up, one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels = ()):
+        if not isinstance(name, str):
+            raise TypeError('name must be a string.')
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('{} needs labels {}, got {}'.format(
+                self.name, self.labels, tuple(labels)))
+        try:
+            return tuple(str(labels[n]) for n in self.labels)
+        except KeyError:
+            raise ValueError('{} needs labels {}, got {}'.format(
+                self.name, self.labels, tuple(labels)))
+
+    def inc(self, amount = 1, **labels):
+        if amount < 0:
+            raise ValueError('A counter cannot go down.')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Value for the labels given, summed over the others."""
+        with self._lock:
+            items = list(self._values.items())
+        return sum(v for key, v in items if all(
+            key[self.labels.index(n)] == str(labels[n]) for n in labels))
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, _labels(self.labels, key), value
+
+class Gauge(Counter):
+    """Number that goes up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram():
+    """Count of observed values by bucket, with their sum, one per
+    combination of label values.
+
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels = (), buckets = SECONDS):
+        if not isinstance(name, str):
+            raise TypeError('name must be a string.')
+        if list(buckets) != sorted(buckets):
+            raise ValueError('Buckets must be in increasing order.')
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Label values -> [counts per bucket and +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    _key = Counter._key
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the with block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        return sum(sum(counts) for counts, _ in self._select(labels))
+
+    def sum(self, **labels):
+        return sum(total for _, total in self._select(labels))
+
+    def _select(self, labels):
+        with self._lock:
+            items = [(k, (list(c), s)) for k, (c, s) in self._values.items()]
+        return [v for key, v in items if all(
+            key[self.labels.index(n)] == str(labels[n]) for n in labels)]
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (k, (list(c), s)) for k, (c, s) in self._values.items())
+        names = self.labels + ('le',)
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       _labels(names, key + (_number(bound),)), cumulative)
+            yield self.name + '_sum', _labels(self.labels, key), total
+            yield self.name + '_count', _labels(self.labels, key), cumulative
+
+class Metrics():
+    """Registry of the metrics of a crawl.
+
+    Asking for a metric by a name in use returns the one registered.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._reporter = None
+        self._stop = threading.Event()
+        self._last = None
+        self._path = None
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(
+                    name, help_text, labels, **kwargs)
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError(
+                    'Metric {} is registered otherwise.'.format(name))
+        return metric
+
+    def counter(self, name, help_text, labels = ()):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels = ()):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels = (), buckets = SECONDS):
+        return self._get(
+            Histogram, name, help_text, labels, buckets = buckets)
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append('# HELP {} {}'.format(
+                name, metric.help.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(sample, labels, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write render() to path, replacing it at once, e.g. for the
+        textfile collector of the node exporter.
+
+        """
+        with FileHander.open_atomic(path) as fobj:
+            fobj.write(self.render().encode())
+
+    def summary(self):
+        """One line with the total of each metric, and for counters their
+        rate since the last summary.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        last_time, last = self._last or (None, {})
+        totals = {}
+        parts = []
+        for name, metric in metrics:
+            if isinstance(metric, Histogram):
+                count = metric.count()
+                if count:
+                    parts.append('{} {} (avg {:.4g})'.format(
+                        name, count, metric.sum() / count))
+                continue
+            total = totals[name] = metric.value()
+            if not total:
+                continue
+            if metric.kind == 'counter' and last_time is not None:
+                parts.append('{} {} ({:.4g}/s)'.format(
+                    name, _number(total),
+                    (total - last.get(name, 0)) / max(now - last_time, 1e-9)))
+            else:
+                parts.append('{} {}'.format(name, _number(total)))
+        self._last = now, totals
+        return ', '.join(parts)
+
+    def start_reporter(self, interval = 60, path = None):
+        """Log summary() every ``interval`` seconds from a thread, and write
+        the metrics to path if given, until stop_reporter().
+
+        """
+        if self._reporter is not None:
+            return
+        self._stop.clear()
+        self._path = path
+        self.summary()
+
+        def report():
+            while not self._stop.wait(interval):
+                self.report(path)
+
+        self._reporter = threading.Thread(
+            target = report, name = 'metrics-reporter', daemon = True)
+        self._reporter.start()
+
+    def report(self, path = None):
+        logging.info('Metrics: %s', self.summary())
+        if path is not None:
+            try:
+                self.write(path)
+            except OSError as e:
+                logging.info('Cannot write metrics to %s: %s', path, e)
+
+    def stop_reporter(self):
+        """Stop the reporter, after a last report."""
+        if self._reporter is None:
+            return
+        self._stop.set()
+        self._reporter.join()
+        self._reporter = None
+        self.report(self._path)
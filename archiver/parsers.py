@@ -0,0 +1,282 @@
+""" Reading links, text and meta tags out of pages.
+
+A parser takes the bytes of a page. SoupParser reads them with the
+html.parser of the standard library: links in one pass with LinkExtractor,
+text and meta tags through BeautifulSoup. LxmlParser, used
+when lxml is installed, parses them with libxml2 at many times the speed.
+The bytes are decoded as BeautifulSoup would, what BeautifulSoup leaves
+out of a page's text is left out here too, and its strings of whitespace
+are shortened the same way. libxml2 and html.parser still read some markup
+differently, and LxmlParser leaves such pages to SoupParser:
+
+- CDATA sections, which html.parser keeps as text;
+- tags with an attribute given twice, where html.parser keeps the last
+  value and libxml2 the first;
+- tags inside title, textarea and the like, which libxml2 takes for text;
+- carriage returns without a line feed, which libxml2 makes line feeds.
+
+"""
+
+import re
+
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup as bs
+from bs4 import UnicodeDammit
+from bs4.builder import HTMLTreeBuilder
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# pylint: disable=missing-docstring
+
+# Elements whose strings BeautifulSoup does not count as text.
+NOT_TEXT = ('script', 'style', 'template', 'rt', 'rp')
+# Runs of whitespace with a line break in them.
+LINE_BREAKS = re.compile(r'[ \t\f]*[\r\n][ \t\r\n\f]*')
+# How BeautifulSoup splits the class attribute.
+CLASSES = re.compile(r'\S+')
+# The whitespace of BeautifulSoup, and where it keeps strings of it as is.
+WHITESPACE = ' \t\n\r\f'
+PRESERVE = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+# A tag with an attribute given twice.
+REPEATED = re.compile(r'<[^>\s]+\s[^>]*?(?<![\w:.-])([\w:.-]+)\s*=[^>]*'
+                      r'(?<![\w:.-])\1\s*=', re.IGNORECASE)
+# A carriage return without a line feed.
+CARRIAGE_RETURN = re.compile(r'\r(?!\n)')
+# Elements whose contents libxml2 reads as text and html.parser as markup.
+RAW_TEXT = ('title', 'textarea', 'iframe', 'noembed', 'noframes', 'xmp',
+            'plaintext')
+
+def lines(text):
+    """Text with each run of whitespace that holds a line break made a
+    single line break, and without whitespace at either end.
+
+    """
+    return LINE_BREAKS.sub('\n', text).strip(' \t\r\n\f')
+
+def matches(tag, attrs, element, class_, id_):
+    """Whether a tag with attrs (a dict) is what BeautifulSoup's
+    find(element, class_ = class_, id = id_) looks for.
+
+    The tag name, one of its classes (or all of them, space separated) and
+    its id must equal the ones given. So no tag matches an empty element,
+    and only tags with an empty class and id match empty ones.
+    """
+    if tag != element or attrs.get('id') != id_:
+        return False
+    value = attrs.get('class')
+    if value is None:
+        return False
+    classes = CLASSES.findall(value)
+    return class_ in classes or class_ == ' '.join(classes)
+
+class _Done(Exception):
+    pass
+
+class LinkExtractor(HTMLParser):
+    """Hrefs of the links in the first tag that matches element, class_
+    and id_ (see matches), or in the whole page if none does, as
+    BeautifulSoup with html.parser finds them.
+
+    Tags are followed as they come, without building a tree, and reading
+    stops where the target tag closes. Tags are opened and closed the way
+    BeautifulSoup does: an end tag closes the latest open tag of its name
+    and all tags opened after it, and empty elements such as <br> close at
+    once.
+    """
+
+    EMPTY = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS
+
+    def __init__(self, element = '', class_ = '', id_ = ''):
+        super().__init__(convert_charrefs = False)
+        self.element = element
+        self.class_ = class_
+        self.id_ = id_
+        self.hrefs = []
+        # Names of the open tags, and how many were open outside the target
+        # once it is found.
+        self._open = []
+        self._outside = None
+        # Empty elements closed already, whose end tag is ignored.
+        self._closed = []
+
+    def extract(self, data):
+        """Hrefs in data, the bytes or text of a page."""
+        if isinstance(data, bytes):
+            data = UnicodeDammit(data, is_html = True).unicode_markup
+        try:
+            self.feed(data or '')
+            self.close()
+        except _Done:
+            pass
+        return self.hrefs
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs)
+        if tag in self.EMPTY:
+            self._end(tag)
+            self._closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs)
+        self._end(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed:
+            self._closed.remove(tag)
+        else:
+            self._end(tag)
+
+    def _start(self, tag, attrs):
+        if tag == 'a' or tag == self.element:
+            # The last of repeated attributes counts, no value is ''.
+            attrs = {k: '' if v is None else v for k, v in attrs}
+            if tag == 'a' and 'href' in attrs:
+                self.hrefs.append(attrs['href'])
+            if self._outside is None and tag == self.element and matches(
+                    tag, attrs, self.element, self.class_, self.id_):
+                self.hrefs = []
+                self._outside = len(self._open)
+        self._open.append(tag)
+
+    def _end(self, tag):
+        stack = self._open
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] == tag:
+                del stack[i:]
+                if self._outside is not None and i <= self._outside:
+                    raise _Done
+                return
+
+class SoupParser():
+    """Pages read with html.parser."""
+
+    name = 'html.parser'
+
+    def soup(self, data, exclude_encodings = None, **kwargs):
+        """BeautifulSoup of data, without scripts and styles."""
+        soup = bs(
+            data, 'html.parser', exclude_encodings = exclude_encodings,
+            **kwargs)
+        # Remove all scripts and style data:
+        # http://stackoverflow.com/questions/22799990/beatifulsoup4
+        #                       -get-text-still-has-javascript
+        for script in soup(["script", "style"]):
+            script.extract()
+        return soup
+
+    def links(self, data, element = '', class_ = '', id_ = ''):
+        """Hrefs of the links in the first tag that matches element, class_
+        and id_ (see matches), or in the whole page if none does.
+
+        """
+        return LinkExtractor(element, class_, id_).extract(data)
+
+    def text(self, data):
+        """Text of the page, see lines."""
+        return lines(self.soup(data).text)
+
+    def meta(self, data, exclude_encodings = None):
+        """Attributes of the meta tags, in page order."""
+        # Attributes as written, rather than class split into a list.
+        soup = self.soup(
+            data, exclude_encodings, multi_valued_attributes = None)
+        return [dict(meta.attrs) for meta in soup.find_all('meta')]
+
+    @staticmethod
+    def encoding(data, exclude_encodings = None):
+        """Encoding data is read in, None for text."""
+        if isinstance(data, str):
+            return None
+        return UnicodeDammit(
+            data, is_html = True,
+            exclude_encodings = exclude_encodings).original_encoding
+
+class LxmlParser(SoupParser):
+    """Pages parsed with lxml. Pages lxml cannot take, or would read
+    differently, are left to SoupParser.
+
+    """
+
+    name = 'lxml'
+
+    def __init__(self):
+        if etree is None:
+            raise ImportError('LxmlParser needs lxml.')
+
+    def _root(self, data, exclude_encodings = None):
+        markup = UnicodeDammit(
+            data, is_html = True, exclude_encodings = exclude_encodings).unicode_markup
+        if markup is None or '<![CDATA[' in markup \
+                or REPEATED.search(markup) \
+                or CARRIAGE_RETURN.search(markup):
+            return None
+        try:
+            root = etree.HTML(markup)
+        except ValueError:
+            # XML declaration with an encoding.
+            return None
+        # None for empty pages.
+        if root is not None and any(
+                '<' in (tag.text or '') for tag in root.iter(*RAW_TEXT)):
+            return None
+        return root
+
+    def links(self, data, element = '', class_ = '', id_ = ''):
+        root = self._root(data)
+        if root is None:
+            return super().links(data, element, class_, id_)
+        target = root
+        for tag in root.iter(element) if element else ():
+            if matches(tag.tag, tag.attrib, element, class_, id_):
+                target = tag
+                break
+        hrefs = []
+        for a in target.iterdescendants('a'):
+            href = a.get('href')
+            if href is not None:
+                hrefs.append(href)
+        return hrefs
+
+    def text(self, data):
+        root = self._root(data)
+        if root is None:
+            return super().text(data)
+        return lines(''.join(_string(node) for node in root.xpath(
+            '//text()[not(ancestor::{})]'.format(
+                ' or ancestor::'.join(NOT_TEXT)))))
+
+    def meta(self, data, exclude_encodings = None):
+        root = self._root(data, exclude_encodings)
+        if root is None:
+            return super().meta(data, exclude_encodings)
+        return [dict(meta.attrib) for meta in root.iter('meta')]
+
+def _string(node):
+    """node, a string of lxml, as BeautifulSoup keeps it: made a line break
+    if it is all whitespace and has one, or else a space, outside pre and
+    textarea.
+
+    """
+    if node.strip(WHITESPACE):
+        return node
+    parent = node.getparent()
+    if node.is_tail:
+        parent = parent.getparent()
+    if parent is not None and (parent.tag in PRESERVE or any(
+            tag.tag in PRESERVE for tag in parent.iterancestors())):
+        return node
+    return '\n' if '\n' in node else ' '
+
+PARSERS = {'lxml': LxmlParser, 'html.parser': SoupParser}
+
+def get_parser(name = None):
+    """Parser called name, or the fastest one installed."""
+    if name is None:
+        name = 'lxml' if etree is not None else 'html.parser'
+    if name not in PARSERS:
+        raise ValueError('Unknown parser: {}'.format(name))
+    return PARSERS[name]()
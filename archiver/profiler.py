@@ -0,0 +1,176 @@
+""" Where the time of a run goes.
+
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+
+from archiver.file_handler import FileHander
+
+# pylint: disable=missing-docstring
+
+MODES = (None, 'spans', 'cprofile')
+
+def percentile(values, p):
+    """The p-th percentile of sorted values, by nearest rank."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+class Span():
+    """Durations of the runs of a span, and a sample of them to take
+    percentiles from.
+
+    """
+
+    # Durations kept for percentiles (reservoir sampling beyond that):
+    max_samples = 100000
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = seconds
+
+    def stats(self):
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'p99': percentile(samples, 99)}
+
+class Profiler():
+    """Timing spans around the stages of a run and the items in them.
+
+    With mode None nothing is timed. With 'spans' every span is timed, and
+    with 'cprofile' each stage is also run under cProfile. cProfile only
+    sees the thread that runs the stage, not pages fetched concurrently.
+    """
+
+    # Functions listed per stage in the report, by cumulative time:
+    top_functions = 25
+
+    def __init__(self, mode = None):
+        if mode not in MODES:
+            raise ValueError('mode must be one of {}.'.format(MODES))
+        self.mode = mode
+        self.spans = {}
+        self.profiles = {}
+        self._lock = threading.Lock()
+        self._capturing = False
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def span(self, name):
+        """Context manager timing the with block as a run of span name."""
+        if self.mode is None:
+            return nullcontext()
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Count a run of span name that took seconds, timed elsewhere."""
+        if self.mode is None:
+            return
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = Span(name)
+            span.add(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Like span, and under cProfile in mode 'cprofile'. Stages run in
+        stages are timed, but profiled with the outer one.
+
+        """
+        if self.mode != 'cprofile' or self._capturing:
+            with self.span(name):
+                yield
+            return
+        with self._lock:
+            profile = self.profiles.get(name)
+            if profile is None:
+                profile = self.profiles[name] = cProfile.Profile()
+        self._capturing = True
+        try:
+            with self.span(name):
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+        finally:
+            self._capturing = False
+
+    def stats(self):
+        with self._lock:
+            return {name: span.stats() for name, span in self.spans.items()}
+
+    def report(self):
+        """Table of count, total, mean and percentiles per span, slowest
+        first, and the top functions of profiled stages.
+
+        """
+        stats = self.stats()
+        lines = ['{:<28} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'span', 'count', 'total s', 'mean ms', 'p50 ms', 'p95 ms',
+            'p99 ms')]
+        for name, s in sorted(
+                stats.items(), key = lambda item: -item[1]['total']):
+            lines.append(
+                '{:<28} {:>9} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} '
+                '{:>10.3f}'.format(
+                    name, s['count'], s['total'], s['mean'] * 1000,
+                    s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000))
+        for name, profile in sorted(self.profiles.items()):
+            stream = io.StringIO()
+            pstats.Stats(profile, stream = stream).sort_stats(
+                'cumulative').print_stats(self.top_functions)
+            lines.append('')
+            lines.append('cProfile of {}:'.format(name))
+            lines.append(stream.getvalue().strip('\n'))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write report() to path, and the cProfile data of each stage next
+        to it as <path without extension>-<stage>.prof, e.g. for snakeviz.
+
+        """
+        with FileHander.open_atomic(path) as fobj:
+            fobj.write(self.report().encode())
+        root = os.path.splitext(path)[0]
+        for name, profile in self.profiles.items():
+            profile.dump_stats('{}-{}.prof'.format(root, name))
+        logging.info('Profile written to %s', path)
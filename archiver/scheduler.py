@@ -0,0 +1,95 @@
+""" Per-host request pacing.
+
+"""
+
+import logging
+import threading
+import time
+
+# pylint: disable=missing-docstring
+
+class TokenBucket():
+    """Allow ``rate`` requests per second on average, and bursts of up to
+    ``burst`` requests.
+
+    """
+
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Take a token, return the number of seconds to wait before using
+        it.
+
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class HostScheduler():
+    """Token bucket per host, with a rate that adapts to how the host copes.
+
+    Every answered request adds ``increase`` requests/second to the host's
+    rate, up to ``max_rate``. Errors, and a moving average of the response
+    time above ``slow``, multiply it by ``decrease``, down to ``min_rate``.
+    """
+
+    def __init__(
+            self, rate = 2.0, min_rate = 0.2, max_rate = 50.0, burst = 2,
+            increase = 0.1, decrease = 0.5, slow = 5.0):
+        if not 0 < min_rate <= rate <= max_rate:
+            raise ValueError('Need 0 < min_rate <= rate <= max_rate.')
+        if not 0 < decrease < 1:
+            raise ValueError('decrease must be between 0 and 1.')
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow = slow
+        self._buckets = {}
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def acquire(self, host):
+        """Block until a request to host is allowed."""
+        with self._lock:
+            wait = self._bucket(host).reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, host, latency = None, error = False):
+        """Adapt the rate of host to the outcome of a request."""
+        with self._lock:
+            bucket = self._bucket(host)
+            if latency is not None:
+                average = self._latency.get(host, latency)
+                average = 0.8 * average + 0.2 * latency
+                self._latency[host] = average
+            if error or self._latency.get(host, 0) > self.slow:
+                rate = max(self.min_rate, bucket.rate * self.decrease)
+                if rate < bucket.rate:
+                    logging.info(
+                        'Slowing down: %s (%.2f requests/s)', host, rate)
+            else:
+                rate = min(self.max_rate, bucket.rate + self.increase)
+            bucket.rate = rate
+
+    def get_rate(self, host):
+        with self._lock:
+            return self._bucket(host).rate
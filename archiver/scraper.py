@@ -2,55 +2,220 @@
 
 """
 
+import asyncio
+import hashlib
 import logging
 import os
+import sqlite3 as lite
+import tempfile
+import time
 import urllib.request
 import http.client
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from socket import timeout
-from shutil import copyfile
+from shutil import copyfileobj
+from urllib.parse import urlsplit
+
+from archiver.file_handler import DiscardPage
+from archiver.http_pool import (
+    ACCEPT_ENCODING, DecodeError, Decoder, HTTPPool)
+from archiver.scheduler import HostScheduler
 
 # pylint: disable=missing-docstring
 
 class Scraper():
-    def __init__(self, parent):
+
+    # Give up on an url after this many failed attempts:
+    max_attempts = 5
+    # Seconds to wait for failed urls to become due for another attempt,
+    # before leaving them for the next run:
+    retry_wait = 300
+    # Bytes read from a response at a time:
+    chunk_size = 64 * 1024
+    # Range requests made to complete a body that broke off:
+    max_resumes = 3
+    # Write gzipped responses to the archive without unzipping them:
+    store_compressed = False
+    # Urls read ahead of the ones in flight when fetching concurrently, so
+    # that urls of other hosts are not held up behind a busy one:
+    backlog = 10000
+
+    def __init__(self, parent, rate = None, max_rate = None):
         self.parent = parent
+        self.pool = HTTPPool(headers = {'Accept-Encoding': ACCEPT_ENCODING})
+        # Requests per second to each host to start from, and to go up to
+        # (None: the defaults of HostScheduler).
+        pacing = {}
+        if rate is not None: pacing['rate'] = rate
+        if max_rate is not None: pacing['max_rate'] = max_rate
+        self.scheduler = HostScheduler(**pacing)
+        metrics = parent.metrics
+        self.requests = metrics.counter(
+            'crawl_requests_total', 'Requests made, by host and status.',
+            ('host', 'status'))
+        self.request_seconds = metrics.histogram(
+            'crawl_request_seconds', 'Time to the response headers, by host.',
+            ('host',))
+        self.bytes = metrics.counter(
+            'crawl_bytes_total', 'Bytes received, as sent, by host.', ('host',))
+        self.failures = metrics.counter(
+            'crawl_failures_total', 'Urls left for a retry, by reason.',
+            ('reason',))
 
-    def load_pages(self, urls, restorer = None):
-        for url in urls:
-            if not restorer is None:
-                if not url in restorer:
-                    logging.info('Skipping url not in restorer.')
-                    continue
-            if self.exclusion(url):
-                continue
-            if self.parent.db.is_four_o_four(url):
-                logging.info('PrevCheck404:%s', url)
-                continue
-            try:
-                self.load_page(url, restorer)
-            except urllib.error.HTTPError:
-                logging.info('404:         %s', url)
-                self.parent.db.set_four_o_four(url)
-                continue
-            except http.client.IncompleteRead:
-                logging.info('Partial:     %s', url) # e.partial
-            except urllib.error.URLError:
-                logging.info('fail:        %s', url)
-                continue
-            except timeout:
-                logging.info('timeout:     %s', url)
+    def load_pages(
+            self, urls, restorer = None, concurrency = None, per_host = None,
+            refetch = False, retry = True):
+        """Fetch all urls, one at a time unless a concurrency is given.
+
+        With ``concurrency`` set, up to that many pages are in flight at once,
+        and at most ``per_host`` of them (default: no extra limit) against the
+        same host. With ``refetch``, pages already in the archive are asked
+        for again, conditionally on them having changed.
+
+        Urls that failed for a passing reason are retried, with growing
+        delays, after all urls have been tried. With ``retry`` False they
+        are only scheduled, for the caller to try again when they are due.
+        """
+        self._load_all(urls, restorer, concurrency, per_host, refetch)
+        if not retry:
+            return
+        previous = None
+        while True:
+            urls = self.parent.db.get_due_retries(self.max_attempts)
+            if urls and urls == previous:
+                # None of them could be tried, e.g. they are not in restorer.
+                break
+            previous = urls
+            if urls:
+                logging.info('Retrying failed urls: %s', len(urls))
+                self._load_all(urls, restorer, concurrency, per_host, refetch)
                 continue
-            except ConnectionResetError:
-                logging.info(
-                    'ConnectionResetError: [Errno 54] Connection reset by peer: %s', url)
+            next_attempt = self.parent.db.get_next_retry(self.max_attempts)
+            if next_attempt is None:
+                break
+            wait = next_attempt - time.time()
+            if wait > self.retry_wait:
+                logging.info('Leaving failed urls for the next run.')
+                break
+            time.sleep(max(0, wait))
+
+    def _load_all(self, urls, restorer, concurrency, per_host, refetch):
+        if concurrency is not None:
+            asyncio.run(self._load_pages_async(
+                urls, restorer, concurrency, per_host, refetch))
+            return
+        for url in urls:
+            self._load_url(url, restorer, refetch)
+
+    async def _load_pages_async(
+            self, urls, restorer, concurrency, per_host, refetch = False):
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError('concurrency must be a positive integer.')
+        if per_host is None: per_host = concurrency
+        if not isinstance(per_host, int) or per_host < 1:
+            raise ValueError('per_host must be a positive integer.')
+        logging.info(
+            'Fetching with concurrency: %s (per host: %s)',
+            concurrency, per_host)
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+        queued = asyncio.Semaphore(concurrency + self.backlog)
+        hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+        pending = set()
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            async def worker(url):
+                try:
+                    # Only take a slot once the host has room, so urls
+                    # waiting for a busy host leave the slots to others.
+                    async with hosts[self.host(url)], slots:
+                        await loop.run_in_executor(
+                            executor, self._load_url, url, restorer, refetch)
+                finally:
+                    queued.release()
+            # Only pull the next url once the backlog has room, so that the
+            # urls may be a lazy iterable.
+            for url in urls:
+                await queued.acquire()
+                task = asyncio.ensure_future(worker(url))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+
+    def _load_url(self, url, restorer = None, refetch = False):
+        if not restorer is None:
+            if not url in restorer:
+                logging.info('Skipping url not in restorer.')
+                return
+        if self.exclusion(url):
+            return
+        if self.parent.db.is_four_o_four(url):
+            logging.info('PrevCheck404:%s', url)
+            return
+        retry = self.parent.db.get_retry(url)
+        if retry is not None:
+            attempts, next_attempt = retry
+            if attempts >= self.max_attempts:
+                logging.info('Gave up:     %s', url)
+                return
+            if next_attempt > time.time():
+                logging.info('Retry later: %s', url)
+                return
+        try:
+            with self.parent.profiler.span('fetch'):
+                self.load_page(url, restorer, refetch)
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                logging.info('%s:         %s', e.code, url)
+                self._schedule_retry(url, str(e.code))
+                return
+            logging.info('404:         %s', url)
+            self.parent.db.set_four_o_four(url)
+            if retry is not None:
+                self.parent.db.clear_retry(url)
+        except http.client.IncompleteRead:
+            logging.info('Partial:     %s', url) # e.partial
+            self._schedule_retry(url, 'partial')
+        except urllib.error.URLError:
+            logging.info('fail:        %s', url)
+            self._schedule_retry(url, 'fail')
+        except timeout:
+            logging.info('timeout:     %s', url)
+            self._schedule_retry(url, 'timeout')
+        except ConnectionResetError:
+            logging.info(
+                'ConnectionResetError: [Errno 54] Connection reset by peer: %s', url)
+            self._schedule_retry(url, 'reset')
+        except DecodeError:
+            # Nothing was archived, the body may come through next time.
+            logging.info('Undecodable: %s', url)
+            self._schedule_retry(url, 'decode')
+        except lite.OperationalError as e:
+            # The index of a SegmentStore, written to by other processes for
+            # longer than its busy_timeout.
+            if 'locked' not in str(e):
+                raise
+            logging.info('Locked:      %s', url)
+            self._schedule_retry(url, 'locked')
+        else:
+            if retry is not None:
+                self.parent.db.clear_retry(url)
 
-    def load_page(self, url, restorer = None):
+    def _schedule_retry(self, url, reason):
+        self.failures.inc(reason = reason)
+        self.parent.db.schedule_retry(url, reason)
+
+    def load_page(self, url, restorer = None, refetch = False):
         if not isinstance (url, str):
             raise TypeError('url must be a string')
         try:
             fname = self.parent.db.get_filename(url)
-            logging.info('Alredy here: %s', url)
+            if refetch:
+                self._refetch_page(url)
+            else:
+                logging.info('Alredy here: %s', url)
         except KeyError:
             self._fetch_page(url, restorer)
             fname = self.parent.db.get_filename(url)
@@ -66,28 +231,31 @@ class Scraper():
         try:
             if url in restorer:
                 fname = self.parent.db.set_filename(url)
-                fpath = os.path.join(self.parent.fh.archive_folder, fname)
                 old_file = restorer[url]
                 os.makedirs('data_old', exist_ok=True)
                 old_file_path = os.path.join('data_old/archives', old_file)
                 logging.info('url: %s', url)
                 logging.info('Copying file: %s -> %s', old_file, fname)
-                copyfile(old_file_path, fpath)
+                with open(old_file_path, 'rb') as src, \
+                        self.parent.fh.open_page(fname) as dst:
+                    copyfileobj(src, dst)
                 self.parent.db.update_fetched(url)
             else:
                 logging.info('Fetching...: %s', url)
-                with urllib.request.urlopen(url) as url_obj:
+                with self._urlopen(url) as url_obj:
                     fname = self.parent.db.set_filename(url)
-                    fpath = os.path.join(self.parent.fh.archive_folder, fname)
-                    with open(fpath, 'wb') as f:
-                        logging.info('Writing file: %s', fname)
-                        f.write(url_obj.read())
+                    try:
+                        self._write_page(url, url_obj, fname)
+                    except Exception:
+                        # Nothing was archived, fetch it again next time.
+                        self.parent.db.rm_filename(url)
+                        raise
                     self.parent.db.update_fetched(url)
-                    if fname == '050000':
-                        exit()
         except KeyboardInterrupt:
             if not fname is None:
-                fname = self.parent.db.get_filename(url)
+                # Not get_filename, which may be the file of another url
+                # with the same contents.
+                fname = self.parent.db.get_own_filename(url)
                 # Skip a line to not get annoyed at the interupt formatting.
                 print()
                 logging.info(
@@ -95,7 +263,8 @@ class Scraper():
                 logging.info(
                     'The current url will be fetched next time the script is '
                     'run: %s', url)
-                os.remove(os.path.join(self.parent.fh.archive_folder, fname))
+                # The page only exists if the download had finished.
+                self.parent.fh.delete_page(fname)
                 self.parent.db.update_fetched(url, revert = True)
                 self.parent.db.rm_filename(url)
                 # We COULD decrease the ID in the database, but that is not
@@ -104,6 +273,197 @@ class Scraper():
                 #       -the-auto-increment-id-in-android-sqlite
             exit()
 
+    def _urlopen(self, url, headers = None):
+        """Open url through the pool, at the pace the host is given by the
+        scheduler.
+
+        """
+        host = self.host(url)
+        self.scheduler.acquire(host)
+        start = time.monotonic()
+        try:
+            url_obj = self.pool.urlopen(url, headers = headers)
+        except urllib.error.HTTPError as e:
+            elapsed = time.monotonic() - start
+            self.scheduler.record(
+                host, elapsed, error = e.code == 429 or e.code >= 500)
+            self.requests.inc(host = host, status = e.code)
+            self.request_seconds.observe(elapsed, host = host)
+            raise
+        except (urllib.error.URLError, OSError):
+            self.scheduler.record(host, error = True)
+            self.requests.inc(host = host, status = 'error')
+            raise
+        elapsed = time.monotonic() - start
+        self.scheduler.record(host, elapsed)
+        self.requests.inc(host = host, status = url_obj.status)
+        self.request_seconds.observe(elapsed, host = host)
+        return url_obj
+
+    def _refetch_page(self, url):
+        """Fetch a page again unless the server says it has not changed.
+
+        """
+        headers = {}
+        validators = self.parent.db.get_validators(url)
+        if validators is not None:
+            if validators['etag'] is not None:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified'] is not None:
+                headers['If-Modified-Since'] = validators['last_modified']
+        logging.info('Refetching.: %s', url)
+        with self._urlopen(url, headers = headers) as url_obj:
+            if url_obj.status == 304:
+                url_obj.read()
+                logging.info('Unchanged:   %s', url)
+                if validators is not None:
+                    # Only the fetch time changes.
+                    self.parent.db.set_validators(
+                        url,
+                        etag = validators['etag'],
+                        last_modified = validators['last_modified'],
+                        content_length = validators['content_length'])
+                return
+            self._rewrite_page(url, url_obj)
+
+    def _write_page(self, url, url_obj, fname):
+        """Archive the body of url_obj under fname, unless the same contents
+        are in the archive already.
+
+        """
+        with self.parent.fh.open_page(fname) as f:
+            logging.info('Writing file: %s', fname)
+            content_length, digest = self._stream(url, url_obj, f)
+            original = self.parent.db.add_content(url, digest, fname)
+            if original != fname:
+                logging.info('Same as file: %s', original)
+                raise DiscardPage
+        self._set_validators(url, url_obj, content_length)
+
+    def _rewrite_page(self, url, url_obj):
+        """Archive a new version of a page, leaving the old version to the
+        urls which share it.
+
+        """
+        with tempfile.TemporaryFile() as tmp:
+            content_length, digest = self._stream(url, url_obj, tmp)
+            self._set_validators(url, url_obj, content_length)
+            if digest == self.parent.db.get_content_hash(url):
+                logging.info('Unchanged:   %s', url)
+                return
+            old_fname = self.parent.db.get_filename(url)
+            shared = self.parent.db.is_shared(url)
+            if shared:
+                fname = self.parent.db.renew_filename(url)
+            else:
+                fname = self.parent.db.get_own_filename(url)
+            original = self.parent.db.add_content(url, digest, fname)
+            if original == fname:
+                tmp.seek(0)
+                with self.parent.fh.open_page(fname) as f:
+                    logging.info('Writing file: %s', fname)
+                    copyfileobj(tmp, f)
+            else:
+                logging.info('Same as file: %s', original)
+            if not shared and old_fname != original:
+                # No url has the old version any more.
+                self.parent.fh.delete_page(old_fname)
+        # The links in the new version have not been looked at yet:
+        self.parent.db.set_unscanned(url)
+
+    def _set_validators(self, url, url_obj, content_length):
+        self.parent.db.set_validators(
+            url,
+            etag = url_obj.getheader('ETag'),
+            last_modified = url_obj.getheader('Last-Modified'),
+            content_length = content_length)
+
+    def _stream(self, url, url_obj, f):
+        """Copy the body of url_obj to f in chunks of ``chunk_size`` bytes,
+        decompressing it unless ``store_compressed`` says to keep it gzipped.
+
+        When the connection breaks off before the end of the body, the rest
+        is asked for with a Range request, up to ``max_resumes`` times.
+        Returns the number of bytes written and their SHA-256 hex digest.
+        """
+        host = self.host(url)
+        expected = url_obj.getheader('Content-Length')
+        expected = int(expected) if expected is not None else None
+        # Only resume if the server can tell whether the page changed since.
+        validator = url_obj.getheader('ETag') or url_obj.getheader(
+            'Last-Modified')
+        decoder = self._decoder(url_obj)
+        digest = hashlib.sha256()
+        # Bytes as sent, which is what Range counts, and as written.
+        received = 0
+        written = 0
+        response = url_obj
+        for resumes in range(self.max_resumes + 1):
+            try:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    self.bytes.inc(len(chunk), host = host)
+                    written += self._write_chunk(
+                        f, digest, decoder.decode(chunk))
+            except http.client.IncompleteRead as e:
+                received += len(e.partial)
+                self.bytes.inc(len(e.partial), host = host)
+                written += self._write_chunk(
+                    f, digest, decoder.decode(e.partial))
+            else:
+                if expected is None or received >= expected:
+                    written += self._write_chunk(f, digest, decoder.flush())
+                    return written, digest.hexdigest()
+            finally:
+                if response is not url_obj:
+                    response.close()
+            if resumes == self.max_resumes:
+                break
+            headers = {}
+            if validator is not None:
+                headers = {
+                    'Range': 'bytes={}-'.format(received),
+                    'If-Range': validator}
+            logging.info('Resuming...: %s (at byte %s)', url, received)
+            response = self._urlopen(url, headers = headers)
+            if response.status != 206:
+                # The whole page is sent again.
+                f.seek(0)
+                f.truncate()
+                received = 0
+                written = 0
+                decoder = self._decoder(response)
+                digest = hashlib.sha256()
+                expected = response.getheader('Content-Length')
+                expected = int(expected) if expected is not None else None
+        raise http.client.IncompleteRead(
+            b'', None if expected is None else expected - received)
+
+    @staticmethod
+    def _write_chunk(f, digest, data):
+        digest.update(data)
+        return f.write(data)
+
+    def _decoder(self, url_obj):
+        encoding = url_obj.getheader('Content-Encoding')
+        if self.store_compressed and encoding in ('gzip', 'x-gzip'):
+            # Readers go through FileHander.read_file, which unzips.
+            return Decoder()
+        try:
+            return Decoder(encoding)
+        except ValueError:
+            logging.info('Unknown encoding %s, stored as is.', encoding)
+            return Decoder()
+
+    @staticmethod
+    def host(url):
+        if not url.startswith('http'):
+            url = 'http://' + url
+        return urlsplit(url).netloc.lower()
+
     @staticmethod
     def exclusion(url):
         url = url.strip('/')
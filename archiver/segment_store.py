@@ -0,0 +1,181 @@
+""" Packed page storage.
+
+Pages are appended, zlib compressed, to segment files of up to
+``segment_size`` bytes. An index in SQLite maps every file id to the
+segment, offset and length of its latest record. Every store writes to a
+segment of its own, so several processes can share the folder.
+
+"""
+
+import os
+import re
+import sqlite3 as lite
+import struct
+import threading
+import zlib
+
+# pylint: disable=missing-docstring
+
+HEADER = struct.Struct('>4sQQ')
+MAGIC = b'PAGE'
+SEGMENT = re.compile(r'^(\d{6,})\.seg$')
+
+class SegmentStore():
+
+    # Seconds to wait for the index while another process writes to it:
+    busy_timeout = 30
+
+    def __init__(self, folder, segment_size = 64 * 2**20, level = 6,
+                 sync = True):
+        if not isinstance(folder, str):
+            raise TypeError('folder must be a string.')
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.segment_size = segment_size
+        self.level = level
+        self.sync = sync
+        self._active = None
+        self._active_number = None
+        self._lock = threading.RLock()
+        self._con = lite.connect(
+            os.path.join(folder, 'index'), timeout = self.busy_timeout,
+            check_same_thread = False)
+        with self._lock, self._con as con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS pages('
+                'ID INTEGER PRIMARY KEY,'
+                'segment INT NOT NULL,'
+                'offset INT NOT NULL,'
+                'length INT NOT NULL'
+                ')'
+            )
+
+    def segment_path(self, number):
+        return os.path.join(self.folder, str(number).zfill(6) + '.seg')
+
+    def segments(self):
+        numbers = []
+        for name in os.listdir(self.folder):
+            match = SEGMENT.match(name)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _open_segment(self):
+        """Start a new segment, which no other store writes to."""
+        number = max(self.segments(), default = 0)
+        while True:
+            number += 1
+            try:
+                fd = os.open(
+                    self.segment_path(number),
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                continue
+            self._active = os.fdopen(fd, 'wb')
+            self._active_number = number
+            return
+
+    def put(self, file_id, data):
+        """Append data (bytes, or a binary file object read in chunks) as
+        the contents of file_id.
+
+        """
+        if not isinstance(file_id, int):
+            raise TypeError('file_id must be an integer.')
+        with self._lock:
+            if self._active is None or self._active.tell() >= self.segment_size:
+                if self._active is not None:
+                    self._active.close()
+                self._open_segment()
+            segment = self._active_number
+            out = self._active
+            offset = out.tell()
+            out.write(HEADER.pack(MAGIC, file_id, 0))
+            compressor = zlib.compressobj(self.level)
+            length = 0
+            if isinstance(data, bytes):
+                chunks = [data]
+            else:
+                chunks = iter(lambda: data.read(2**16), b'')
+            try:
+                for chunk in chunks:
+                    length += out.write(compressor.compress(chunk))
+                length += out.write(compressor.flush())
+                out.seek(offset)
+                out.write(HEADER.pack(MAGIC, file_id, length))
+                out.seek(0, os.SEEK_END)
+                out.flush()
+                if self.sync:
+                    os.fsync(out.fileno())
+            except BaseException:
+                # Leave no half record behind for the next append.
+                out.seek(offset)
+                out.truncate()
+                raise
+            with self._con as con:
+                con.execute(
+                    'INSERT OR REPLACE INTO pages (ID, segment, offset, length) '
+                    'VALUES (?, ?, ?, ?)', (file_id, segment, offset, length))
+
+    def locate(self, file_id):
+        with self._lock:
+            res = self._con.execute(
+                'SELECT segment, offset, length FROM pages WHERE ID = ?',
+                (file_id,)).fetchone()
+        if res is None:
+            raise KeyError('Not in segment store: {}'.format(file_id))
+        return res
+
+    def get(self, file_id):
+        segment, offset, length = self.locate(file_id)
+        with open(self.segment_path(segment), 'rb') as fobj:
+            fobj.seek(offset + HEADER.size)
+            return zlib.decompress(fobj.read(length))
+
+    def __contains__(self, file_id):
+        try:
+            self.locate(file_id)
+        except KeyError:
+            return False
+        return True
+
+    def delete(self, file_id):
+        """Forget file_id. Its record stays in the segment until it is
+        rewritten.
+
+        """
+        with self._lock, self._con as con:
+            con.execute('DELETE FROM pages WHERE ID = ?', (file_id,))
+
+    def scan(self, segment = None):
+        """Yield (file_id, data) for the current records, reading one segment
+        at a time from start to end.
+
+        """
+        segments = self.segments() if segment is None else [segment]
+        for number in segments:
+            with self._lock:
+                current = set(self._con.execute(
+                    'SELECT offset FROM pages WHERE segment = ?', (number,)))
+            with open(self.segment_path(number), 'rb') as fobj:
+                while True:
+                    offset = fobj.tell()
+                    header = fobj.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    magic, file_id, length = HEADER.unpack(header)
+                    if magic != MAGIC:
+                        break
+                    data = fobj.read(length)
+                    if len(data) < length:
+                        break
+                    if (offset,) in current:
+                        yield file_id, zlib.decompress(data)
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+            self._con.close()
@@ -1,5 +1,7 @@
 import re
 
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
 from archiver.date_tools import get_date, get_date_string_generator
 
 def get_archive_urls(
@@ -28,3 +30,78 @@ def get_archive_urls(
         out.append(schema.format(date))
     return out
 
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def remove_dot_segments(path):
+    """ Resolve '.' and '..' in an url path (RFC 3986, 5.2.4).
+    """
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if len(segments) > 1:
+                segments.pop()
+        elif segment != '.':
+            segments.append(segment)
+    if path.endswith(('/.', '/..')):
+        segments.append('')
+    return '/'.join(segments)
+
+def canonical_url(url, base = None, query = 'keep', ignore_params = ()):
+    """ Return the canonical form of url, resolved against base if given.
+
+    http(s) urls get a lowercase scheme and host, no default port, no
+    fragment and no '.' or '..' in the path. The query is kept as it is
+    ('keep'), with its parameters sorted ('sort') or dropped ('drop').
+    Parameters named in ignore_params, or starting with a name there that
+    ends with '*', are left out. Other urls, and malformed ones such as
+    with a port that is not a number, are returned as resolved.
+    """
+    if not isinstance (url, str):
+        raise TypeError
+    if query not in ('keep', 'sort', 'drop'):
+        raise ValueError('query must be "keep", "sort" or "drop".')
+    url = url.strip()
+    try:
+        if base is not None:
+            url = urljoin(base, url)
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # Invalid IPv6 address or port.
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+    netloc = parts.hostname
+    if ':' in netloc:
+        netloc = '[' + netloc + ']'
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += ':{}'.format(port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+    path = remove_dot_segments(parts.path) or '/'
+    params = parts.query
+    if query == 'drop':
+        params = ''
+    elif ignore_params or query == 'sort':
+        pairs = [
+            (name, value)
+            for name, value in parse_qsl(params, keep_blank_values = True)
+            if not _ignored(name, ignore_params)]
+        if query == 'sort':
+            pairs.sort()
+        params = urlencode(pairs)
+    return urlunsplit((scheme, netloc, path, params, ''))
+
+def _ignored(name, ignore_params):
+    for ignored in ignore_params:
+        if ignored.endswith('*'):
+            if name.startswith(ignored[:-1]):
+                return True
+        elif name == ignored:
+            return True
+    return False
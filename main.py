@@ -2,17 +2,74 @@
 
 """
 import json
+import os
 
 from archiver import archiver, url_tools
+from archiver.analyzer import process_context
 
 CLEAN_ARCHIVE = False
 SCAN_ARCHIVE = True
 SCAN_ARTICLES = True
 EXTRACT_TEXT = False
+# Number of pages fetched at once (None: one at a time), and per host.
+CONCURRENCY = None
+PER_HOST = None
+# Requests per second to each host to start from; the rate goes up while
+# the host keeps up, to at most MAX_RATE (None: the scheduler's defaults).
+RATE = None
+MAX_RATE = None
+# Wait for failed urls to be due and try them again before moving on
+# (False: they are left for the next run).
+RETRY = False
+# Number of processes fetching articles from a shared frontier (None: one,
+# without frontier).
+WORKERS = None
+# Number of processes parsing the archive for links (None: parsed one page
+# at a time), and the number of pages handed to them at once.
+SCAN_WORKERS = None
+SCAN_BATCH_SIZE = 100
+# Seconds between metrics summaries in the log, and the file the metrics are
+# written to in the Prometheus text format (None: not written).
+METRICS_INTERVAL = 60
+METRICS_FILE = 'data/metrics.prom'
+# Time the stages of the run ('spans'), and profile them ('cprofile'), with
+# the report written to PROFILE_FILE at the end (None: no profiling).
+PROFILE = None
+PROFILE_FILE = 'data/profile.txt'
+# Keep the links, text and encoding read out of pages next to the database,
+# so pages are parsed once.
+ARTIFACTS = True
 
 RESTORER = json.load(open('data_restore/mapping.json', 'r'))
 RESTORER = None
 
+def run_worker():
+    "Fetch urls from the frontier, in a process of its own."
+    agent = archiver.Agent(
+        directory = 'data',
+        archive_folder = 'archives',
+        db = 'db',
+        profile = PROFILE,
+        artifacts = ARTIFACTS,
+        rate = RATE,
+        max_rate = MAX_RATE)
+    if METRICS_FILE is not None:
+        # One file per process; the exporter collects all of them.
+        root, ext = os.path.splitext(METRICS_FILE)
+        agent.report_metrics(
+            METRICS_INTERVAL, '{}-{}{}'.format(root, os.getpid(), ext))
+    else:
+        agent.report_metrics(METRICS_INTERVAL)
+    try:
+        agent.run_worker(
+            restorer = RESTORER, concurrency = CONCURRENCY, per_host = PER_HOST)
+    finally:
+        if PROFILE:
+            root, ext = os.path.splitext(PROFILE_FILE)
+            agent.profiler.write('{}-{}{}'.format(root, os.getpid(), ext))
+        # Worker processes exit without running atexit handlers.
+        agent.close()
+
 if __name__ == '__main__':
     all_urls = url_tools.get_archive_urls(
         from_date = '2016-04-01',
@@ -22,28 +79,55 @@ if __name__ == '__main__':
     agent = archiver.Agent(
         directory = 'data',
         archive_folder = 'archives',
-        db = 'db')
+        db = 'db',
+        profile = PROFILE,
+        artifacts = ARTIFACTS,
+        rate = RATE,
+        max_rate = MAX_RATE)
 
     if CLEAN_ARCHIVE:
         agent.clean()
         agent = archiver.Agent(
             directory = 'data',
             archive_folder = 'archives',
-            db = 'db')
+            db = 'db',
+            profile = PROFILE,
+            artifacts = ARTIFACTS,
+            rate = RATE,
+            max_rate = MAX_RATE)
 
+    agent.report_metrics(METRICS_INTERVAL, METRICS_FILE)
     agent.seed_archive(all_urls)
 
     if SCAN_ARCHIVE:
-        agent.load_unfetched_seeds(RESTORER)
-        agent.find_links_in_archive(target_element = 'ul', target_class = 'list_16')
+        agent.load_unfetched_seeds(
+            RESTORER, concurrency = CONCURRENCY, per_host = PER_HOST,
+            retry = RETRY)
+        agent.find_links_in_archive(
+            target_element = 'ul', target_class = 'list_16',
+            workers = SCAN_WORKERS, batch_size = SCAN_BATCH_SIZE)
 
-    if SCAN_ARTICLES:
-        agent.load_unfetched_links(RESTORER)
+    if SCAN_ARTICLES and WORKERS:
+        agent.fill_frontier()
+        # Not forked: the metrics reporter and database writer threads of
+        # this process are running.
+        workers = [process_context().Process(target = run_worker)
+                   for _ in range(WORKERS)]
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+    elif SCAN_ARTICLES:
+        agent.load_unfetched_links(
+            RESTORER, concurrency = CONCURRENCY, per_host = PER_HOST,
+            retry = RETRY)
         home = 'http://politics.people.com.cn'
 
     if EXTRACT_TEXT:
         agent.extract_text_from_articles()
 
+    if PROFILE:
+        agent.profiler.write(PROFILE_FILE)
+    agent.close()
+
     #for x in article_urls: print (x)
     #c = agent.count_links()
 
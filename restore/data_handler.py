@@ -3,8 +3,13 @@ import sqlite3 as lite
 import json
 import os
 
+from archiver.artifact_store import ArtifactStore
 from restore import page_identifier, page_mapper, page_contains_url
 
+def open_artifacts(data_restore_path):
+    "What was read out of pages, next to the database like an Agent's."
+    return ArtifactStore(os.path.join(data_restore_path, 'db.artifacts'))
+
 def get_all_links(data_restore_path):
     "_"
     try:
@@ -36,8 +41,10 @@ def get_page_data(data_path, data_restore_path):
         missing_data = []
         page_data = []
         content_ids = []
+        artifacts = open_artifacts(data_restore_path)
         for x in range(1, 47212):#15478):
-            catalogs, content_id, publish_date = page_identifier(data_path, x)
+            catalogs, content_id, publish_date = page_identifier(
+                data_path, x, artifacts=artifacts)
             fname = str(x).zfill(6)
             if None in (content_id, catalogs, publish_date):
                 print ('file name:', fname,
@@ -49,6 +56,7 @@ def get_page_data(data_path, data_restore_path):
                 page_data.append((fname, content_id, catalogs, publish_date))
             if not content_id is None:
                 content_ids.append((fname, content_id, catalogs, publish_date))
+        artifacts.close()
         json.dump(
             missing_data,
             open(os.path.join(data_restore_path, 'missing_data.json'), 'w'))
@@ -71,11 +79,13 @@ def get_mapping(all_links, page_data, names_and_funcs, data_restore_path, data_p
         happy = 0
         results = []
         mapping = {}
+        artifacts = open_artifacts(data_restore_path)
         for i, link in enumerate(all_links):
             for result in page_mapper(link, page_data, names_and_funcs):
                 url = result['url']
                 fname = result['fname']
-                if page_contains_url(url, fname, data_path):
+                if page_contains_url(
+                        url, fname, data_path, artifacts=artifacts):
                     mapping[url] = fname
                     happy += 1
                     break
@@ -86,6 +96,7 @@ def get_mapping(all_links, page_data, names_and_funcs, data_restore_path, data_p
                     print (i, '/', len(all_links))
             else:
                 sad += 1
+        artifacts.close()
         print ('happy:', happy)
         print ('sad:', sad)
         json.dump(
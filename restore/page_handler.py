@@ -1,34 +1,41 @@
 """_
 """
 import re
-import os
 
 from bs4 import BeautifulSoup as bs
 
+from archiver.file_handler import FileHander
+from archiver.parsers import get_parser
+
 # pylint: disable=unused-variable
 
-def page_identifier(_path, num):
+PARSER = get_parser()
+EXCLUDE_ENCODINGS = ['windows-1252']
+
+def page_identifier(_path, num, store=None, artifacts=None):
     "_"
     str_num = str(num).zfill(6)
-    with open(_path + str_num, 'rb') as _file:
-        soup = bs(_file, 'html.parser', exclude_encodings=['windows-1252'])
-        #soup = bs(_file, 'html.parser', exclude_encodings=['gb2312'])
-        #soup = bs(_file, 'html.parser', exclude_encodings=['utf-8'])
-        #print (soup.original_encoding)
-        #try: soup.encode('utf')
-        #except: soup = soup.decode('utf')
-
-    for script in soup(["script", "style"]):
-        script.extract()
-    #_text = soup.text
-    #_text = re.sub(r'\n+', r'\n', _text)
-    #_text = re.sub(r'\t+', r'', _text)
-    #_text = re.sub(r'( )+', r' ', _text)
-    #print (_text)
+    if store is None:
+        _data = FileHander.read_file(
+            FileHander.find_page_file(_path, str_num))
+    else:
+        _data = FileHander.gunzip(store.get(int(num)))
+    if artifacts is None:
+        return _identify(_data)
+    artifacts.cached(
+        int(num), _data, 'encoding',
+        lambda data: PARSER.encoding(data, EXCLUDE_ENCODINGS),
+        EXCLUDE_ENCODINGS)
+    return tuple(artifacts.cached(
+        int(num), _data, 'meta', _identify, EXCLUDE_ENCODINGS))
+
+def _identify(_data):
+    "Catalogs, content id and publish date in the meta tags of a page."
+    metas = PARSER.meta(_data, exclude_encodings=EXCLUDE_ENCODINGS)
 
     (_content_id, _catalogs, _publish_date) = (None, None, None)
-    for meta in soup.find_all('meta'):
-        if meta.has_attr('name'):
+    for meta in metas:
+        if 'name' in meta:
             if meta['name'] == 'catalogs':
                 _catalogs = meta['content']
                 #print ('_catalogs:', _catalogs)
@@ -53,10 +60,22 @@ def page_mapper(_url, _data, _names_and_funcs):
     #if GB_num_review_num is not None:
     #    yield GB_num_review_num
 
-def page_contains_url(_url, _fname, path):
+def page_contains_url(_url, _fname, path, store=None, artifacts=None):
     "_"
-    with open(os.path.join(path, _fname), 'rb') as _file:
-        soup = bs(_file, 'html.parser', exclude_encodings=['windows-1252'])
+    if store is None:
+        _data = FileHander.read_file(FileHander.find_page_file(path, _fname))
+    else:
+        _data = FileHander.gunzip(store.get(int(_fname)))
+    if artifacts is None:
+        contents = _contents(_data)
+    else:
+        contents = artifacts.cached(
+            int(_fname), _data, 'contents', _contents, EXCLUDE_ENCODINGS)
     marker = r'/'.join(_url.split('/')[3:])
-    res = re.search(marker, str(soup.contents))
+    res = re.search(marker, contents)
     return bool(res)
+
+def _contents(_data):
+    "The page as BeautifulSoup writes it out."
+    soup = bs(_data, 'html.parser', exclude_encodings=EXCLUDE_ENCODINGS)
+    return str(soup.contents)
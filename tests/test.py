@@ -2,9 +2,13 @@
 
 """
 
+import gzip
+import http.server
 import tempfile
 import os
 import shutil
+import threading
+import time
 
 from glob import glob
 
@@ -17,6 +21,47 @@ import archiver
 
 # pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
 
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /missing as 404 and any other path after a pause, counting
+    the requests in flight and done per Host header, and the requests to
+    other hosts done before the first to each host.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    in_flight = {}
+    peak = {}
+    done = {}
+    done_before = {}
+
+    def do_GET(self):
+        host = self.headers['Host']
+        cls = type(self)
+        with cls.lock:
+            cls.done_before.setdefault(host, sum(cls.done.values()))
+            cls.in_flight[host] = cls.in_flight.get(host, 0) + 1
+            cls.peak[host] = max(cls.peak.get(host, 0), cls.in_flight[host])
+            cls.peak['all'] = max(
+                cls.peak.get('all', 0), sum(cls.in_flight.values()))
+        try:
+            time.sleep(0.1)
+            if self.path.startswith('/missing'):
+                self.send_error(404)
+                return
+            body = self.path.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.in_flight[host] -= 1
+                cls.done[host] = cls.done.get(host, 0) + 1
+
+    def log_message(self, *args):
+        pass
+
 class TestAgent(object):
 
     skip_online_tests = True
@@ -32,7 +77,8 @@ class TestAgent(object):
 
     def setup(self):
         self.agent = archiver.Agent(
-            directory = self.temp_dir, archive_folder = 'archives', db = 'db')
+            directory = self.temp_dir, archive_folder = 'archives', db = 'db',
+            backend = 'memory')
 
     def teardown(self):
         self.agent.clean()
@@ -77,8 +123,8 @@ class TestAgent(object):
         # One file, one dir, one data, archive_folder, fpath:
         assert_true(os.path.isdir(archive_folder))
         assert_true(os.path.isfile(fpath))
-        # ./archive/ ./archive.json ./scanned.json
-        assert_equals(2, len(glob(os.path.join(self.agent.fh.directory,'*'))))
+        # ./archive/ (the database is in memory)
+        assert_equals(1, len(glob(os.path.join(self.agent.fh.directory,'*'))))
         assert_equals(1, len(glob(os.path.join(self.agent.fh.archive_folder,'*'))))
 
         # Delete it:
@@ -90,9 +136,10 @@ class TestAgent(object):
         assert_equals(0, len(glob(os.path.join(self.agent.fh.directory,'*'))))
         # Recreate, so teardown doesn't fail:
         self.agent = archiver.Agent(
-            directory = self.temp_dir, archive_folder = 'archives', db = 'db')
+            directory = self.temp_dir, archive_folder = 'archives', db = 'db',
+            backend = 'memory')
 
-        assert_equals(2, len(glob(os.path.join(self.agent.fh.directory,'*'))))
+        assert_equals(1, len(glob(os.path.join(self.agent.fh.directory,'*'))))
 
         # Delete it:
         self.agent.clean()
@@ -102,7 +149,62 @@ class TestAgent(object):
 
         # Recreate, so teardown doesn't fail:
         self.agent = archiver.Agent(
-            directory = self.temp_dir, archive_folder = 'archives', db = 'db')
+            directory = self.temp_dir, archive_folder = 'archives', db = 'db',
+            backend = 'memory')
+
+    def test_open_atomic(self):
+        archive = self.agent.fh.archive_folder
+        fpath = os.path.join(archive, '000001')
+        with self.agent.fh.open_atomic(fpath) as f:
+            f.write(b'Some contents')
+            assert_false(os.path.isfile(fpath))
+        with open(fpath, 'rb') as f:
+            assert_equals(f.read(), b'Some contents')
+        assert_equals(os.listdir(archive), ['000001'])
+
+    def test_open_atomic_keeps_target_on_error(self):
+        archive = self.agent.fh.archive_folder
+        fpath = os.path.join(archive, '000001')
+        with open(fpath, 'wb') as f: f.write(b'Old contents')
+        def write():
+            with self.agent.fh.open_atomic(fpath) as f:
+                f.write(b'Half')
+                raise OSError
+        assert_raises(OSError, write)
+        with open(fpath, 'rb') as f:
+            assert_equals(f.read(), b'Old contents')
+        assert_equals(os.listdir(archive), ['000001'])
+
+    def test_read_file_gzipped(self):
+        fpath = os.path.join(self.agent.fh.archive_folder, '000001')
+        with gzip.open(fpath, 'wb') as f: f.write(b'Some contents')
+        assert_equals(self.agent.fh.read_file(fpath), b'Some contents')
+
+    def test_pack(self):
+        self.agent.fh.archive_folder = 'archives'
+        fname = self.agent.db.set_filename('www.example.com')
+        fpath = os.path.join(self.agent.fh.archive_folder, fname)
+        with open(fpath, 'wb') as f: f.write(b'Some contents')
+        self.agent.pack_archive()
+        assert_false(os.path.isfile(fpath))
+        assert_equals(self.agent.fh.storage, 'segments')
+        assert_equals(self.agent.db.get_page('www.example.com'), b'Some contents')
+
+    def test_shard(self):
+        self.agent.fh.archive_folder = 'archives'
+        archive = self.agent.fh.archive_folder
+        fname = self.agent.db.set_filename('www.example.com')
+        with open(os.path.join(archive, fname), 'wb') as f:
+            f.write(b'Some contents')
+        self.agent.shard_archive()
+        fpath = os.path.join(archive, '01', '00', '000001')
+        assert_true(os.path.isfile(fpath))
+        assert_equals(self.agent.db.get_filepath('www.example.com'), fpath)
+
+    def test_get_path_beyond_six_digits(self):
+        assert_equals(
+            self.agent.fh.get_path('1234567'),
+            os.path.join(self.agent.fh.archive_folder, '67', '45', '1234567'))
 
     # File names and paths
     def test__get_filename_url_raises_TypeError(self):
@@ -189,6 +291,45 @@ class TestAgent(object):
         assert_equals(fname, '000001')
         assert_equals(retrieved, '000001')
 
+    def test__load_pages_concurrently(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        port = server.server_address[1]
+        try:
+            # Two hosts for the same server.
+            hosts = ['127.0.0.1:{}'.format(port), 'localhost:{}'.format(port)]
+            # One host after the other, so the first could take every slot.
+            urls = ['http://{}/{}.html'.format(host, i)
+                    for host in hosts for i in range(6)]
+            missing = 'http://{}/missing.html'.format(hosts[0])
+            self.agent.db.seed_archive(urls + [missing])
+            self.agent.scraper.scheduler = archiver.HostScheduler(
+                rate = 50, max_rate = 50, burst = 50)
+            self.agent.scraper.load_pages(
+                urls + [missing], concurrency = 4, per_host = 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+        for url in urls:
+            fname = self.agent.db.get_filename(url)
+            assert_equals(
+                self.agent.fh.read_page(fname),
+                ('/' + url.rsplit('/', 1)[1]).encode())
+        assert_equals(self.agent.db.get_unfetched_seeds(), {missing})
+        assert_true(self.agent.db.is_four_o_four(missing))
+        assert_equals(self.agent.db.get_four_o_fours(), [missing])
+        for host in hosts:
+            assert_true(SlowHandler.peak[host] <= 2)
+        # min(concurrency, hosts * per_host)
+        assert_equals(SlowHandler.peak['all'], 4)
+        # The second host is not held up behind the first.
+        assert_equals(SlowHandler.done_before[hosts[1]], 0)
+
+    def test__load_pages_concurrency_raises_ValueError(self):
+        assert_raises(
+            ValueError, self.agent.scraper.load_pages,
+            urls = ['www.example.com'], concurrency = 0)
+
     def test__fetch_page_url_raises_TypeError(self):
         if self.skip_online_tests: raise SkipTest
         assert_raises(
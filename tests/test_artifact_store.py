@@ -0,0 +1,114 @@
+""" Test the store of what was read out of pages.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+PAGE = b'<html><body><ul class="list_16"><a href="/a">a</a></ul></body></html>'
+
+class TestArtifactStore(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'db.artifacts')
+        self.store = archiver.ArtifactStore(self.path)
+
+    def teardown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        digest = self.store.digest(PAGE)
+        self.store.put(1, digest, 'links', ['/a'], ['ul', 'list_16', ''])
+        assert_equals(
+            self.store.get(1, digest, 'links', ['ul', 'list_16', '']), ['/a'])
+        assert_equals(self.store.get(1, digest, 'links', ['', '', '']), None)
+        assert_equals(self.store.get(2, digest, 'links'), None)
+        assert_raises(TypeError, self.store.put, '1', digest, 'text', '')
+
+    def test_other_contents(self):
+        self.store.put(1, self.store.digest(PAGE), 'text', 'a')
+        assert_equals(
+            self.store.get(1, self.store.digest(b'changed'), 'text'), None)
+
+    def test_cached(self):
+        calls = []
+        def make(data):
+            calls.append(data)
+            return {'length': len(data)}
+        for _ in range(2):
+            assert_equals(
+                self.store.cached(1, PAGE, 'size', make), {'length': len(PAGE)})
+        assert_equals(calls, [PAGE])
+        assert_equals(
+            self.store.stats(), {'artifacts': 1, 'hits': 1, 'misses': 1})
+        self.store.forget(1)
+        self.store.cached(1, PAGE, 'size', make)
+        assert_equals(len(calls), 2)
+
+    def test_kept(self):
+        self.store.put(1, self.store.digest(PAGE), 'text', 'a')
+        self.store.close()
+        self.store = archiver.ArtifactStore(self.path)
+        assert_equals(self.store.get(1, self.store.digest(PAGE), 'text'), 'a')
+
+    def test_other_version_dropped(self):
+        self.store.put(1, self.store.digest(PAGE), 'text', 'a')
+        self.store.close()
+        store = type('Store', (archiver.ArtifactStore,), {'version': archiver.ArtifactStore.version + 1})
+        self.store = store(self.path)
+        assert_equals(self.store.get(1, self.store.digest(PAGE), 'text'), None)
+
+class TestAnalyzerArtifacts(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.agent = archiver.Agent(
+            directory = self.directory, archive_folder = 'archives',
+            db = 'db', artifacts = True)
+        self.url = 'http://example.com/a'
+        fname = self.agent.db.set_filename(self.url)
+        self.path = self.agent.fh.get_path(fname)
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        with open(self.path, 'wb') as fobj:
+            fobj.write(PAGE)
+
+    def teardown(self):
+        self.agent.close()
+        shutil.rmtree(self.directory)
+
+    def test_parsed_once(self):
+        analyzer = self.agent.analyzer
+        for _ in range(2):
+            assert_equals(analyzer.find_text_in_page(self.url), 'a')
+            assert_equals(analyzer.find_encoding_of_page(self.url), 'utf-8')
+        assert_equals(self.agent.metrics['scan_parse_seconds'].count(), 1)
+        assert_true(os.path.isfile(self.agent.fh.db + '.artifacts'))
+        analyzer.find_links_in_page(self.url, 'ul', 'list_16', '')
+        assert_equals(self.agent.metrics['scan_parse_seconds'].count(), 2)
+
+    def test_changed_page_parsed_again(self):
+        analyzer = self.agent.analyzer
+        analyzer.find_text_in_page(self.url)
+        with open(self.path, 'wb') as fobj:
+            fobj.write(PAGE.replace(b'>a<', b'>b<'))
+        assert_equals(analyzer.find_text_in_page(self.url), 'b')
+
+    def test_other_parser_parses_again(self):
+        if archiver.etree is None: raise SkipTest
+        analyzer = self.agent.analyzer
+        for name in 'lxml', 'html.parser', 'lxml':
+            analyzer.parser = archiver.get_parser(name)
+            analyzer.find_text_in_page(self.url)
+        assert_equals(self.agent.metrics['scan_parse_seconds'].count(), 2)
@@ -0,0 +1,61 @@
+""" Test Bloom filters.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true, assert_false
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+class TestScalableBloomFilter(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_added_keys_are_found(self):
+        bloom = archiver.ScalableBloomFilter(capacity = 100, error_rate = 0.01)
+        keys = ['http://example.com/{}'.format(i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        assert_true(all(key in bloom for key in keys))
+        assert_true(len(bloom.filters) > 1)
+
+    def test_add_returns_whether_new(self):
+        bloom = archiver.ScalableBloomFilter()
+        assert_true(bloom.add('a'))
+        assert_false(bloom.add('a'))
+
+    def test_error_rate(self):
+        bloom = archiver.ScalableBloomFilter(capacity = 1000, error_rate = 0.01)
+        for i in range(5000):
+            bloom.add('in {}'.format(i))
+        found = sum('out {}'.format(i) in bloom for i in range(10000))
+        assert_true(found < 200)
+        assert_true(bloom.stats()['error_rate'] < 0.01)
+
+    def test_save_and_load(self):
+        bloom = archiver.ScalableBloomFilter(capacity = 10, error_rate = 0.01)
+        for i in range(100):
+            bloom.add(str(i))
+        bloom.mark = {'rowid': 100}
+        path = os.path.join(self.temp_dir, 'bloom')
+        bloom.save(path)
+        loaded = archiver.ScalableBloomFilter.load(path)
+        assert_equals(loaded.stats(), bloom.stats())
+        assert_equals(loaded.mark, {'rowid': 100})
+        assert_true(all(str(i) in loaded for i in range(100)))
+
+    def test_load_raises_ValueError(self):
+        path = os.path.join(self.temp_dir, 'bloom')
+        with open(path, 'wb') as f: f.write(b'Some contents')
+        assert_raises(ValueError, archiver.ScalableBloomFilter.load, path)
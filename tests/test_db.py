@@ -1,11 +1,16 @@
 """ Test DB
 
 """
+import os
+import sqlite3
 import tempfile
 import shutil
+import threading
+import time
 
 from nose.tools import assert_equals
 from nose.tools import assert_raises
+from nose.tools import assert_true
 
 import archiver
 
@@ -23,7 +28,8 @@ class TestDB():
 
     def setup(self):
         self.agent = archiver.Agent(
-            directory = self.temp_dir, archive_folder = 'archives', db = 'test.db')
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'test.db', backend = 'memory')
         self.db = self.agent.db
 
     def teardown(self):
@@ -63,3 +69,370 @@ class TestDB():
             cur = con.cursor()
             cur.execute('INSERT INTO file_names (url) VALUES ("wikipedia.org")')
             assert_raises(KeyError, self.db.get_filename, 'uncyclopedia.org')
+
+    def test_validators(self):
+        url = 'wikipedia.org'
+        self.db.set_validators(url, etag = '"abc"', content_length = 10)
+        validators = self.db.get_validators(url)
+        assert_equals(validators['etag'], '"abc"')
+        assert_equals(validators['last_modified'], None)
+        assert_equals(validators['content_length'], 10)
+
+    def test_get_validators_unknown_url(self):
+        assert_equals(self.db.get_validators('wikipedia.org'), None)
+
+    def test_schedule_retry(self):
+        url = 'wikipedia.org'
+        assert_equals(self.db.schedule_retry(url, 'timeout', delay = 0), 1)
+        assert_equals(self.db.schedule_retry(url, 'timeout', delay = 0), 2)
+        assert_equals(self.db.get_due_retries(max_attempts = 3), [url])
+        assert_equals(self.db.get_due_retries(max_attempts = 2), [])
+        self.db.clear_retry(url)
+        assert_equals(self.db.get_retry(url), None)
+
+    def test_retry_not_due(self):
+        self.db.schedule_retry('wikipedia.org', 'fail', delay = 60)
+        assert_equals(self.db.get_due_retries(max_attempts = 5), [])
+
+    def test_add_content_shares_file(self):
+        first = self.db.set_filename('wikipedia.org')
+        second = self.db.set_filename('www.wikipedia.org')
+        assert_equals(self.db.add_content('wikipedia.org', 'abc', first), first)
+        assert_equals(
+            self.db.add_content('www.wikipedia.org', 'abc', second), first)
+        assert_equals(self.db.get_filename('www.wikipedia.org'), first)
+        assert_equals(self.db.get_own_filename('www.wikipedia.org'), second)
+        assert_equals(self.db.is_shared('wikipedia.org'), True)
+
+    def test_content_scanned(self):
+        first = self.db.set_filename('wikipedia.org')
+        second = self.db.set_filename('www.wikipedia.org')
+        self.db.add_content('wikipedia.org', 'abc', first)
+        self.db.add_content('www.wikipedia.org', 'abc', second)
+        assert_equals(self.db.content_scanned('www.wikipedia.org'), False)
+        self.db.set_scanned('wikipedia.org')
+        assert_equals(self.db.content_scanned('www.wikipedia.org'), True)
+
+    def test_add_content_forgets_old_contents(self):
+        fname = self.db.set_filename('wikipedia.org')
+        self.db.add_content('wikipedia.org', 'abc', fname)
+        self.db.add_content('wikipedia.org', 'def', fname)
+        other = self.db.set_filename('www.wikipedia.org')
+        assert_equals(
+            self.db.add_content('www.wikipedia.org', 'abc', other), other)
+
+    def test_claim_urls_disjoint(self):
+        self.db.add_to_frontier(['a', 'b', 'c'])
+        first = self.db.claim_urls('worker-1', batch_size = 2)
+        second = self.db.claim_urls('worker-2', batch_size = 2)
+        assert_equals(len(first), 2)
+        assert_equals(sorted(first + second), ['a', 'b', 'c'])
+        assert_equals(self.db.claim_urls('worker-3'), [])
+
+    def test_claim_urls_by_priority(self):
+        self.db.add_to_frontier(['article'])
+        self.db.add_to_frontier(['seed'], priority = 1)
+        assert_equals(self.db.claim_urls('worker', batch_size = 1), ['seed'])
+
+    def test_claim_urls_after_lease_expires(self):
+        self.db.add_to_frontier(['a'])
+        assert_equals(self.db.claim_urls('worker-1', lease = -1), ['a'])
+        assert_equals(self.db.claim_urls('worker-2'), ['a'])
+        self.db.complete_urls('worker-1', ['a'])
+        assert_equals(self.db.get_frontier_size(), 1)
+        self.db.complete_urls('worker-2', ['a'])
+        assert_equals(self.db.get_frontier_size(), 0)
+
+    def test_defer_urls(self):
+        self.db.add_to_frontier(['a', 'b'])
+        self.db.claim_urls('worker-1')
+        assert_equals(self.db.get_next_deferred(), None)
+        self.db.defer_urls('worker-1', [('a', time.time() + 60)])
+        self.db.release_urls('worker-1')
+        assert_equals(self.db.claim_urls('worker-2'), ['b'])
+        assert_true(self.db.get_next_deferred() > time.time())
+        self.db.defer_urls('worker-2', [('b', time.time() - 1)])
+        assert_equals(self.db.claim_urls('worker-3'), ['b'])
+
+    def test_release_urls(self):
+        self.db.add_to_frontier(['a'])
+        self.db.claim_urls('worker-1')
+        self.db.release_urls('worker-1')
+        assert_equals(self.db.claim_urls('worker-2'), ['a'])
+
+    def test_connection_is_kept(self):
+        assert_true(self.db.connect() is self.db.connect())
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(
+            target = lambda: connections.append(self.db.connect()))
+        thread.start()
+        thread.join()
+        assert_true(connections[0] is not self.db.connect())
+
+    def test_wal_mode(self):
+        agent = archiver.Agent(
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'file.db')
+        try:
+            mode = agent.db.connect().execute('PRAGMA journal_mode').fetchone()
+            assert_equals(mode, ('wal',))
+        finally:
+            agent.close()
+            os.remove(agent.fh.db)
+
+    def test_memory_backend_has_no_file(self):
+        self.db.set_filename('wikipedia.org')
+        assert_equals(os.path.exists(self.agent.fh.db), False)
+
+    def test_memory_backend_is_shared_by_threads(self):
+        self.db.set_filename('wikipedia.org')
+        filenames = []
+        thread = threading.Thread(target = lambda: filenames.append(
+            self.db.get_own_filename('wikipedia.org')))
+        thread.start()
+        thread.join()
+        assert_equals(filenames, ['000001'])
+
+    def test_backend_raises_ValueError(self):
+        assert_raises(
+            ValueError, archiver.Agent, directory = self.temp_dir,
+            archive_folder = 'archives', db = 'test.db', backend = 'x')
+
+    def test_bulk_load(self):
+        with self.db.bulk_load():
+            self.db.seed_archive(['http://example.com/'])
+            synchronous = self.db.connect().execute(
+                'PRAGMA synchronous').fetchone()
+        assert_equals(synchronous, (0,))
+        assert_equals(self.db.get_seeds(), {'http://example.com/'})
+        synchronous = self.db.connect().execute('PRAGMA synchronous').fetchone()
+        assert_equals(synchronous, (1,))
+
+    def test_write_behind_is_flushed(self):
+        self.db.seed_archive(['a', 'b'])
+        self.db.update_fetched('a')
+        self.db.flush()
+        with self.db.connect() as con:
+            cur = con.cursor()
+            cur.execute('SELECT link FROM links WHERE fetched = 1')
+            assert_equals(cur.fetchall(), [('a',)])
+
+    def test_listing_flushes_writes(self):
+        self.db.seed_archive(['a', 'b'])
+        self.db.update_fetched('a')
+        assert_equals(self.db.get_unfetched_seeds(), {'b'})
+
+    def test_pending_four_o_four(self):
+        self.db.write_interval = 60
+        self.db.set_four_o_four('a')
+        assert_equals(self.db.is_four_o_four('a'), True)
+        self.db.flush()
+        assert_equals(self.db.is_four_o_four('a'), True)
+        assert_equals(self.db.get_four_o_fours(), ['a'])
+
+    def test_failed_write_raises_on_flush(self):
+        self.db.set_filename('a')
+        with self.db.connect() as con:
+            con.execute('DROP VIEW file_names')
+            con.execute('DROP TABLE pages')
+        self.db.set_scanned('a')
+        assert_raises(sqlite3.OperationalError, self.db.flush)
+        self.db.flush()
+
+    def test_schema_version(self):
+        with self.db.connect() as con:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+        assert_equals(version, len(archiver.database.MIGRATIONS))
+
+    def test_set_filename_twice_raises_IntegrityError(self):
+        self.db.set_filename('wikipedia.org')
+        assert_raises(
+            sqlite3.IntegrityError, self.db.set_filename, 'wikipedia.org')
+
+    def test_migrate_first_version(self):
+        path = os.path.join(self.temp_dir, 'old.db')
+        with sqlite3.connect(path) as con:
+            con.execute(
+                'CREATE TABLE file_names(url VARCHAR(255) NOT NULL,'
+                'ID INTEGER PRIMARY KEY AUTOINCREMENT,'
+                'scanned INT DEFAULT 0, four_o_four INT DEFAULT 0)')
+            con.execute(
+                'CREATE TABLE links(url VARCHAR(255) NOT NULL,'
+                'link VARCHAR(255) NOT NULL, fetched INT DEFAULT 0,'
+                'UNIQUE(url, link) ON CONFLICT IGNORE)')
+            con.execute(
+                'INSERT INTO file_names (url, four_o_four) VALUES ("a", 1)')
+            con.execute('INSERT INTO file_names (url) VALUES ("a")')
+            con.execute('INSERT INTO file_names (url) VALUES ("b")')
+            con.execute('DELETE FROM file_names WHERE url = "b"')
+            con.execute('INSERT INTO links VALUES ("seed", "a", 1)')
+            con.execute('INSERT INTO links VALUES ("seed", "b", 0)')
+            con.execute('INSERT INTO links VALUES ("a", "c", 0)')
+        con.close()
+        agent = archiver.Agent(
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'old.db')
+        try:
+            # Duplicate urls are gone, the fetched page is kept:
+            assert_equals(agent.db.get_filename('a'), '000002')
+            assert_equals(agent.db.is_four_o_four('a'), False)
+            # File names are not given out twice:
+            assert_equals(agent.db.set_filename('b'), '000004')
+            assert_equals(
+                agent.db.get_all_links(), [('a',), ('b',), ('c',)])
+            assert_equals(agent.db.get_unfetched_seeds(), {'b'})
+            assert_equals(agent.db.get_unfetched_links(), {'c'})
+        finally:
+            agent.close()
+            os.remove(path)
+
+    def test_four_o_four_of_archived_url(self):
+        self.db.set_filename('a')
+        self.db.set_four_o_four('a')
+        assert_equals(self.db.get_four_o_fours(), ['a'])
+
+    def test_get_filename_is_cached(self):
+        fname = self.db.set_filename('wikipedia.org')
+        hits = self.db.filename_cache.hits
+        assert_equals(self.db.get_filename('wikipedia.org'), fname)
+        assert_equals(self.db.filename_cache.hits, hits + 1)
+
+    def test_rm_filename_forgets_cached_filenames(self):
+        first = self.db.set_filename('wikipedia.org')
+        second = self.db.set_filename('www.wikipedia.org')
+        self.db.add_content('wikipedia.org', 'abc', first)
+        self.db.add_content('www.wikipedia.org', 'abc', second)
+        assert_equals(self.db.get_filename('www.wikipedia.org'), first)
+        self.db.rm_filename('wikipedia.org')
+        assert_equals(self.db.get_filename('www.wikipedia.org'), second)
+        assert_raises(KeyError, self.db.get_filename, 'wikipedia.org')
+
+    def test_rm_filename_keeps_other_cached_filenames(self):
+        other = self.db.set_filename('example.com')
+        self.db.set_filename('wikipedia.org')
+        self.db.get_filename('example.com')
+        self.db.rm_filename('wikipedia.org')
+        hits = self.db.filename_cache.hits
+        assert_equals(self.db.get_filename('example.com'), other)
+        assert_equals(self.db.filename_cache.hits, hits + 1)
+
+    def test_four_o_four_is_cached(self):
+        self.db.set_filename('wikipedia.org')
+        self.db.set_four_o_four('wikipedia.org')
+        misses = self.db.four_o_four_cache.misses
+        assert_equals(self.db.is_four_o_four('wikipedia.org'), True)
+        assert_equals(self.db.four_o_four_cache.misses, misses)
+
+    def test_lru_cache_drops_least_recently_used(self):
+        cache = archiver.LRUCache(maxsize = 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert_equals(cache.get('b'), None)
+        assert_equals(cache.get('a'), 1)
+        assert_equals(cache.stats(), {'hits': 2, 'misses': 1, 'size': 2})
+
+    def test_register_links_are_canonical(self):
+        self.db.register_links(
+            'http://example.com/a/b.html',
+            ['c.html', '../a/c.html#top', 'HTTP://EXAMPLE.COM/a/c.html',
+             '/d.html'])
+        assert_equals(
+            self.db.get_all_links(),
+            [('http://example.com/a/c.html',), ('http://example.com/d.html',)])
+
+    def test_register_links_skips_the_page_itself(self):
+        self.db.register_links(
+            'http://example.com/a/b.html',
+            ['#', '#top', 'b.html', '', 'c.html'])
+        assert_equals(
+            self.db.get_all_links(), [('http://example.com/a/c.html',)])
+
+    def test_register_links_keeps_malformed_links(self):
+        self.db.register_links(
+            'http://example.com/a/b.html',
+            ['c.html', 'http://a.com:abc/x', 'http://[bad/x', '/d.html'])
+        assert_equals(
+            self.db.get_all_links(),
+            [('http://example.com/a/c.html',), ('http://a.com:abc/x',),
+             ('http://[bad/x',), ('http://example.com/d.html',)])
+
+    def test_iter_unfetched_links_pages(self):
+        self.db.seed_archive(['http://example.com/'])
+        links = ['http://example.com/{}'.format(i) for i in range(10)]
+        self.db.register_links('http://example.com/', links)
+        self.db.register_links('http://example.com/0', links[:5])
+        self.db.update_fetched(links[0])
+        assert_equals(
+            list(self.db.iter_unfetched_links(page_size = 3)), links[1:])
+
+    def test_iter_unscanned_pages(self):
+        urls = ['http://example.com/{}'.format(i) for i in range(5)]
+        self.db.seed_archive(urls)
+        for url in urls: self.db.set_filename(url)
+        self.db.set_scanned(urls[2])
+        assert_equals(
+            list(self.db.iter_unscanned(page_size = 2)),
+            urls[:2] + urls[3:])
+
+    def test_iter_fetched_articles_once(self):
+        self.db.register_links('a', ['b'])
+        self.db.register_links('c', ['b'])
+        self.db.set_filename('b')
+        assert_equals(list(self.db.iter_fetched_articles()), ['b'])
+
+    def test_bloom_skips_seen_links(self):
+        self.db.bloom = True
+        self.db.register_links('a', ['b', 'c'])
+        self.db.register_links('d', ['b', 'e'])
+        assert_equals(
+            self.db.get_all_links(), [('b',), ('c',), ('e',)])
+        assert_equals(self.db.bloom_stats()['count'], 3)
+
+    def test_bloom_is_saved_and_caught_up(self):
+        agent = archiver.Agent(
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'bloom.db')
+        try:
+            agent.db.bloom = True
+            agent.db.register_links('a', ['b'])
+            agent.db.close()
+            assert_true(os.path.isfile(agent.db.bloom_path()))
+            # Stored by another process, without the filter:
+            agent.db.bloom = False
+            agent.db.register_links('a', ['c'])
+            agent.db.bloom = True
+            agent.db.register_links('d', ['b', 'c', 'e'])
+            assert_equals(
+                agent.db.get_all_links(), [('b',), ('c',), ('e',)])
+        finally:
+            agent.close()
+            os.remove(agent.fh.db)
+            os.remove(agent.db.bloom_path())
+
+    def test_bloom_saved_with_links_of_other_processes(self):
+        agent = archiver.Agent(
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'bloom.db')
+        other = archiver.Agent(
+            directory = self.temp_dir, archive_folder = 'archives',
+            db = 'bloom.db')
+        try:
+            agent.db.bloom = True
+            agent.db.register_links('a', ['b'])
+            agent.db.flush()
+            # Stored by another process while the filter is loaded:
+            other.db.register_links('a', ['c'])
+            other.db.flush()
+            agent.db.close()
+            agent.db.register_links('d', ['b', 'c', 'e'])
+            assert_equals(
+                agent.db.get_all_links(), [('b',), ('c',), ('e',)])
+        finally:
+            other.close()
+            agent.close()
+            os.remove(agent.fh.db)
+            os.remove(agent.db.bloom_path())
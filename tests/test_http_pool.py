@@ -0,0 +1,135 @@
+""" Test pooled HTTP connections.
+
+"""
+
+import gzip
+import http.server
+import threading
+import urllib.error
+import zlib
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/page')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        if self.path != '/page':
+            self.send_error(404)
+            return
+        body = 'port {}'.format(self.client_address[1]).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestHTTPPool(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setup(self):
+        self.pool = archiver.HTTPPool(maxsize = 2)
+
+    def teardown(self):
+        self.pool.close()
+
+    def fetch(self, path):
+        with self.pool.urlopen(self.url + path) as response:
+            return response.read()
+
+    def test_connection_is_reused(self):
+        first = self.fetch('/page')
+        assert_equals(self.pool.idle_count(), 1)
+        assert_equals(self.fetch('/page'), first)
+
+    def test_redirect_is_followed(self):
+        assert_equals(self.fetch('/moved'), self.fetch('/page'))
+
+    def test_not_modified_is_returned(self):
+        response = self.pool.urlopen(
+            self.url + '/page', headers = {'If-None-Match': '"v1"'})
+        with response:
+            assert_equals(response.status, 304)
+            assert_equals(response.read(), b'')
+
+    def test_404_raises_HTTPError(self):
+        assert_raises(urllib.error.HTTPError, self.fetch, '/missing')
+
+    def test_idle_connections_are_evicted(self):
+        self.fetch('/page')
+        self.pool.idle_timeout = 0
+        self.pool.evict_idle()
+        assert_equals(self.pool.idle_count(), 0)
+
+    def test_unsupported_url_raises_URLError(self):
+        assert_raises(
+            urllib.error.URLError, self.pool.urlopen, 'ftp://example.com')
+
+    def test_url_raises_TypeError(self):
+        assert_raises(TypeError, self.pool.urlopen, 1)
+
+class TestDecoder(object):
+
+    data = b'<html>' + 1000 * b'text ' + b'</html>'
+
+    def decode(self, decoder, data):
+        return b''.join(
+            decoder.decode(data[i:i+100]) for i in range(0, len(data), 100)
+        ) + decoder.flush()
+
+    def test_gzip(self):
+        decoder = archiver.Decoder('gzip')
+        assert_equals(self.decode(decoder, gzip.compress(self.data)), self.data)
+
+    def test_deflate(self):
+        decoder = archiver.Decoder('deflate')
+        assert_equals(self.decode(decoder, zlib.compress(self.data)), self.data)
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(wbits = -zlib.MAX_WBITS)
+        data = compressor.compress(self.data) + compressor.flush()
+        decoder = archiver.Decoder('deflate')
+        assert_equals(self.decode(decoder, data), self.data)
+
+    def test_identity(self):
+        assert_equals(self.decode(archiver.Decoder(), self.data), self.data)
+
+    def test_unknown_raises_ValueError(self):
+        assert_raises(ValueError, archiver.Decoder, 'compress')
+
+    def test_corrupt_raises_DecodeError(self):
+        assert_raises(
+            archiver.DecodeError, self.decode, archiver.Decoder('gzip'),
+            self.data)
+        assert_raises(
+            archiver.DecodeError, self.decode, archiver.Decoder('deflate'),
+            b'\xff' * 100)
@@ -0,0 +1,137 @@
+""" Test crawl metrics.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.metrics = archiver.Metrics()
+
+    def test_counter(self):
+        counter = self.metrics.counter('requests', 'Requests.', ('host',))
+        counter.inc(host = 'a')
+        counter.inc(2, host = 'b')
+        assert_equals(counter.value(host = 'a'), 1)
+        assert_equals(counter.value(), 3)
+        assert_raises(ValueError, counter.inc, -1, host = 'a')
+        assert_raises(ValueError, counter.inc)
+        assert_raises(ValueError, counter.inc, other = 'a')
+
+    def test_registered_once(self):
+        counter = self.metrics.counter('requests', 'Requests.')
+        assert_true(self.metrics.counter('requests', 'Requests.') is counter)
+        assert_raises(
+            ValueError, self.metrics.histogram, 'requests', 'Requests.')
+        assert_raises(
+            ValueError, self.metrics.counter, 'requests', 'Requests.',
+            ('host',))
+
+    def test_histogram(self):
+        histogram = self.metrics.histogram(
+            'seconds', 'Seconds.', buckets = (1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        assert_equals(histogram.count(), 4)
+        assert_equals(histogram.sum(), 6)
+        with histogram.time():
+            pass
+        assert_equals(histogram.count(), 5)
+
+    def test_render(self):
+        self.metrics.counter('requests_total', 'Requests.', ('host',)).inc(
+            host = 'a"b')
+        histogram = self.metrics.histogram(
+            'seconds', 'Seconds.', buckets = (1, 2))
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(3)
+        assert_equals(self.metrics.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{host="a\\"b"} 1',
+            '# HELP seconds Seconds.',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="1"} 1',
+            'seconds_bucket{le="2"} 2',
+            'seconds_bucket{le="+Inf"} 3',
+            'seconds_sum 5',
+            'seconds_count 3',
+        ]) + '\n')
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics.prom')
+            self.metrics.counter('requests_total', 'Requests.').inc()
+            self.metrics.write(path)
+            with open(path) as fobj:
+                assert_equals(fobj.read(), self.metrics.render())
+            assert_equals(os.listdir(directory), ['metrics.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_summary(self):
+        counter = self.metrics.counter('requests_total', 'Requests.')
+        self.metrics.histogram('seconds', 'Seconds.').observe(2)
+        assert_equals(self.metrics.summary(), 'seconds 1 (avg 2)')
+        counter.inc(5)
+        assert_true(self.metrics.summary().startswith('requests_total 5 ('))
+
+    def test_reporter(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics.prom')
+            self.metrics.start_reporter(interval = 60, path = path)
+            self.metrics.counter('requests_total', 'Requests.').inc()
+            self.metrics.stop_reporter()
+            with open(path) as fobj:
+                assert_true('requests_total 1' in fobj.read())
+        finally:
+            shutil.rmtree(directory)
+
+class TestInstrumented(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.agent = archiver.Agent(
+            directory = self.directory, archive_folder = 'archives',
+            db = 'db', backend = 'memory')
+
+    def teardown(self):
+        self.agent.close()
+        shutil.rmtree(self.directory)
+
+    def test_db_queries(self):
+        self.agent.db.seed_archive(['http://example.com/a'])
+        self.agent.db.get_seeds()
+        metrics = self.agent.metrics
+        assert_true(metrics['db_queries_total'].value(op = 'SELECT') > 0)
+        assert_true(metrics['db_queries_total'].value(op = 'INSERT') > 0)
+        assert_equals(
+            metrics['db_query_seconds'].count(),
+            metrics['db_queries_total'].value())
+
+    def test_scan(self):
+        url = 'http://example.com/a'
+        fname = self.agent.db.set_filename(url)
+        path = self.agent.fh.get_path(fname)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as fobj:
+            fobj.write(b'<a href="/b">b</a><a href="/c">c</a>')
+        self.agent.analyzer.find_links_in_page(url)
+        metrics = self.agent.metrics
+        assert_equals(metrics['scan_parse_seconds'].count(), 1)
+        assert_equals(metrics['scan_links_per_page'].count(), 1)
+        assert_equals(metrics['scan_links_per_page'].sum(), 2)
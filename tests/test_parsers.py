@@ -0,0 +1,219 @@
+""" Test the parsers of pages, and that they agree.
+
+"""
+
+from bs4 import BeautifulSoup as bs
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+ARTICLE = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta http-equiv="content-type" content="text/html;charset={charset}"/>
+<meta name="publishdate" content="2016-03-31">
+<meta name="contentid" content="28241876">
+<meta name="catalogs" content="70731">
+<meta name="keywords" content="">
+<title>习近平会见 -- 时政 -- 人民网</title>
+<link href="/img/2011pol/page.css" type="text/css" rel="stylesheet" />
+<script type="text/javascript">
+var a = '<a href="/not/a/link.html">';
+if (a < 2 && a > 1) {{ document.write("</div>"); }}
+</script>
+<style>.list_16 li {{ font-size: 16px; }}</style>
+</head>
+<body>
+<!--header-->
+<div class="nav"><a href="http://www.people.com.cn/">人民网</a>&gt;&gt;
+<a href="http://politics.people.com.cn/" target="_blank">时政</a></div>
+<div class="clearfix w1000_320 text_title">
+  <h1>习近平会见&nbsp;美国总统</h1>
+  <p class="box01"><a href="http://www.people.com.cn/" target="_blank">人民网</a>
+  2016年03月31日 23:15&nbsp;&nbsp;来源：<a href='http://www.people.com.cn/' target=_blank>人民网-人民日报</a></p>
+</div>
+<div class="box_con" id="rwb_zw">
+	<p>　　新华社华盛顿3月31日电（记者 霍小光）国家主席习近平31日在华盛顿会见。</p>
+	<p>　　习近平指出，中美两国&amp;世界……</p>
+	<p style="text-align: center"><img src="/img/1.jpg" alt="图"></p>
+	<table><tr><td>表格<td>第二格</tr></table>
+	<p>字号：<a href="javascript:void(0)" onclick="doZoom(16)">大</a>
+	<a href = " /n1/2016/0331/c1024-28241876.html ">相关</a>
+	<a name="anchor">无链接</a><a href>空链接</a></p>
+</div>
+<ul class="list_16 mt10" id="news">
+	<li><a href="/n/2016/0331/c1001-28241875.html">第一条</a><i>2016-03-31</i></li>
+	<li><a href="/n/2016/0330/c1001-28240001.html">第二条 &lt;新&gt;</a></li>
+	<li><a href="/n/2016/0329/c1001-28237777.html"><b>第三条</b></a>
+</ul>
+<template><a href="/template.html">模板</a></template>
+<p>拼音：<ruby>漢<rp>(</rp><rt>hàn</rt><rp>)</rp></ruby>字</p>
+<noscript><a href="/noscript.html">noscript</a></noscript>
+<div class="footer">版权所有&copy;人民网</div>
+<script src="/js/foot.js"></script>
+</body>
+</html>
+'''
+
+INDEX = b'''<html>
+<head><meta charset="utf-8"><title>review</title></head>
+<body>
+<div class="ej_left">
+<ul class="list_16">
+<li><a href="/GB/70731/review/20160401.html">01</a></li>
+<li><a href=/GB/70731/review/20160402.html>02</a></li>
+<li><A HREF="/GB/70731/review/20160403.html">03</A></li>
+</ul>
+<ul class="list_16"><li><a href="/second.html">second list</a></li></ul>
+</div>
+<div id="page"><a href="?page=2">next</a></div>
+</body></html>
+'''
+
+SAMPLES = [
+    ARTICLE.format(charset = 'gb2312').encode('gbk'),
+    ARTICLE.format(charset = 'utf-8').encode('utf-8'),
+    ARTICLE.format(charset = 'utf-8'),
+    INDEX,
+    b'<p>A page <a href="/a">without</a> html, head or body.</p>',
+    b'<ul class="list_16"><li><a href="/open">unclosed list<li>next',
+    b'<p class="" id="">empty <a href="/empty">class and id</a></p>',
+    b'<?xml version="1.0" encoding="utf-8"?><p><a href="/xml">xml</a></p>',
+    b'<p>cdata <![CDATA[kept]]> by <a href="/cdata">html.parser</a></p>',
+    b'Just some text.\r\nOn two lines.',
+    b'',
+]
+
+# Markup libxml2 and html.parser read differently.
+DIFFERENT = [
+    b'<a href="/first" HREF="/last" class="t" class="u">dup</a>',
+    b'<meta name="a" name="b" content="c">',
+    b'<title><a href="/t">title</a></title>'
+    b'<textarea><a href="/in">x</a></textarea><a href="/out">o</a>',
+    b'<iframe><a href="/i">i</a></iframe><xmp><a href="/x">x</a></xmp>',
+    b'<p>carriage</p> \r <p>return</p>',
+]
+
+# Whitespace BeautifulSoup shortens, and keeps in pre and textarea.
+WHITESPACE = (
+    b'<p>a  b</p>\n<p>c</p>  <div> d\t e </div>\t<span>f</span>'
+    b'<pre>  g\n\n  h </pre>  <pre><b>i</b>  <i>j</i></pre>'
+    b'<textarea>  </textarea><!-- k -->  <p>l</p>')
+
+# Markup where BeautifulSoup's way of opening and closing tags counts.
+NESTING = [
+    b'<div><ul class="t" id="i"><li><a href="/in">in</div><a href="/out">o',
+    b'<ul class="t" id="i"><li><a href="/1">1<li><a href="/2">2</ul>'
+    b'<a href="/3">3',
+    b'<ul class="t" id="i"><br></br><a href="/1">1</br></ul><a href="/2">',
+    b'<ul class="t" id="i"/><a href="/1">1</a></ul><a href="/2">2',
+    b'<img class="t" id="i"><a href="/1">1</a>',
+    b'<a class="t" id="i" href="/self"><a href="/nested">n</a></a>',
+    b'<a href="/first" href="/last">dup</a><p class="t" id="i"></p>',
+    b'<ul class="t" id="i"><li></p></span><a href="/1">1</li></ul>'
+    b'<a href="/2">',
+    b'<p class="t" id="i"><script>"<a href=/no></p>"</script>'
+    b'<a href="/yes">y</a></p>',
+    b'<ul class="t" id="i"><a href="/unclosed"',
+]
+
+# (target_element, target_class, target_id)
+TARGETS = [
+    ('', '', ''),
+    ('ul', 'list_16', ''),
+    ('ul', 'list_16', 'news'),
+    ('ul', 'mt10', 'news'),
+    ('ul', 'list_16 mt10', 'news'),
+    ('div', 'box_con', 'rwb_zw'),
+    ('p', '', ''),
+    ('a', 'x', 'y'),
+]
+
+def soup_links(data, element, class_, id_):
+    """Links as find_links_in_page found them with BeautifulSoup."""
+    soup = bs(data, 'html.parser')
+    target = soup.find(element, class_ = class_, id = id_)
+    if target is None: target = soup
+    return [a.attrs['href'] for a in target.find_all('a') if a.has_attr('href')]
+
+def test_link_extractor():
+    for data in SAMPLES + NESTING:
+        for target in TARGETS + [('ul', 't', 'i'), ('p', 't', 'i'),
+                                 ('img', 't', 'i'), ('a', 't', 'i')]:
+            assert_equals(
+                archiver.LinkExtractor(*target).extract(data),
+                soup_links(data, *target))
+
+def test_parity():
+    if archiver.etree is None: raise SkipTest
+    soup = archiver.SoupParser()
+    lxml = archiver.LxmlParser()
+    for data in SAMPLES + DIFFERENT + [WHITESPACE]:
+        for target in TARGETS + [('a', 't', '')]:
+            assert_equals(lxml.links(data, *target), soup.links(data, *target))
+        assert_equals(lxml.text(data), soup.text(data))
+        assert_equals(
+            lxml.meta(data, ['windows-1252']),
+            soup.meta(data, ['windows-1252']))
+
+def test_lxml_reads_whitespace():
+    if archiver.etree is None: raise SkipTest
+    lxml = archiver.LxmlParser()
+    assert_true(lxml._root(WHITESPACE) is not None)
+    assert_equals(lxml.text(WHITESPACE), 'a  b\nc  d\t e  f  g\nh  i  j   l')
+
+def test_get_parser():
+    assert_equals(archiver.get_parser('html.parser').name, 'html.parser')
+    assert_equals(
+        archiver.get_parser().name,
+        'html.parser' if archiver.etree is None else 'lxml')
+    assert_raises(ValueError, archiver.get_parser, 'html5lib')
+
+def test_lines():
+    assert_equals(archiver.lines('\n a \t\n\r\n b\xa0 c \n'), 'a\nb\xa0 c')
+
+def test_matches():
+    attrs = {'class': 'list_16  mt10', 'id': 'news'}
+    assert_equals(archiver.matches('ul', attrs, 'ul', 'mt10', 'news'), True)
+    assert_equals(
+        archiver.matches('ul', attrs, 'ul', 'list_16 mt10', 'news'), True)
+    assert_equals(
+        archiver.matches('ul', attrs, 'ul', 'list_16  mt10', 'news'), False)
+    assert_equals(archiver.matches('ul', attrs, 'ul', 'mt10', ''), False)
+    assert_equals(archiver.matches('ul', attrs, '', 'mt10', 'news'), False)
+    assert_equals(
+        archiver.matches('p', {'class': '', 'id': ''}, 'p', '', ''), True)
+    assert_equals(archiver.matches('p', {}, 'p', '', ''), False)
+
+class TestSoupParser(object):
+
+    parser = archiver.SoupParser()
+
+    def test_links(self):
+        assert_equals(
+            self.parser.links(INDEX, 'ul', 'list_16', ''),
+            ['/GB/70731/review/20160401.html', '/GB/70731/review/20160402.html',
+             '/GB/70731/review/20160403.html', '/second.html', '?page=2'])
+        data = ARTICLE.format(charset = 'utf-8')
+        assert_equals(
+            self.parser.links(data, 'ul', 'list_16', 'news'),
+            ['/n/2016/0331/c1001-28241875.html',
+             '/n/2016/0330/c1001-28240001.html',
+             '/n/2016/0329/c1001-28237777.html'])
+
+    def test_text(self):
+        text = self.parser.text(ARTICLE.format(charset = 'utf-8'))
+        assert_equals(text.split('\n')[0], '习近平会见 -- 时政 -- 人民网')
+        assert_equals('var a' in text or 'font-size' in text, False)
+        assert_equals('模板' in text or 'hàn' in text, False)
+
+    def test_meta(self):
+        metas = self.parser.meta(ARTICLE.format(charset = 'gb2312').encode(
+            'gbk'), ['windows-1252'])
+        assert_equals(metas[3], {'name': 'catalogs', 'content': '70731'})
@@ -0,0 +1,113 @@
+""" Test profiling of runs.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert_equals(archiver.percentile(values, 50), 50)
+    assert_equals(archiver.percentile(values, 99), 99)
+    assert_equals(archiver.percentile([3], 95), 3)
+    assert_equals(archiver.percentile([], 50), None)
+
+class TestProfiler(object):
+
+    def test_off(self):
+        profiler = archiver.Profiler()
+        with profiler.span('fetch'):
+            pass
+        with profiler.stage('load'):
+            pass
+        assert_equals(profiler.stats(), {})
+
+    def test_mode_raises_ValueError(self):
+        assert_raises(ValueError, archiver.Profiler, 'sampling')
+
+    def test_spans(self):
+        profiler = archiver.Profiler('spans')
+        for _ in range(3):
+            with profiler.span('fetch'):
+                pass
+        assert_raises(KeyError, self._fail, profiler)
+        stats = profiler.stats()
+        assert_equals(stats['fetch']['count'], 3)
+        assert_equals(stats['parse']['count'], 1)
+        assert_true(stats['fetch']['p50'] <= stats['fetch']['p99'])
+        assert_equals(profiler.profiles, {})
+
+    @staticmethod
+    def _fail(profiler):
+        with profiler.span('parse'):
+            raise KeyError
+
+    def test_samples_are_capped(self):
+        span = archiver.Span('fetch')
+        span.max_samples = 10
+        for i in range(100):
+            span.add(i)
+        assert_equals(span.count, 100)
+        assert_equals(len(span.samples), 10)
+        assert_equals(span.stats()['mean'], 49.5)
+
+    def test_cprofile(self):
+        profiler = archiver.Profiler('cprofile')
+        with profiler.stage('load'):
+            with profiler.stage('inner'):
+                sorted(range(1000))
+        assert_equals(list(profiler.profiles), ['load'])
+        assert_equals(profiler.stats()['inner']['count'], 1)
+        report = profiler.report()
+        assert_true('cProfile of load:' in report)
+        assert_true('sorted' in report)
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = archiver.Profiler('cprofile')
+            with profiler.stage('load'):
+                pass
+            profiler.write(os.path.join(directory, 'profile.txt'))
+            assert_equals(
+                sorted(os.listdir(directory)),
+                ['profile-load.prof', 'profile.txt'])
+        finally:
+            shutil.rmtree(directory)
+
+class TestAgentProfile(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.agent = archiver.Agent(
+            directory = self.directory, archive_folder = 'archives',
+            db = 'db', backend = 'memory', profile = 'spans')
+
+    def teardown(self):
+        self.agent.close()
+        shutil.rmtree(self.directory)
+
+    def test_stages(self):
+        url = 'http://example.com/a'
+        self.agent.db.seed_archive([url])
+        fname = self.agent.db.set_filename(url)
+        path = self.agent.fh.get_path(fname)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as fobj:
+            fobj.write(b'<a href="/b">b</a>')
+        self.agent.find_links_in_archive()
+        stats = self.agent.profiler.stats()
+        assert_equals(
+            sorted(stats),
+            ['find_links_in_archive', 'parse', 'save_links', 'scan'])
+        assert_true(
+            stats['scan']['total'] <= stats['find_links_in_archive']['total'])
@@ -0,0 +1,131 @@
+""" Test scanning the archive for links in a pool of processes.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+ROOT = 'http://example.com/'
+
+def page(i):
+    return (
+        '<ul class="list_16"><li><a href=" /a/{0}.html ">{0}</a></li>'
+        '<li><a href="/b/{1}.html">{1}</a></li></ul>'
+        '<a href="/outside.html">outside</a>'.format(i, i % 3)).encode()
+
+class TestScan(object):
+
+    def setup(self):
+        self.directories = []
+
+    def teardown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def _agent(self, pages, **kwargs):
+        """Agent with pages (url: contents, None for no file) fetched."""
+        directory = tempfile.mkdtemp()
+        self.directories.append(directory)
+        agent = archiver.Agent(
+            directory = directory, archive_folder = 'archives', db = 'db',
+            **kwargs)
+        agent.db.seed_archive(list(pages))
+        for url, data in pages.items():
+            fname = agent.db.set_filename(url)
+            if data is None:
+                continue
+            fname = agent.db.add_content(
+                url, archiver.ArtifactStore.digest(data), fname)
+            path = agent.fh.get_path(fname)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, 'wb') as fobj:
+                fobj.write(data)
+        return agent
+
+    @staticmethod
+    def _scanned(agent):
+        agent.db.flush()
+        with agent.db.connect() as con:
+            return con.execute(
+                'SELECT a.url, b.url FROM edges '
+                'JOIN urls AS a ON a.ID = edges.url_id '
+                'JOIN urls AS b ON b.ID = edges.link_id '
+                'WHERE a.url != \'seed\' ORDER BY edges.rowid').fetchall()
+
+    def _compare(self, pages, batch_size, **kwargs):
+        sequential = self._agent(pages, **kwargs)
+        parallel = self._agent(pages, **kwargs)
+        try:
+            sequential.find_links_in_archive('ul', 'list_16')
+            parallel.find_links_in_archive(
+                'ul', 'list_16', workers = 2, batch_size = batch_size)
+            assert_equals(self._scanned(parallel), self._scanned(sequential))
+            assert_equals(parallel.db.get_unscanned(), [])
+            assert_equals(
+                parallel.metrics['scan_links_per_page'].count(),
+                sequential.metrics['scan_links_per_page'].count())
+        finally:
+            sequential.close()
+            parallel.close()
+        return self._scanned(parallel)
+
+    def test_same_as_sequential(self):
+        pages = {ROOT + str(i): page(i) for i in range(25)}
+        # Same contents as the first page, scanned once.
+        pages[ROOT + 'copy'] = page(0)
+        for batch_size in (1, 4, 100):
+            scanned = self._compare(pages, batch_size)
+        assert_equals(
+            scanned[:2],
+            [(ROOT + '0', ROOT + 'a/0.html'), (ROOT + '0', ROOT + 'b/0.html')])
+        assert_equals(len(scanned), 75)
+
+    def test_artifacts(self):
+        pages = {ROOT + str(i): page(i) for i in range(10)}
+        agent = self._agent(pages, backend = 'memory', artifacts = True)
+        agent.find_links_in_archive(
+            'ul', 'list_16', workers = 2, batch_size = 3)
+        artifacts = agent.analyzer.get_artifacts()
+        assert_equals(artifacts.stats()['artifacts'], 20)
+        for url in pages:
+            agent.db.set_unscanned(url)
+        before = self._scanned(agent)
+        agent.find_links_in_archive(
+            'ul', 'list_16', workers = 2, batch_size = 3)
+        assert_equals(artifacts.stats()['hits'], 10)
+        assert_equals(agent.metrics['scan_parse_seconds'].count(), 10)
+        assert_equals(
+            agent.analyzer.find_encoding_of_page(ROOT + '0'), 'utf-8')
+        assert_equals(self._scanned(agent), before)
+        agent.close()
+
+    def test_missing_file(self):
+        pages = {ROOT + str(i): page(i) for i in range(6)}
+        pages[ROOT + '3'] = None
+        sequential = self._agent(pages)
+        parallel = self._agent(pages)
+        try:
+            assert_raises(OSError, sequential.find_links_in_archive)
+            assert_raises(
+                OSError, parallel.find_links_in_archive,
+                workers = 2, batch_size = 2)
+            assert_equals(self._scanned(parallel), self._scanned(sequential))
+        finally:
+            sequential.close()
+            parallel.close()
+
+    def test_arguments(self):
+        analyzer = self._agent({}).analyzer
+        assert_raises(
+            TypeError, analyzer.find_links_in_pages, [], workers = '2')
+        assert_raises(
+            ValueError, analyzer.find_links_in_pages, [], batch_size = 0)
+        analyzer.parent.close()
@@ -0,0 +1,54 @@
+""" Test request pacing.
+
+"""
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+class TestTokenBucket(object):
+
+    def test_burst_is_free(self):
+        bucket = archiver.TokenBucket(rate = 1, burst = 2)
+        assert_equals(bucket.reserve(), 0)
+        assert_equals(bucket.reserve(), 0)
+
+    def test_wait_after_burst(self):
+        bucket = archiver.TokenBucket(rate = 10, burst = 1)
+        bucket.reserve()
+        wait = bucket.reserve()
+        assert_true(0.05 < wait <= 0.1)
+
+class TestHostScheduler(object):
+
+    def setup(self):
+        self.scheduler = archiver.HostScheduler(
+            rate = 4, min_rate = 1, max_rate = 5, increase = 1, slow = 1)
+
+    def test_error_slows_down(self):
+        self.scheduler.record('example.com', error = True)
+        assert_equals(self.scheduler.get_rate('example.com'), 2)
+        self.scheduler.record('example.com', error = True)
+        self.scheduler.record('example.com', error = True)
+        assert_equals(self.scheduler.get_rate('example.com'), 1)
+
+    def test_success_speeds_up(self):
+        self.scheduler.record('example.com', latency = 0.1)
+        self.scheduler.record('example.com', latency = 0.1)
+        assert_equals(self.scheduler.get_rate('example.com'), 5)
+
+    def test_slow_responses_slow_down(self):
+        self.scheduler.record('example.com', latency = 10)
+        assert_equals(self.scheduler.get_rate('example.com'), 2)
+
+    def test_hosts_are_independent(self):
+        self.scheduler.record('example.com', error = True)
+        assert_equals(self.scheduler.get_rate('example.org'), 4)
+
+    def test_rates_raise_ValueError(self):
+        assert_raises(
+            ValueError, archiver.HostScheduler, rate = 10, max_rate = 5)
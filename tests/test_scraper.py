@@ -0,0 +1,313 @@
+""" Test fetching pages from a local server.
+
+"""
+
+import gzip
+import http.server
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+PAGE = b'<html><body>' + 2000 * b'text ' + b'</body></html>'
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answers paths with the function for them in routes."""
+
+    protocol_version = 'HTTP/1.1'
+    routes = {}
+
+    def do_GET(self):
+        route = self.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+        route(self)
+
+    def send_body(self, body, status = 200, headers = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cut(self, body, at, status = 200, headers = None):
+        """Send the headers for body, then only its first at bytes."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:at])
+        self.wfile.flush()
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+class TestScraper(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setup(self):
+        Handler.routes = {}
+        self.directory = tempfile.mkdtemp()
+        self.agent = archiver.Agent(
+            directory = self.directory, archive_folder = 'archives', db = 'db')
+        self.scraper = self.agent.scraper
+        self.scraper.scheduler = archiver.HostScheduler(
+            rate = 50, max_rate = 50, burst = 50)
+        # Leave failed urls for the next run rather than wait for them.
+        self.scraper.retry_wait = 0
+
+    def teardown(self):
+        self.agent.close()
+        shutil.rmtree(self.directory)
+
+    def read(self, url):
+        return self.agent.fh.read_page(self.agent.db.get_filename(url))
+
+    def archived(self):
+        """Names of the files in the archive, temporary ones included."""
+        return sorted(
+            name for _, _, names in os.walk(self.agent.fh.archive_folder)
+            for name in names)
+
+    def test_undecodable_body_is_retried(self):
+        # Not gzipped, nor all there.
+        bad = lambda h: h.send_body(
+            PAGE, headers = {'Content-Encoding': 'gzip'})
+        good = lambda h: h.send_body(
+            gzip.compress(PAGE), headers = {'Content-Encoding': 'gzip'})
+        for concurrency in (None, 2):
+            urls = ['/bad', '/good', '/cut']
+            urls = ['{}{}/{}'.format(self.url, path, concurrency)
+                    for path in urls]
+            Handler.routes.update({
+                '/bad/{}'.format(concurrency): bad,
+                '/good/{}'.format(concurrency): good,
+                '/cut/{}'.format(concurrency): lambda h: h.send_body(
+                    gzip.compress(PAGE)[:-100] + 100 * b'x',
+                    headers = {'Content-Encoding': 'gzip'}),
+            })
+            self.scraper.load_pages(urls, concurrency = concurrency)
+            assert_equals(self.read(urls[1]), PAGE)
+            for url in urls[0], urls[2]:
+                assert_raises(KeyError, self.agent.db.get_filename, url)
+                assert_equals(self.agent.db.get_retry(url)[0], 1)
+        assert_equals(
+            self.agent.metrics['crawl_failures_total'].value(
+                reason = 'decode'), 4)
+        # The same page twice, and no partial files.
+        assert_equals(len(self.archived()), 1)
+
+    def test_locked_index_is_retried(self):
+        Handler.routes['/page'] = lambda h: h.send_body(PAGE)
+        url = self.url + '/page'
+        def locked(fname):
+            raise sqlite3.OperationalError('database is locked')
+        self.agent.fh.open_page = locked
+        self.scraper.load_pages([url])
+        assert_raises(KeyError, self.agent.db.get_filename, url)
+        assert_equals(self.agent.db.get_retry(url)[0], 1)
+        assert_equals(
+            self.agent.metrics['crawl_failures_total'].value(
+                reason = 'locked'), 1)
+
+    def flaky(self, *statuses):
+        """Route answering with statuses in turn, then with PAGE."""
+        statuses = list(statuses)
+        calls = []
+        def route(handler):
+            calls.append(handler.path)
+            if statuses:
+                handler.send_body(b'', status = statuses.pop(0))
+            else:
+                handler.send_body(PAGE)
+        return route, calls
+
+    def test_worker_defers_failed_urls(self):
+        Handler.routes['/flaky'], calls = self.flaky(503)
+        urls = [self.url + path for path in ('/flaky', '/a', '/b', '/c')]
+        for path in '/a', '/b', '/c':
+            Handler.routes[path] = lambda h: h.send_body(PAGE)
+        self.agent.db.add_to_frontier(urls)
+        self.agent.run_worker('worker', batch_size = 2)
+        assert_equals(len(calls), 1)
+        assert_equals(self.agent.db.claim_urls('other'), [])
+        assert_equals(
+            self.agent.db.get_next_deferred(),
+            self.agent.db.get_retry(urls[0])[1])
+        assert_equals(self.agent.db.get_frontier_size(), 1)
+
+    def test_worker_retries_when_due(self):
+        Handler.routes['/flaky'], calls = self.flaky(503, 503)
+        db = self.agent.db
+        db.schedule_retry = lambda url, error: type(db).schedule_retry(
+            db, url, error, delay = 0.1)
+        self.scraper.retry_wait = 5
+        url = self.url + '/flaky'
+        db.add_to_frontier([url])
+        self.agent.run_worker('worker')
+        assert_equals(len(calls), 3)
+        assert_equals(self.read(url), PAGE)
+        assert_equals(db.get_frontier_size(), 0)
+        assert_equals(db.get_retry(url), None)
+
+    def test_retry_is_left_to_the_caller(self):
+        Handler.routes['/flaky'], calls = self.flaky(503)
+        db = self.agent.db
+        db.schedule_retry = lambda url, error: type(db).schedule_retry(
+            db, url, error, delay = 0.1)
+        self.scraper.retry_wait = 5
+        url = self.url + '/flaky'
+        self.agent.load_pages([url], retry = False)
+        assert_equals(len(calls), 1)
+        assert_equals(db.get_retry(url)[0], 1)
+        self.agent.load_pages([url])
+        assert_equals(self.read(url), PAGE)
+
+    def test_pacing(self):
+        agent = archiver.Agent(
+            directory = self.directory, archive_folder = 'archives',
+            db = 'db', backend = 'memory', rate = 10, max_rate = 100)
+        assert_equals(
+            (agent.scraper.scheduler.rate, agent.scraper.scheduler.max_rate),
+            (10, 100))
+        agent.close()
+
+    def test_interrupt_keeps_shared_file(self):
+        Handler.routes['/a'] = Handler.routes['/b'] = (
+            lambda h: h.send_body(PAGE))
+        first, second = self.url + '/a', self.url + '/b'
+        self.scraper.load_pages([first])
+        db = self.agent.db
+        update_fetched = db.update_fetched
+        def interrupt(url, revert = False):
+            if url == second and not revert:
+                raise KeyboardInterrupt
+            update_fetched(url, revert)
+        db.update_fetched = interrupt
+        # Interrupted once its contents turned out to be those of first.
+        assert_raises(SystemExit, self.scraper._fetch_page, second)
+        assert_equals(self.read(first), PAGE)
+        assert_raises(KeyError, db.get_filename, second)
+
+    def resumable(self, whole = False, cut = False):
+        """Route cutting PAGE off halfway, then answering Range requests
+        with the rest (cut off again if cut), or with all of it (whole).
+
+        """
+        requests = []
+        etag = {'ETag': '"v1"'}
+        def route(handler):
+            requests.append(
+                (handler.headers.get('Range'), handler.headers.get('If-Range')))
+            if handler.headers.get('Range') is None:
+                handler.send_cut(PAGE, len(PAGE) // 2, headers = etag)
+            elif whole:
+                handler.send_body(PAGE, headers = etag)
+            else:
+                start = int(handler.headers['Range'][6:-1])
+                rest = PAGE[start:]
+                headers = dict(etag)
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, len(PAGE) - 1, len(PAGE))
+                if cut:
+                    handler.send_cut(rest, 10, 206, headers)
+                else:
+                    handler.send_body(rest, 206, headers)
+        return route, requests
+
+    def test_body_is_resumed_with_range(self):
+        Handler.routes['/page'], requests = self.resumable()
+        url = self.url + '/page'
+        self.scraper.load_pages([url])
+        assert_equals(self.read(url), PAGE)
+        assert_equals(
+            requests,
+            [(None, None), ('bytes={}-'.format(len(PAGE) // 2), '"v1"')])
+        assert_equals(
+            self.agent.db.get_validators(url)['content_length'], len(PAGE))
+
+    def test_body_is_restarted_on_200(self):
+        Handler.routes['/page'], requests = self.resumable(whole = True)
+        url = self.url + '/page'
+        self.scraper.load_pages([url])
+        assert_equals(self.read(url), PAGE)
+        assert_equals(len(requests), 2)
+
+    def test_broken_body_leaves_nothing(self):
+        Handler.routes['/page'], requests = self.resumable(cut = True)
+        url = self.url + '/page'
+        self.scraper.load_pages([url])
+        assert_equals(len(requests), self.scraper.max_resumes + 1)
+        assert_raises(KeyError, self.agent.db.get_filename, url)
+        assert_equals(self.agent.db.get_retry(url)[0], 1)
+        assert_equals(self.archived(), [])
+
+    def versioned(self):
+        """Route serving version[0] with its ETag, or 304 if the client has
+        it already.
+
+        """
+        version = ['v1']
+        requests = []
+        def route(handler):
+            etag = '"{}"'.format(version[0])
+            requests.append(handler.headers.get('If-None-Match'))
+            if handler.headers.get('If-None-Match') == etag:
+                handler.send_body(b'', 304, {'ETag': etag})
+            else:
+                handler.send_body(
+                    PAGE + version[0].encode(), headers = {'ETag': etag})
+        return route, version, requests
+
+    def test_refetch_unchanged(self):
+        Handler.routes['/page'], _, requests = self.versioned()
+        url = self.url + '/page'
+        self.agent.db.seed_archive([url])
+        self.scraper.load_pages([url])
+        fname = self.agent.db.get_filename(url)
+        self.agent.db.set_scanned(url)
+        self.agent.refetch_seeds()
+        assert_equals(requests, [None, '"v1"'])
+        assert_equals(self.agent.db.get_filename(url), fname)
+        assert_equals(self.read(url), PAGE + b'v1')
+        assert_equals(self.agent.db.get_validators(url)['etag'], '"v1"')
+        assert_equals(self.agent.db.get_unscanned(), [])
+
+    def test_refetch_changed(self):
+        Handler.routes['/page'], version, requests = self.versioned()
+        url = self.url + '/page'
+        self.agent.db.seed_archive([url])
+        self.scraper.load_pages([url])
+        self.agent.db.set_scanned(url)
+        version[0] = 'v2'
+        self.agent.refetch_seeds()
+        assert_equals(requests, [None, '"v1"'])
+        assert_equals(self.read(url), PAGE + b'v2')
+        assert_equals(self.agent.db.get_validators(url)['etag'], '"v2"')
+        # The old version is gone, and the new one is to be scanned.
+        assert_equals(len(self.archived()), 1)
+        assert_equals(self.agent.db.get_unscanned(), [url])
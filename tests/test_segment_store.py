@@ -0,0 +1,87 @@
+""" Test packed page storage.
+
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true, assert_false
+
+import archiver
+
+# pylint: disable=missing-docstring,no-self-use,attribute-defined-outside-init,too-many-public-methods,protected-access
+
+class TestSegmentStore(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = archiver.SegmentStore(self.temp_dir, segment_size = 100)
+
+    def teardown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_put_get(self):
+        self.store.put(1, b'Some contents')
+        assert_equals(self.store.get(1), b'Some contents')
+
+    def test_put_file_object(self):
+        fpath = os.path.join(self.temp_dir, 'page')
+        with open(fpath, 'wb') as f: f.write(200 * b'Some contents')
+        with open(fpath, 'rb') as f:
+            self.store.put(1, f)
+        assert_equals(self.store.get(1), 200 * b'Some contents')
+
+    def test_get_raises_KeyError(self):
+        assert_raises(KeyError, self.store.get, 1)
+
+    def test_file_id_raises_TypeError(self):
+        assert_raises(TypeError, self.store.put, '000001', b'')
+
+    def test_put_replaces(self):
+        self.store.put(1, b'Old contents')
+        self.store.put(1, b'New contents')
+        assert_equals(self.store.get(1), b'New contents')
+        assert_equals(list(self.store.scan()), [(1, b'New contents')])
+
+    def test_segments_roll_over(self):
+        for i in range(1, 4):
+            self.store.put(i, os.urandom(100))
+        assert_equals(self.store.segments(), [1, 2, 3])
+
+    def test_scan(self):
+        self.store.put(1, b'a')
+        self.store.put(2, b'b')
+        self.store.delete(1)
+        assert_false(1 in self.store)
+        assert_true(2 in self.store)
+        assert_equals(list(self.store.scan()), [(2, b'b')])
+
+    def test_stores_share_folder(self):
+        other = archiver.SegmentStore(self.temp_dir)
+        self.store.put(1, b'a')
+        other.put(2, b'b')
+        other.close()
+        assert_equals(self.store.get(2), b'b')
+        assert_equals(len(self.store.segments()), 2)
+
+    def test_waits_for_index(self):
+        con = sqlite3.connect(
+            os.path.join(self.temp_dir, 'index'), check_same_thread = False)
+        con.execute('BEGIN IMMEDIATE')
+        impatient = type('Store', (archiver.SegmentStore,), {'busy_timeout': 0})
+        other = impatient(self.temp_dir)
+        start = time.monotonic()
+        assert_raises(sqlite3.OperationalError, other.put, 1, b'a')
+        assert_true(time.monotonic() - start < 1)
+        other.close()
+        threading.Timer(0.2, con.rollback).start()
+        self.store.put(1, b'a')
+        assert_equals(self.store.get(1), b'a')
+        con.close()
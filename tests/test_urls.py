@@ -65,3 +65,66 @@ class TestGetArchiveUrls(object):
         assert_raises(
             ValueError, archiver.get_archive_urls, from_date='today',
             earliest_date='2012-02-06', schema = '[]')
+
+class TestCanonicalUrl(object):
+
+    def test_relative_link(self):
+        assert_equals(
+            archiver.canonical_url('../x.html', 'http://example.com/a/b/c.html'),
+            'http://example.com/a/x.html')
+
+    def test_root_relative_link(self):
+        assert_equals(
+            archiver.canonical_url('/GB/1.html', 'https://example.com/a/b.html'),
+            'https://example.com/GB/1.html')
+
+    def test_host_and_scheme_are_lowercase(self):
+        assert_equals(
+            archiver.canonical_url('HTTP://Example.COM/Page'),
+            'http://example.com/Page')
+
+    def test_default_port_and_fragment_are_dropped(self):
+        assert_equals(
+            archiver.canonical_url('http://example.com:80/a#top'),
+            'http://example.com/a')
+        assert_equals(
+            archiver.canonical_url('http://example.com:8080'),
+            'http://example.com:8080/')
+
+    def test_query_is_kept(self):
+        assert_equals(
+            archiver.canonical_url('http://example.com/?b=2&a=1'),
+            'http://example.com/?b=2&a=1')
+
+    def test_query_is_sorted(self):
+        assert_equals(
+            archiver.canonical_url(
+                'http://example.com/?b=2&a=1&utm_source=x', query = 'sort',
+                ignore_params = ('utm_*',)),
+            'http://example.com/?a=1&b=2')
+
+    def test_query_is_dropped(self):
+        assert_equals(
+            archiver.canonical_url('http://example.com/a?b=2', query = 'drop'),
+            'http://example.com/a')
+
+    def test_other_urls_are_kept(self):
+        assert_equals(archiver.canonical_url('link_1'), 'link_1')
+        assert_equals(
+            archiver.canonical_url('mailto:a@example.com'),
+            'mailto:a@example.com')
+
+    def test_malformed_urls_are_kept(self):
+        for url in ('http://a.com:abc/x', 'http://a.com:99999/',
+                    'http://[bad/x'):
+            assert_equals(archiver.canonical_url(url), url)
+        assert_equals(
+            archiver.canonical_url('/x', 'http://[bad/'), '/x')
+
+    def test_query_raises_ValueError(self):
+        assert_raises(
+            ValueError, archiver.canonical_url, 'http://example.com',
+            query = 'x')
+
+    def test_url_raises_TypeError(self):
+        assert_raises(TypeError, archiver.canonical_url, 1)